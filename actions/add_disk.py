@@ -15,7 +15,8 @@
 # limitations under the License.
 
 import os
-import psutil
+import re
+import subprocess
 import sys
 
 sys.path.append('lib')
@@ -26,27 +27,76 @@ import charmhelpers.core.hookenv as hookenv
 
 import ceph_hooks
 import ceph.utils
+from ceph import device_registry
+import charm_agent
+import log_buffer
 
 
-def add_device(request, device_path, bucket=None):
-    ceph.utils.osdize(dev, hookenv.config('osd-format'),
-                      ceph_hooks.get_journal_devices(),
-                      hookenv.config('ignore-device-errors'),
-                      hookenv.config('osd-encrypt'),
-                      hookenv.config('bluestore'),
-                      hookenv.config('osd-encrypt-keymanager'))
+def get_osd_ids(devices):
+    """Find the ids of the OSDs on devices.
+
+    ceph-volume is asked once for every local OSD; devices it does not
+    report directly, such as encrypted ones, are looked up in the device
+    registry.
+
+    :param devices: list. Device paths
+    :returns: dict. List of the ids of the OSDs on each device holding any,
+              keyed by device path
+    """
+    try:
+        osds = ceph.utils.get_ceph_volume_osds()
+    except (subprocess.CalledProcessError, OSError, ValueError) as e:
+        hookenv.log('Unable to list ceph-volume OSDs: {}'.format(e),
+                    level=hookenv.WARNING)
+        osds = {}
+    registry = device_registry.registry()
+    osd_ids = {}
+    for dev in devices:
+        ids = (osds.get(os.path.realpath(dev)) or
+               device_registry.osd_ids(registry.lookup(dev)))
+        if ids:
+            osd_ids[dev] = ids
+    return osd_ids
+
+
+def add_devices(devices, bucket=None, parallel=None):
+    """Prepare devices as OSDs and move them to bucket.
+
+    :param devices: list. Device paths
+    :param bucket: str. CRUSH bucket to move the new OSDs to
+    :param parallel: int. Maximum number of devices prepared at once
+    :returns: tuple. Seconds taken to prepare each device keyed by device
+              path, and the OSD ids of each device which holds any
+    """
+    timings = ceph.utils.osdize_devs(
+        devices, hookenv.config('osd-format'),
+        ceph_hooks.get_journal_devices(),
+        hookenv.config('ignore-device-errors'),
+        hookenv.config('osd-encrypt'),
+        hookenv.config('bluestore'),
+        hookenv.config('osd-encrypt-keymanager'),
+        parallel=parallel)
     # Make it fast!
     if hookenv.config('autotune'):
-        ceph.utils.tune_dev(dev)
-    mounts = filter(lambda disk: device_path
-                    in disk.device, psutil.disk_partitions())
-    for osd in mounts:
-        osd_id = osd.mountpoint.split('/')[-1].split('-')[-1]
-        request.ops.append({
-            'op': 'move-osd-to-bucket',
-            'osd': "osd.{}".format(osd_id),
-            'bucket': bucket})
-    return request
+        for dev in devices:
+            ceph.utils.tune_dev(dev)
+    ceph_hooks.tune_dm_crypt()
+    osd_ids = get_osd_ids(devices)
+    if bucket and osd_ids:
+        request = ch_ceph.CephBrokerRq()
+        for dev in devices:
+            for osd_id in osd_ids.get(dev, []):
+                request.ops.append({
+                    'op': 'move-osd-to-bucket',
+                    'osd': "osd.{}".format(osd_id),
+                    'bucket': bucket})
+        ch_ceph.send_request_if_needed(request, relation='mon')
+    return timings, osd_ids
+
+
+def _key(dev):
+    """Action result key for a device path."""
+    return re.sub('[^a-z0-9]+', '-', os.path.basename(dev).lower()).strip('-')
 
 
 def get_devices():
@@ -59,10 +109,23 @@ def get_devices():
     return devices
 
 
+def add_disk():
+    timings, osd_ids = add_devices(get_devices(),
+                                   bucket=hookenv.action_get('bucket'),
+                                   parallel=hookenv.action_get('parallel'))
+    charm_agent.invalidate()
+    ceph_hooks.refresh_nrpe_checks()
+    results = {}
+    for dev, ids in osd_ids.items():
+        results['osd-ids.{}'.format(_key(dev))] = ' '.join(
+            str(osd_id) for osd_id in ids)
+    for dev, seconds in timings.items():
+        results['timings.{}'.format(_key(dev))] = '{:.1f}'.format(seconds)
+    if results:
+        hookenv.action_set(results)
+
+
 if __name__ == "__main__":
-    request = ch_ceph.CephBrokerRq()
-    for dev in get_devices():
-        request = add_device(request=request,
-                             device_path=dev,
-                             bucket=hookenv.action_get("bucket"))
-    ch_ceph.send_request_if_needed(request, relation='mon')
+    log_buffer.install(hookenv.config('charm-log-level'))
+    ceph_hooks.forget_published_status()
+    add_disk()
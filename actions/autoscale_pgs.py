@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+
+sys.path.append('lib')
+sys.path.append('hooks')
+
+import charmhelpers.core.hookenv as hookenv
+
+from ceph.pg_utils import (
+    apply_pg_plan,
+    get_cluster_pg_state,
+    plan_pgs,
+)
+
+CEPH_SERVICE = 'osd-upgrade'
+
+
+def format_plan(plans):
+    """Render a plan as one 'pool: current -> target' line per pool."""
+    lines = []
+    for plan in plans:
+        marker = '*' if plan.target_pg_num != plan.pg_num else ' '
+        lines.append('{} {}: {} -> {} (size {}, {} OSDs)'.format(
+            marker, plan.name, plan.pg_num, plan.target_pg_num,
+            plan.size, plan.osd_count))
+    return '\n'.join(lines)
+
+
+def autoscale_pgs():
+    plans = plan_pgs(get_cluster_pg_state(CEPH_SERVICE),
+                     hookenv.action_get('target-pgs-per-osd'),
+                     hookenv.action_get('max-pgs-per-osd'))
+    changes = [plan for plan in plans if plan.target_pg_num != plan.pg_num]
+    result = {
+        'plan': format_plan(plans),
+        'pools-to-change': len(changes),
+    }
+    if hookenv.action_get('apply') and changes:
+        apply_pg_plan(CEPH_SERVICE, changes,
+                      step=hookenv.action_get('step'))
+        result['applied'] = 'true'
+    hookenv.action_set(result)
+
+
+if __name__ == '__main__':
+    try:
+        autoscale_pgs()
+    except Exception as e:
+        hookenv.action_fail('Action autoscale-pgs failed: {}'.format(str(e)))
@@ -14,15 +14,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import fnmatch
+import glob
 import os
 import sys
 
+sys.path.append('lib')
 sys.path.append('hooks')
 
 import charmhelpers.core.hookenv as hookenv
-import charmhelpers.core.unitdata as unitdata
-
-BLACKLIST_KEY = 'osd-blacklist'
+from ceph import device_registry
 
 
 class Error(Exception):
@@ -44,20 +45,33 @@ def get_devices():
     return devices
 
 
+def expand(pattern):
+    """Return the existing paths matching pattern.
+
+    :param pattern: str. Device path, or a glob such as
+                    /dev/disk/by-path/pci-0000:00:1f.2-ata-*
+    :returns: list. Matching paths
+    """
+    if glob.has_magic(pattern):
+        return sorted(glob.glob(pattern))
+    return [pattern] if os.path.exists(pattern) else []
+
+
 def blacklist_add():
     """
     Add devices given in 'osd-devices' action parameter to
     unit-local devices blacklist.
     """
-    db = unitdata.kv()
-    blacklist = db.get(BLACKLIST_KEY, [])
-    for device in get_devices():
-        if not os.path.exists(device):
-            raise Error('{}: No such file or directory.'.format(device))
-        if device not in blacklist:
-            blacklist.append(device)
-    db.set(BLACKLIST_KEY, blacklist)
-    db.flush()
+    devices = []
+    for pattern in get_devices():
+        matches = expand(pattern)
+        if not matches:
+            raise Error('{}: No such file or directory.'.format(pattern))
+        devices.extend(matches)
+    registry = device_registry.registry()
+    for device in devices:
+        registry.blacklist(device)
+    registry.db.flush()
 
 
 def blacklist_remove():
@@ -65,15 +79,21 @@ def blacklist_remove():
     Remove devices given in 'osd-devices' action parameter from
     unit-local devices blacklist.
     """
-    db = unitdata.kv()
-    blacklist = db.get(BLACKLIST_KEY, [])
-    for device in get_devices():
-        try:
-            blacklist.remove(device)
-        except ValueError:
-            raise Error('{}: Device not in blacklist.'.format(device))
-    db.set(BLACKLIST_KEY, blacklist)
-    db.flush()
+    registry = device_registry.registry()
+    records = registry.devices(device_registry.BLACKLISTED)
+    remove = {}
+    for pattern in get_devices():
+        identities = set(registry.identity(path) for path in expand(pattern))
+        matched = [record for record in records
+                   if record['id'] in identities or
+                   fnmatch.filter(record['paths'], pattern)]
+        if not matched:
+            raise Error('{}: Device not in blacklist.'.format(pattern))
+        for record in matched:
+            remove[record['id']] = record['paths'][0]
+    for device in remove.values():
+        registry.unblacklist(device)
+    registry.db.flush()
 
 
 # A dictionary of all the defined actions to callables
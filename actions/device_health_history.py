@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import sys
+
+sys.path.append('lib')
+sys.path.append('hooks')
+
+import charmhelpers.core.hookenv as hookenv
+
+import ceph_hooks
+import device_health
+
+
+def device_health_history():
+    devices = ceph_hooks.get_monitored_devices()
+    history = device_health.get_history(devices,
+                                        ceph_hooks.device_health_dir())
+    problems = device_health.assess_devices(history)
+    hookenv.action_set({
+        'history': json.dumps({
+            device: [sample._asdict() for sample in samples]
+            for device, samples in history.items()}),
+        'problems': json.dumps(problems),
+    })
+
+
+if __name__ == '__main__':
+    try:
+        device_health_history()
+    except Exception as e:
+        hookenv.action_fail('Action device-health-history failed: {}'
+                            .format(str(e)))
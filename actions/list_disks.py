@@ -26,6 +26,8 @@ in the local kv store of this specific unit.
 The 'non-pristine' key is populated with block devices that are known by
 udev, are not mounted, not mentioned in 'osd-journal' configuration option
 and are currently not eligible for use because of presence of foreign data.
+
+The disks are classified by the charm agent when it is running.
 """
 
 import sys
@@ -35,19 +37,16 @@ sys.path.append('lib/')
 
 import charmhelpers.core.hookenv as hookenv
 
-import ceph.utils
+import charm_agent
 import utils
 
 if __name__ == '__main__':
-    non_pristine = []
     osd_journal = utils.get_journal_devices()
-    for dev in list(set(ceph.utils.unmounted_disks()) - set(osd_journal)):
-        if (not ceph.utils.is_active_bluestore_device(dev) and
-                not ceph.utils.is_pristine_disk(dev)):
-            non_pristine.append(dev)
-
+    inventory = charm_agent.inventory()
     hookenv.action_set({
-        'disks': list(set(ceph.utils.unmounted_disks()) - set(osd_journal)),
-        'blacklist': utils.get_blacklist(),
-        'non-pristine': non_pristine,
+        'disks': [dev for dev in inventory['disks']
+                  if dev not in osd_journal],
+        'blacklist': sorted(utils.get_blacklist()),
+        'non-pristine': [dev for dev in inventory['non-pristine']
+                         if dev not in osd_journal],
     })
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+
+sys.path.append('lib')
+sys.path.append('hooks')
+
+import charmhelpers.core.hookenv as hookenv
+
+from ceph.primary_affinity import (
+    apply_primary_affinity,
+    plan_local_primary_affinity,
+)
+
+CEPH_SERVICE = 'osd-upgrade'
+
+
+def format_plan(plans):
+    """Render a plan as one 'osd: current -> new' line per OSD."""
+    lines = []
+    for plan in plans:
+        marker = '*' if plan.new_affinity != plan.affinity else ' '
+        lines.append('{} osd.{}: {} -> {} ({}ms, target {})'.format(
+            marker, plan.osd_id, plan.affinity, plan.new_affinity,
+            plan.latency_ms, plan.target))
+    return '\n'.join(lines)
+
+
+def optimize_primary_affinity():
+    plans = plan_local_primary_affinity(
+        CEPH_SERVICE,
+        step=hookenv.action_get('step'),
+        hysteresis=hookenv.action_get('hysteresis'),
+        min_affinity=hookenv.action_get('min-affinity'))
+    changes = [plan for plan in plans if plan.new_affinity != plan.affinity]
+    result = {
+        'plan': format_plan(plans),
+        'osds-to-change': len(changes),
+    }
+    if hookenv.action_get('apply') and changes:
+        changed = apply_primary_affinity(changes)
+        result['applied'] = ' '.join('osd.{}'.format(osd_id)
+                                     for osd_id in changed)
+    hookenv.action_set(result)
+
+
+if __name__ == '__main__':
+    try:
+        optimize_primary_affinity()
+    except Exception as e:
+        hookenv.action_fail(
+            'Action optimize-primary-affinity failed: {}'.format(str(e)))
@@ -18,40 +18,62 @@
 
 import os
 import sys
-from subprocess import check_call
 
 sys.path.append('lib')
 sys.path.append('hooks')
 
 from charmhelpers.core.hookenv import (
     action_fail,
+    action_get,
+    action_set,
+)
+from charmhelpers.core.unitdata import kv
+
+from ceph.pg_utils import wait_for_active_clean
+from ceph.utils import (
+    get_local_osd_ids,
+    mark_osds,
+    set_maintenance_flags,
+    start_osds_staggered,
+    stop_osds_parallel,
+)
+from ceph_hooks import (
+    assess_status,
+    forget_published_status,
 )
-
-from ceph.utils import get_local_osd_ids
-from ceph_hooks import assess_status
 
 from utils import (
     set_unit_paused,
     clear_unit_paused,
 )
 
+# Where pause set the maintenance flags, so that resume unsets only those
+MAINTENANCE_FLAGS_KEY = 'pause-maintenance-flags'
+
+
+def _report(timings):
+    action_set(dict(('timings.osd-{}'.format(osd_id), '{:.1f}'.format(t))
+                    for osd_id, t in timings.items()))
+
 
 def pause(args):
     """Pause the ceph-osd units on the local machine only.
 
-    Optionally uses the 'osd-number' from juju action param to only pause a
-    specific osd.  If all the osds are not stopped then the paused status is
-    not set.
+    All local OSDs are marked out with a single command. Optionally noout
+    and norebalance are set for this host first, and the OSD daemons are
+    stopped, several at a time, afterwards.
 
     @raises CalledProcessError if the ceph commands fails.
     @raises OSError if it can't get the local osd ids.
     """
-    for local_id in get_local_osd_ids():
-        cmd = [
-            'ceph',
-            '--id', 'osd-upgrade',
-            'osd', 'out', str(local_id)]
-        check_call(cmd)
+    local_ids = get_local_osd_ids()
+    db = kv()
+    if action_get('set-flags') and db.get(MAINTENANCE_FLAGS_KEY) is None:
+        db.set(MAINTENANCE_FLAGS_KEY, set_maintenance_flags())
+        db.flush()
+    mark_osds(local_ids, 'out')
+    if action_get('stop-osds'):
+        _report(stop_osds_parallel(local_ids, action_get('parallel')))
     set_unit_paused()
     assess_status()
 
@@ -59,17 +81,32 @@ def pause(args):
 def resume(args):
     """Resume the ceph-osd units on this local machine only
 
+    Any stopped OSD daemons are started in waves before the OSDs are
+    marked in with a single command, and maintenance flags set by pause
+    are unset. The action then waits for all PGs to become active+clean,
+    up to the wait-timeout parameter.
+
     @raises subprocess.CalledProcessError should the osd units fails to resume.
     @raises OSError if the unit can't get the local osd ids
     """
-    for local_id in get_local_osd_ids():
-        cmd = [
-            'ceph',
-            '--id', 'osd-upgrade',
-            'osd', 'in', str(local_id)]
-        check_call(cmd)
+    local_ids = get_local_osd_ids()
+    timings = {}
+    start_osds_staggered(local_ids, action_get('parallel'), timings=timings)
+    mark_osds(local_ids, 'in')
+    db = kv()
+    flags = db.get(MAINTENANCE_FLAGS_KEY)
+    if flags is not None:
+        set_maintenance_flags(unset=True, flags=flags)
+        db.unset(MAINTENANCE_FLAGS_KEY)
+        db.flush()
     clear_unit_paused()
     assess_status()
+    _report(timings)
+    timeout = action_get('wait-timeout')
+    if timeout:
+        clean = wait_for_active_clean('osd-upgrade', timeout)
+        action_set({'pgs-active-clean': clean})
+
 
 # A dictionary of all the defined actions to callables (which take
 # parsed arguments).
@@ -92,4 +129,5 @@ def main(args):
 
 
 if __name__ == "__main__":
+    forget_published_status()
     sys.exit(main(sys.argv))
@@ -16,19 +16,27 @@
 
 import os
 import sys
+import time
+from multiprocessing.pool import ThreadPool
 
 sys.path.append('lib')
 sys.path.append('hooks')
 
 import charmhelpers.core.hookenv as hookenv
-from charmhelpers.contrib.storage.linux.utils import (
-    is_block_device,
-    is_device_mounted,
-    zap_disk,
+from charmhelpers.contrib.storage.linux.utils import is_block_device
+from ceph import device_registry
+from ceph.utils import (
+    block_device_inventory,
+    wipe_block_device,
 )
-from charmhelpers.core.unitdata import kv
-from ceph.utils import is_active_bluestore_device
-from ceph.utils import is_mapped_luks_device
+from ceph_hooks import (
+    forget_published_status,
+    refresh_nrpe_checks,
+)
+import charm_agent
+
+# Maximum number of devices wiped at once
+ZAP_PARALLEL = 8
 
 
 def get_devices():
@@ -43,52 +51,89 @@ def get_devices():
     return devices
 
 
+def _wipe(args):
+    device, info, discard = args
+    started = time.time()
+    try:
+        wipe_block_device(device, info['mappings'], info['fstype'],
+                          discard=discard and info['discard'])
+    except Exception as e:
+        return device, None, e
+    return device, time.time() - started, None
+
+
 def zap():
     if not hookenv.action_get('i-really-mean-it'):
         hookenv.action_fail('i-really-mean-it is a required parameter')
         return
 
-    failed_devices = []
-    not_block_devices = []
     devices = get_devices()
-    for device in devices:
-        if not is_block_device(device):
-            not_block_devices.append(device)
-        if (is_device_mounted(device) or
-                is_active_bluestore_device(device) or
-                is_mapped_luks_device(device)):
-            failed_devices.append(device)
+    not_block_devices = [device for device in devices
+                         if not is_block_device(device)]
+    inventory = {}
+    if len(not_block_devices) < len(devices):
+        inventory = block_device_inventory(
+            [device for device in devices
+             if device not in not_block_devices])
+    mounted_devices = [device for device, info in inventory.items()
+                       if info['mounted']]
+    in_use_devices = [device for device, info in inventory.items()
+                      if info['in-use'] and not info['mounted']]
 
-    if failed_devices or not_block_devices:
-        message = ""
-        if failed_devices:
-            message = "{} devices are mounted: {}".format(
-                len(failed_devices),
-                ", ".join(failed_devices))
+    if mounted_devices or in_use_devices or not_block_devices:
+        messages = []
+        if mounted_devices:
+            messages.append("{} devices are mounted: {}".format(
+                len(mounted_devices),
+                ", ".join(sorted(mounted_devices))))
+        if in_use_devices:
+            messages.append(
+                "{} devices are in use by an OSD or an open device-mapper "
+                "mapping: {}".format(len(in_use_devices),
+                                     ", ".join(sorted(in_use_devices))))
         if not_block_devices:
-            if message is not '':
-                message += "\n\n"
-            message += "{} devices are not block devices: {}".format(
+            messages.append("{} devices are not block devices: {}".format(
                 len(not_block_devices),
-                ", ".join(not_block_devices))
-        hookenv.action_fail(message)
+                ", ".join(not_block_devices)))
+        hookenv.action_fail("\n\n".join(messages))
+        return
+
+    discard = hookenv.action_get('discard')
+    registry = device_registry.registry()
+    timings = {}
+    # devices lsblk did not report cannot be inspected, so are not wiped
+    errors = ['{}: not found by lsblk'.format(device)
+              for device in devices if device not in inventory]
+    pool = ThreadPool(min(ZAP_PARALLEL, len(devices)))
+    try:
+        for device, seconds, error in pool.imap_unordered(
+                _wipe, [(device, inventory[device], discard)
+                        for device in devices if device in inventory]):
+            if error is not None:
+                errors.append('{}: {}'.format(device, error))
+                continue
+            timings[device] = seconds
+            registry.transition(device, device_registry.ZAPPED)
+    finally:
+        pool.close()
+        pool.join()
+    registry.db.flush()
+    charm_agent.invalidate()
+    refresh_nrpe_checks()
+    zapped = [device for device in devices if device in timings]
+    if errors:
+        hookenv.action_fail('Failed to zap {} device(s): {}'.format(
+            len(errors), '; '.join(sorted(errors))))
         return
-    db = kv()
-    used_devices = db.get('osd-devices', [])
-    for device in devices:
-        zap_disk(device)
-        if device in used_devices:
-            used_devices.remove(device)
-    db.set('osd-devices', used_devices)
-    db.flush()
     hookenv.action_set({
         'message': "{} disk(s) have been zapped, to use them as OSDs, run: \n"
                    "juju run-action {} add-disk osd-devices=\"{}\"".format(
-                       len(devices),
+                       len(zapped),
                        hookenv.local_unit(),
-                       " ".join(devices))
+                       " ".join(zapped))
     })
 
 
 if __name__ == "__main__":
+    forget_published_status()
     zap()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Write ceph-osd host metrics in the node-exporter textfile format.
+
+Run periodically from a systemd timer installed by the ceph-osd charm.
+Only procfs, sysfs and the JSON state file maintained by the charm hooks
+are read, so a run neither forks processes nor talks to the monitors.
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+OSD_BASE_DIR = '/var/lib/ceph/osd'
+METRICS_FILE = 'ceph_osd_charm.prom'
+PREFIX = 'ceph_osd_charm'
+
+# Field offsets in /proc/diskstats (after major, minor, name)
+DISKSTATS_FIELDS = [
+    ('reads_completed_total', 0, 1),
+    ('reads_sectors_total', 2, 1),
+    ('read_time_seconds_total', 3, 0.001),
+    ('writes_completed_total', 4, 1),
+    ('writes_sectors_total', 6, 1),
+    ('write_time_seconds_total', 7, 0.001),
+    ('io_in_progress', 8, 1),
+    ('io_time_seconds_total', 9, 0.001),
+]
+
+TUNING_ATTRIBUTES = ['max_sectors_kb', 'read_ahead_kb', 'rotational']
+
+
+class Metrics(object):
+    """Accumulate samples and render them in the textfile format."""
+
+    def __init__(self):
+        self._samples = {}
+        self._help = {}
+
+    def add(self, name, value, help_text, **labels):
+        name = '{}_{}'.format(PREFIX, name)
+        self._help[name] = help_text
+        self._samples.setdefault(name, []).append((labels, value))
+
+    def render(self):
+        lines = []
+        for name in sorted(self._samples):
+            lines.append('# HELP {} {}'.format(name, self._help[name]))
+            lines.append('# TYPE {} {}'.format(
+                name, 'counter' if name.endswith('_total') else 'gauge'))
+            for labels, value in self._samples[name]:
+                label_str = ','.join(
+                    '{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+                if label_str:
+                    lines.append('{}{{{}}} {}'.format(name, label_str, value))
+                else:
+                    lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+def local_osd_ids(osd_base_dir=OSD_BASE_DIR):
+    """OSD ids with a data directory on this host."""
+    osd_ids = []
+    if os.path.isdir(osd_base_dir):
+        for entry in os.listdir(osd_base_dir):
+            match = re.match(r'ceph-(\d+)$', entry)
+            if match:
+                osd_ids.append(match.group(1))
+    return sorted(osd_ids, key=int)
+
+
+def running_osd_ids(proc='/proc'):
+    """OSD ids of the ceph-osd daemons running on this host."""
+    running = set()
+    for pid in os.listdir(proc):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join(proc, pid, 'cmdline'), 'rb') as f:
+                argv = f.read().split(b'\0')
+        except (IOError, OSError):
+            continue
+        if not argv or not argv[0].endswith(b'ceph-osd'):
+            continue
+        for i, arg in enumerate(argv[:-1]):
+            if arg in (b'--id', b'-i'):
+                running.add(argv[i + 1].decode('UTF-8'))
+    return running
+
+
+def read_diskstats(path='/proc/diskstats'):
+    """Map kernel device names to their /proc/diskstats counters."""
+    stats = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 14:
+                continue
+            stats[fields[2]] = [int(v) for v in fields[3:14]]
+    return stats
+
+
+def read_sysfs_int(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def collect_osds(metrics, osd_base_dir=OSD_BASE_DIR, proc='/proc'):
+    running = running_osd_ids(proc)
+    for osd_id in local_osd_ids(osd_base_dir):
+        metrics.add('osd_up', int(osd_id in running),
+                    'Whether the local ceph-osd daemon is running',
+                    osd=osd_id)
+
+
+def collect_devices(metrics, devices, diskstats_path='/proc/diskstats',
+                    sys_block='/sys/block'):
+    diskstats = read_diskstats(diskstats_path)
+    for device in devices:
+        name = os.path.basename(os.path.realpath(device))
+        counters = diskstats.get(name)
+        if counters is None:
+            continue
+        for metric, index, scale in DISKSTATS_FIELDS:
+            metrics.add('device_{}'.format(metric),
+                        round(counters[index] * scale, 3),
+                        'Block device statistic from /proc/diskstats',
+                        device=device)
+        for attribute in TUNING_ATTRIBUTES:
+            value = read_sysfs_int(
+                os.path.join(sys_block, name, 'queue', attribute))
+            if value is not None:
+                metrics.add('device_queue_{}'.format(attribute), value,
+                            'Applied block device queue setting',
+                            device=device)
+
+
+def collect_state(metrics, state):
+    for device in state.get('osd_devices', []):
+        metrics.add('device_processed', 1,
+                    'Device initialised as an OSD by the charm',
+                    device=device)
+    for device in state.get('blacklist', []):
+        metrics.add('device_blacklisted', 1,
+                    'Device in the unit-local blacklist', device=device)
+    for hook, info in sorted(state.get('hooks', {}).items()):
+        metrics.add('hook_duration_seconds', info['duration'],
+                    'Duration of the last execution of the hook', hook=hook)
+        metrics.add('hook_last_run_timestamp_seconds', info['timestamp'],
+                    'Time of the last execution of the hook', hook=hook)
+
+
+def write_atomic(path, content):
+    """Write content to path such that readers never see a partial file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--state-file', required=True,
+                        help='JSON state file maintained by the charm')
+    parser.add_argument('--textfile-dir', required=True,
+                        help='node-exporter textfile collector directory')
+    args = parser.parse_args(args)
+
+    try:
+        with open(args.state_file) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        state = {}
+
+    start = time.time()
+    metrics = Metrics()
+    collect_osds(metrics)
+    collect_devices(metrics, state.get('osd_devices', []) +
+                    state.get('journal_devices', []))
+    collect_state(metrics, state)
+    metrics.add('collector_duration_seconds',
+                round(time.time() - start, 6),
+                'Time taken to collect these metrics')
+    write_atomic(os.path.join(args.textfile_dir, METRICS_FILE),
+                 metrics.render())
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
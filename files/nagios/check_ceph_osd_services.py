@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2018 Canonical
+# All Rights Reserved
+
+"""
+Check the systemd state of local ceph-osd daemons.
+
+The state of every local ceph-osd@ unit is fetched with a single
+'systemctl show' invocation and cached for a short period, so that the
+per-OSD checks registered by the charm share one query per interval.
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+OSD_BASE_DIR = '/var/lib/ceph/osd'
+CACHE_FILE = '/var/lib/nagios/ceph-osd-services.json'
+
+OK, WARNING, CRITICAL, UNKNOWN = range(4)
+
+
+def local_osd_ids(osd_base_dir=OSD_BASE_DIR):
+    osd_ids = []
+    if os.path.isdir(osd_base_dir):
+        for entry in os.listdir(osd_base_dir):
+            match = re.match(r'ceph-(\d+)$', entry)
+            if match:
+                osd_ids.append(match.group(1))
+    return sorted(osd_ids, key=int)
+
+
+def query_units(osd_ids):
+    """Return {osd_id: {property: value}} from one 'systemctl show' call."""
+    units = ['ceph-osd@{}.service'.format(osd_id) for osd_id in osd_ids]
+    output = subprocess.check_output(
+        ['systemctl', 'show', '--property=Id,ActiveState,SubState'] +
+        units).decode('UTF-8')
+    states = {}
+    for block in output.strip().split('\n\n'):
+        props = dict(line.split('=', 1)
+                     for line in block.splitlines() if '=' in line)
+        match = re.match(r'ceph-osd@(\d+)\.service$', props.get('Id', ''))
+        if match:
+            states[match.group(1)] = props
+    return states
+
+
+def write_cache(path, states):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.' + os.path.basename(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'timestamp': time.time(), 'units': states}, f)
+    os.rename(tmp_path, path)
+
+
+def get_states(cache_file, max_age, osd_base_dir=OSD_BASE_DIR):
+    osd_ids = local_osd_ids(osd_base_dir)
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if (time.time() - cached['timestamp'] <= max_age and
+                set(cached['units']) == set(osd_ids)):
+            return cached['units']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    states = query_units(osd_ids) if osd_ids else {}
+    try:
+        write_cache(cache_file, states)
+    except (IOError, OSError):
+        # The cache is an optimisation only
+        pass
+    return states
+
+
+def check(osd_ids, states):
+    """Return a (nagios status, message) tuple for the requested OSDs."""
+    failed = []
+    for osd_id in osd_ids:
+        props = states.get(osd_id)
+        if props is None:
+            return UNKNOWN, 'UNKNOWN: osd.{} is not a local OSD'.format(
+                osd_id)
+        if props.get('ActiveState') != 'active':
+            failed.append('osd.{} {}/{}'.format(osd_id,
+                                                props.get('ActiveState'),
+                                                props.get('SubState')))
+    if failed:
+        return CRITICAL, 'CRITICAL: {}'.format(', '.join(failed))
+    return OK, 'OK: {} running'.format(
+        ', '.join('osd.{}'.format(i) for i in osd_ids) or 'no OSDs')
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('osd_ids', nargs='*',
+                        help='OSD ids to check (default: all local OSDs)')
+    parser.add_argument('--cache-file', default=CACHE_FILE)
+    parser.add_argument('--max-age', type=int, default=60,
+                        help='Seconds for which a query result is reused')
+    args = parser.parse_args(args)
+    try:
+        states = get_states(args.cache_file, args.max_age)
+    except (subprocess.CalledProcessError, OSError) as e:
+        print('UNKNOWN: unable to query systemd: {}'.format(e))
+        return UNKNOWN
+    status, message = check(args.osd_ids or sorted(states, key=int), states)
+    print(message)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
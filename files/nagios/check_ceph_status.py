@@ -4,53 +4,158 @@
 # All Rights Reserved
 # Author: Jacek Nykis <jacek.nykis@canonical.com>
 
-import re
 import argparse
+import json
 import subprocess
+import time
+
 import nagios_plugin
 
+CHECKS = ['health', 'osds', 'pgs', 'nearfull']
 
-def check_ceph_status(args):
-    if args.status_file:
-        nagios_plugin.check_file_freshness(args.status_file, 3600)
+
+def load_status(args):
+    """Return the status snapshot written by collect_ceph_status.sh.
+
+    Without a status file the cluster is queried directly, which opens a
+    monitor session for every invocation of the check.
+    """
+    if not args.status_file:
+        status = json.loads(subprocess
+                            .check_output(["ceph", "status",
+                                           "--format=json"])
+                            .decode('UTF-8'))
+        osd_df = json.loads(subprocess
+                            .check_output(["ceph", "osd", "df",
+                                           "--format=json"])
+                            .decode('UTF-8'))
+        return {'timestamp': time.time(), 'status': status,
+                'osd_df': osd_df}
+
+    try:
         with open(args.status_file, "rt", encoding='UTF-8') as f:
-            lines = f.readlines()
-    else:
-        lines = (subprocess
-                 .check_output(["ceph", "status"])
-                 .decode('UTF-8')
-                 .split('\n'))
-    status_data = dict(l.strip().split(' ', 1) for l in lines if len(l) > 1)
-
-    if ('health' not in status_data or
-            'monmap' not in status_data or
-            'osdmap' not in status_data):
+            data = json.load(f)
+    except (IOError, OSError) as e:
+        raise nagios_plugin.UnknownError(
+            'UNKNOWN: unable to read {}: {}'.format(args.status_file, e))
+    except ValueError:
+        raise nagios_plugin.UnknownError(
+            'UNKNOWN: {} is not valid JSON'.format(args.status_file))
+
+    age = time.time() - data.get('timestamp', 0)
+    if age > args.max_age:
+        raise nagios_plugin.UnknownError(
+            'UNKNOWN: status data is {:.0f} seconds old'.format(age))
+    if 'status' not in data:
         raise nagios_plugin.UnknownError('UNKNOWN: status data is incomplete')
+    return data
+
+
+def check_health(data, args):
+    health = data['status'].get('health', {})
+    # Luminous reports 'status' and 'checks', older releases report
+    # 'overall_status' and 'summary'.
+    overall = health.get('status', health.get('overall_status'))
+    if overall is None:
+        raise nagios_plugin.UnknownError('UNKNOWN: health status missing')
+    if overall == 'HEALTH_OK':
+        return 'health OK'
+
+    messages = [c['summary']['message']
+                for c in health.get('checks', {}).values()]
+    messages.extend(s['summary'] for s in health.get('summary', []))
+    msg = 'ceph health status: "{} {}"'.format(overall, '; '.join(messages))
+    if overall == 'HEALTH_WARN':
+        raise nagios_plugin.WarnError('WARNING: ' + msg)
+    raise nagios_plugin.CriticalError('CRITICAL: ' + msg)
 
-    if status_data['health'] != 'HEALTH_OK':
-        msg = 'CRITICAL: ceph health status: "{}'.format(status_data['health'])
-        if (len(status_data['health'].split(' '))) == 1:
-            a = iter(lines)
-            for line in a:
-                if re.search('health', line) is not None:
-                    msg1 = next(a)
-                    msg += " "
-                    msg += msg1.strip()
-                    break
-        msg += '"'
-        raise nagios_plugin.CriticalError(msg)
-
-    osds = re.search("^.*: (\d+) osds: (\d+) up, (\d+) in", status_data['osdmap'])
-    if osds.group(1) > osds.group(2):  # not all OSDs are "up"
-        msg = 'CRITICAL: Some OSDs are not up. Total: {}, up: {}'.format(
-            osds.group(1), osds.group(2))
-        raise nagios_plugin.CriticalError(msg)
-    print("All OK")
+
+def check_osds(data, args):
+    osdmap = data['status'].get('osdmap', {})
+    # Releases prior to Nautilus nest the counters one level deeper.
+    osdmap = osdmap.get('osdmap', osdmap)
+    total = int(osdmap.get('num_osds', 0))
+    up = int(osdmap.get('num_up_osds', 0))
+    in_ = int(osdmap.get('num_in_osds', 0))
+    if not total:
+        raise nagios_plugin.UnknownError('UNKNOWN: no OSDs in osdmap')
+    msg = 'Total: {}, up: {}, in: {}'.format(total, up, in_)
+    if float(up) / total < args.min_up_ratio:
+        raise nagios_plugin.CriticalError(
+            'CRITICAL: Some OSDs are not up. ' + msg)
+    if float(in_) / total < args.min_in_ratio:
+        raise nagios_plugin.WarnError(
+            'WARNING: Some OSDs are not in. ' + msg)
+    return 'OSDs OK ({})'.format(msg)
+
+
+def check_pgs(data, args):
+    pgmap = data['status'].get('pgmap', {})
+    by_state = {s['state_name']: int(s['count'])
+                for s in pgmap.get('pgs_by_state', [])}
+    inactive = sum(count for state, count in by_state.items()
+                   if 'active' not in state.split('+'))
+    unclean = sum(count for state, count in by_state.items()
+                  if state != 'active+clean')
+    states = ', '.join('{} {}'.format(count, state)
+                       for state, count in sorted(by_state.items()))
+    if inactive:
+        raise nagios_plugin.CriticalError(
+            'CRITICAL: {} PGs are not active ({})'.format(inactive, states))
+    if unclean:
+        raise nagios_plugin.WarnError(
+            'WARNING: {} PGs are not active+clean ({})'.format(unclean,
+                                                               states))
+    return 'PGs OK ({} active+clean)'.format(by_state.get('active+clean', 0))
+
+
+def check_nearfull(data, args):
+    nodes = data.get('osd_df', {}).get('nodes', [])
+    crit = sorted(n['name'] for n in nodes
+                  if n.get('utilization', 0) >= args.full_crit)
+    warn = sorted(n['name'] for n in nodes
+                  if args.full_warn <= n.get('utilization', 0) <
+                  args.full_crit)
+    if crit:
+        raise nagios_plugin.CriticalError(
+            'CRITICAL: OSDs above {}% utilization: {}'.format(
+                args.full_crit, ', '.join(crit)))
+    if warn:
+        raise nagios_plugin.WarnError(
+            'WARNING: OSDs above {}% utilization: {}'.format(
+                args.full_warn, ', '.join(warn)))
+    return 'OSD utilization OK'
+
+
+def check_ceph_status(args):
+    data = load_status(args)
+    results = []
+    for check in args.checks:
+        results.append(globals()['check_{}'.format(check)](data, args))
+    print('All OK: {}'.format('; '.join(results)))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Check ceph status')
     parser.add_argument('-f', '--file', dest='status_file',
-                        default=False, help='Optional file with "ceph status" output')
+                        default=False,
+                        help='Optional JSON file written by '
+                             'collect_ceph_status.sh')
+    parser.add_argument('--max-age', type=int, default=3600,
+                        help='Maximum age in seconds of the status file')
+    parser.add_argument('-c', '--check', dest='checks', action='append',
+                        choices=CHECKS,
+                        help='Check to run; may be repeated '
+                             '(default: health and osds)')
+    parser.add_argument('--min-up-ratio', type=float, default=1.0,
+                        help='Minimum ratio of OSDs which must be up')
+    parser.add_argument('--min-in-ratio', type=float, default=1.0,
+                        help='Minimum ratio of OSDs which must be in')
+    parser.add_argument('--full-warn', type=float, default=85.0,
+                        help='OSD utilization percentage to warn at')
+    parser.add_argument('--full-crit', type=float, default=95.0,
+                        help='OSD utilization percentage to go critical at')
     args = parser.parse_args()
+    if not args.checks:
+        args.checks = ['health', 'osds']
     nagios_plugin.try_check(check_ceph_status, args)
@@ -2,6 +2,9 @@
 # Copyright (C) 2014 Canonical
 # All Rights Reserved
 # Author: Jacek Nykis <jacek.nykis@canonical.com>
+#
+# Snapshot cluster state as JSON for check_ceph_status.py; all checks read
+# this one file so that only the collector opens monitor sessions.
 
 LOCK=/var/lock/ceph-status.lock
 lockfile-create -r2 --lock-name $LOCK > /dev/null 2>&1
@@ -14,5 +17,23 @@ DATA_DIR="/var/lib/nagios"
 if [ ! -d $DATA_DIR ]; then
     mkdir -p $DATA_DIR
 fi
+STATUS_FILE=${DATA_DIR}/cat-ceph-status.json
 
-ceph status >${DATA_DIR}/cat-ceph-status.txt
+CEPH_ARGS=""
+if [ -n "$1" ]; then
+    CEPH_ARGS="--id $1"
+fi
+
+TMP_FILE=$(mktemp ${DATA_DIR}/.cat-ceph-status.XXXXXX) || exit 1
+trap "rm -f $LOCK $TMP_FILE > /dev/null 2>&1" exit
+
+set -e
+{
+    printf '{"timestamp": %s, "status": ' "$(date +%s)"
+    ceph $CEPH_ARGS status --format=json
+    printf ', "osd_df": '
+    ceph $CEPH_ARGS osd df --format=json
+    printf '}\n'
+} > $TMP_FILE
+chmod 644 $TMP_FILE
+mv -f $TMP_FILE $STATUS_FILE
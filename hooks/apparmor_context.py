@@ -0,0 +1,31 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from charmhelpers.contrib.openstack.context import (
+    AppArmorContext,
+)
+
+
+class CephOsdAppArmorContext(AppArmorContext):
+    """"Apparmor context for ceph-osd binary"""
+    def __init__(self):
+        super(CephOsdAppArmorContext, self).__init__()
+        self.aa_profile = 'usr.bin.ceph-osd'
+
+    def __call__(self):
+        super(CephOsdAppArmorContext, self).__call__()
+        if not self.ctxt:
+            return self.ctxt
+        self._ctxt.update({'aa_profile': self.aa_profile})
+        return self.ctxt
@@ -22,16 +22,16 @@ import shutil
 import sys
 import socket
 import subprocess
-import netifaces
+import time
 
 sys.path.append('lib')
-import ceph.utils as ceph
 from charmhelpers.core import hookenv
 from charmhelpers.core.hookenv import (
     log,
     DEBUG,
     ERROR,
     INFO,
+    WARNING,
     config,
     relation_ids,
     related_units,
@@ -40,7 +40,6 @@ from charmhelpers.core.hookenv import (
     Hooks,
     UnregisteredHookError,
     service_name,
-    status_get,
     status_set,
     storage_get,
     storage_list,
@@ -64,10 +63,6 @@ from charmhelpers.fetch import (
     filter_installed_packages,
     get_upstream_version,
 )
-from charmhelpers.core.sysctl import create as create_sysctl
-from charmhelpers.contrib.openstack.context import (
-    AppArmorContext,
-)
 from utils import (
     get_host_ip,
     get_networks,
@@ -77,30 +72,60 @@ from utils import (
     get_public_addr,
     get_cluster_addr,
     get_blacklist,
+    filter_blacklisted,
     get_journal_devices,
+    has_aes_instructions,
 )
-from charmhelpers.contrib.openstack.alternatives import install_alternative
-from charmhelpers.contrib.network.ip import (
-    get_ipv6_addr,
-    format_ipv6_addr,
-    get_relation_ip,
-)
-from charmhelpers.contrib.storage.linux.ceph import (
-    CephConfContext)
 from charmhelpers.contrib.storage.linux.utils import (
     is_device_mounted,
     is_block_device,
 )
-from charmhelpers.contrib.charmsupport import nrpe
 from charmhelpers.contrib.hardening.harden import harden
 
 from charmhelpers.core.unitdata import kv
 
-import charmhelpers.contrib.openstack.vaultlocker as vaultlocker
+from ceph import device_registry
+import charm_agent
+import device_health
+import log_buffer
+from lazy_import import LazyModule, lazy_callable
+
+# Modules and helpers which are only needed by some hooks are imported on
+# first use; see "Hook start-up cost" in README.md for the import budget.
+ceph = LazyModule('ceph.utils')
+nrpe = LazyModule('charmhelpers.contrib.charmsupport.nrpe')
+vaultlocker = LazyModule('charmhelpers.contrib.openstack.vaultlocker')
+vault_approle = LazyModule('vault_approle')
+primary_affinity = LazyModule('ceph.primary_affinity')
+weight_ramp = LazyModule('ceph.weight_ramp')
+netifaces = LazyModule('netifaces')
+get_ipv6_addr = lazy_callable('charmhelpers.contrib.network.ip',
+                              'get_ipv6_addr')
+format_ipv6_addr = lazy_callable('charmhelpers.contrib.network.ip',
+                                 'format_ipv6_addr')
+get_relation_ip = lazy_callable('charmhelpers.contrib.network.ip',
+                                'get_relation_ip')
+create_sysctl = lazy_callable('charmhelpers.core.sysctl', 'create')
+install_alternative = lazy_callable(
+    'charmhelpers.contrib.openstack.alternatives', 'install_alternative')
+CephConfContext = lazy_callable(
+    'charmhelpers.contrib.storage.linux.ceph', 'CephConfContext')
+CephOsdAppArmorContext = lazy_callable('apparmor_context',
+                                       'CephOsdAppArmorContext')
 
 hooks = Hooks()
 STORAGE_MOUNT_PATH = '/var/lib/ceph'
 
+NON_PRISTINE_KEY = 'non-pristine-devices'
+NON_PRISTINE_MESSAGE = ('Non-pristine devices detected, consult '
+                        '`list-disks`, `zap-disk` and `blacklist-*` actions.')
+VAULT_REFUSED_KEY = 'vault-refused'
+VAULT_REFUSED_MESSAGE = 'Vault refused the unit credentials'
+
+METRICS_SCRIPT = '/usr/local/bin/charm-ceph-osd-metrics'
+METRICS_UNIT = 'charm-ceph-osd-metrics'
+SYSTEMD_SYSTEM_DIR = '/etc/systemd/system'
+
 
 def check_for_upgrade():
     if not os.path.exists(ceph._upgrade_keyring):
@@ -189,20 +214,6 @@ def copy_profile_into_place():
     return new_install
 
 
-class CephOsdAppArmorContext(AppArmorContext):
-    """"Apparmor context for ceph-osd binary"""
-    def __init__(self):
-        super(CephOsdAppArmorContext, self).__init__()
-        self.aa_profile = 'usr.bin.ceph-osd'
-
-    def __call__(self):
-        super(CephOsdAppArmorContext, self).__call__()
-        if not self.ctxt:
-            return self.ctxt
-        self._ctxt.update({'aa_profile': self.aa_profile})
-        return self.ctxt
-
-
 def use_vaultlocker():
     """Determine whether vaultlocker should be used for OSD encryption
 
@@ -249,6 +260,182 @@ def install_udev_rules():
                            '--reload-rules'])
 
 
+def metrics_state_file():
+    """Path of the JSON state file read by the metrics exporter"""
+    return "/var/lib/charm/{}/metrics-state.json".format(service_name())
+
+
+def install_metrics_exporter():
+    """
+    Install, or remove, the node-exporter textfile metrics exporter
+    and the systemd timer which runs it, based on the current setting
+    of the 'metrics-textfile-dir' configuration option.
+    """
+    if not ceph.systemd():
+        log('Skipping metrics exporter installation as systemd is '
+            'not in use', level=DEBUG)
+        return
+    unit_files = [os.path.join(SYSTEMD_SYSTEM_DIR,
+                               '{}.{}'.format(METRICS_UNIT, suffix))
+                  for suffix in ('service', 'timer')]
+    textfile_dir = config('metrics-textfile-dir')
+    if not textfile_dir:
+        if os.path.exists(unit_files[1]):
+            log('Removing metrics exporter')
+            subprocess.call(['systemctl', 'disable', '--now',
+                             '{}.timer'.format(METRICS_UNIT)])
+            for path in unit_files + [METRICS_SCRIPT]:
+                if os.path.exists(path):
+                    os.unlink(path)
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+        return
+
+    log('Installing metrics exporter writing to {}'.format(textfile_dir))
+    mkdir(textfile_dir)
+    shutil.copy('files/metrics/charm_ceph_osd_metrics.py', METRICS_SCRIPT)
+    os.chmod(METRICS_SCRIPT, 0o755)
+    context = {
+        'script': METRICS_SCRIPT,
+        'state_file': metrics_state_file(),
+        'textfile_dir': textfile_dir,
+        'interval': config('metrics-interval'),
+    }
+    for path in unit_files:
+        write_file(path, render_template(os.path.basename(path), context),
+                   perms=0o644)
+    update_metrics_state()
+    subprocess.check_call(['systemctl', 'daemon-reload'])
+    subprocess.check_call(['systemctl', 'enable', '--now',
+                           '{}.timer'.format(METRICS_UNIT)])
+
+
+def install_charm_agent():
+    """
+    Install, or remove, the systemd service running the charm agent
+    based on the current setting of the 'charm-agent' configuration
+    option. The agent runs from the charm directory, so it is restarted
+    to pick up new charm code as well as configuration.
+    """
+    if not ceph.systemd():
+        log('Skipping charm agent installation as systemd is not in use',
+            level=DEBUG)
+        return
+    unit = '{}.service'.format(charm_agent.AGENT_UNIT)
+    unit_file = os.path.join(SYSTEMD_SYSTEM_DIR, unit)
+    if not config('charm-agent'):
+        if os.path.exists(unit_file):
+            log('Removing charm agent')
+            subprocess.call(['systemctl', 'disable', '--now', unit])
+            os.unlink(unit_file)
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+        return
+
+    log('Installing charm agent')
+    context = {
+        'charm_dir': hookenv.charm_dir(),
+        'script': os.path.join(hookenv.charm_dir(), 'hooks',
+                               'charm_agent.py'),
+        'socket': charm_agent.AGENT_SOCKET,
+        'runtime_dir': charm_agent.AGENT_UNIT,
+    }
+    write_file(unit_file, render_template(unit, context), perms=0o644)
+    subprocess.check_call(['systemctl', 'daemon-reload'])
+    subprocess.check_call(['systemctl', 'enable', unit])
+    subprocess.check_call(['systemctl', 'restart', unit])
+
+
+def update_metrics_state(hook=None, duration=None):
+    """Record unit state for the metrics exporter.
+
+    The exporter runs outside of hook context, so the device state
+    held in unitdata and the duration of the most recent execution of
+    each hook are published to a JSON file it can read cheaply.
+
+    :param hook: str. Name of the hook which has just executed
+    :param duration: float. Duration of the hook in seconds
+    """
+    if not config('metrics-textfile-dir'):
+        return
+    path = metrics_state_file()
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        state = {}
+    state['osd_devices'] = sorted(
+        device_registry.registry().paths(device_registry.ACTIVE))
+    state['blacklist'] = sorted(get_blacklist())
+    state['journal_devices'] = sorted(get_journal_devices())
+    if hook:
+        state.setdefault('hooks', {})[hook] = {
+            'duration': round(duration, 3),
+            'timestamp': int(time.time()),
+        }
+    mkdir(os.path.dirname(path))
+    write_file(path, json.dumps(state), perms=0o644)
+
+
+def device_health_dir():
+    """Directory holding the device health history ring buffers"""
+    return "/var/lib/charm/{}/device-health".format(service_name())
+
+
+def get_monitored_devices():
+    """Devices in use by this unit for OSD data, journals, WAL or DB"""
+    devices = device_registry.registry().paths(device_registry.ACTIVE)
+    devices.update(get_journal_devices())
+    for name in ('bluestore-wal', 'bluestore-db', 'osd-cache-devices'):
+        devices.update(ceph.get_devices(name))
+    return sorted(dev for dev in devices if dev.startswith('/dev'))
+
+
+def sample_device_health():
+    """Record a device health sample if the sample interval has elapsed"""
+    interval = config('device-health-interval')
+    if not interval:
+        return
+    db = kv()
+    now = time.time()
+    if now - db.get('device-health-last-sample', 0) < interval:
+        return
+    device_health.record_samples(get_monitored_devices(),
+                                 device_health_dir())
+    db.set('device-health-last-sample', now)
+    db.flush()
+
+
+def optimize_primary_affinity():
+    """Adjust the primary affinity of the local OSDs to their latency if
+    the optimization interval has elapsed"""
+    interval = config('primary-affinity-interval')
+    if not interval or is_unit_paused_set():
+        return
+    db = kv()
+    now = time.time()
+    if now - db.get('primary-affinity-last-run', 0) < interval:
+        return
+    try:
+        primary_affinity.apply_primary_affinity(
+            primary_affinity.plan_local_primary_affinity(
+                'osd-upgrade',
+                step=config('primary-affinity-step'),
+                hysteresis=config('primary-affinity-hysteresis')))
+    except (subprocess.CalledProcessError, ValueError) as e:
+        log('Unable to optimize primary affinity: {}'.format(e),
+            level=WARNING)
+    db.set('primary-affinity-last-run', now)
+    db.flush()
+
+
+def get_device_health_problems():
+    """Devices flagged by the device health history, with reasons"""
+    if not config('device-health-interval'):
+        return {}
+    return device_health.assess_devices(
+        device_health.get_history(get_monitored_devices(),
+                                  device_health_dir()))
+
+
 @hooks.hook('install.real')
 @harden()
 def install():
@@ -258,6 +445,15 @@ def install():
     if config('autotune'):
         tune_network_adapters()
     install_udev_rules()
+    check_aes_instructions()
+
+
+def check_aes_instructions():
+    """Warn when OSDs are to be encrypted on a CPU without AES
+    instructions, which makes dm-crypt a bottleneck for fast devices."""
+    if config('osd-encrypt') and has_aes_instructions() is False:
+        log('CPU lacks AES instructions, encrypted OSDs will be limited '
+            'by software encryption throughput', level=WARNING)
 
 
 def az_info():
@@ -325,7 +521,7 @@ def get_ceph_context(upgrading=False):
         'mon_hosts': ' '.join(mon_hosts),
         'fsid': get_fsid(),
         'old_auth': cmp_pkgrevno('ceph', "0.51") < 0,
-        'crush_initial_weight': config('crush-initial-weight'),
+        'crush_initial_weight': crush_initial_weight(),
         'osd_journal_size': config('osd-journal-size'),
         'osd_max_backfills': config('osd-max-backfills'),
         'osd_recovery_max_active': config('osd-recovery-max-active'),
@@ -409,17 +605,57 @@ def config_changed():
     if sysctl_dict:
         create_sysctl(sysctl_dict, '/etc/sysctl.d/50-ceph-osd-charm.conf')
 
+    if config('device-health-interval'):
+        apt_install(filter_installed_packages(['smartmontools']),
+                    fatal=True)
+
     e_mountpoint = config('ephemeral-unmount')
     if e_mountpoint and ceph.filesystem_mounted(e_mountpoint):
         umount(e_mountpoint)
     prepare_disks_and_activate()
     install_apparmor_profile()
     add_to_updatedb_prunepath(STORAGE_MOUNT_PATH)
+    install_metrics_exporter()
+    install_charm_agent()
+
+
+def check_vault_credentials(context):
+    """Check that Vault accepts the unit's AppRole credentials before
+    devices are encrypted with vaultlocker.
+
+    A refusal blocks the unit until the credentials are accepted, while an
+    unreachable Vault only defers preparation to a later hook.
+
+    :param context: dict. Context of the secrets-storage relation
+    :returns: bool. True if devices can be encrypted
+    """
+    ca = context.get('vault_ca')
+    if ca:
+        ca = base64.b64decode(ca).decode('UTF-8')
+    try:
+        vault_approle.check_credentials(context['vault_url'],
+                                        context['role_id'],
+                                        context['secret_id'],
+                                        ca=ca)
+    except vault_approle.VaultRefused as e:
+        log('Deferring OSD preparation as vault refused the unit '
+            'credentials: {}'.format(e), level=WARNING)
+        status_set('blocked', VAULT_REFUSED_MESSAGE)
+        db = kv()
+        db.set(VAULT_REFUSED_KEY, True)
+        db.flush()
+        return False
+    except vault_approle.VaultError as e:
+        log('Deferring OSD preparation as vault cannot be reached: {}'
+            .format(e), level=WARNING)
+        return False
+    return True
 
 
 @hooks.hook('storage.real')
 def prepare_disks_and_activate():
     # NOTE: vault/vaultlocker preflight check
+    db = kv()
     vault_kv = vaultlocker.VaultKVContext(vaultlocker.VAULTLOCKER_BACKEND)
     context = vault_kv()
     if use_vaultlocker() and not vault_kv.complete:
@@ -436,15 +672,24 @@ def prepare_disks_and_activate():
         raise ValueError('`osd-journal` and `osd-devices` options must not'
                          'overlap.')
     log("got journal devs: {}".format(osd_journal), level=DEBUG)
+    if not ceph.get_devices('osd-cache-devices').isdisjoint(
+            set(get_devices())):
+        raise ValueError('`osd-cache-devices` and `osd-devices` options '
+                         'must not overlap.')
 
     # pre-flight check of eligible device pristinity
     devices = get_devices()
 
     # if a device has been previously touched we need to consider it as
     # non-pristine. If it needs to be re-processed it has to be zapped
-    # via the respective action which also clears the unitdata entry.
-    db = kv()
-    touched_devices = db.get('osd-devices', [])
+    # via the respective action which also resets its registry state.
+    # Devices left preparing by an interrupted hook are not pristine
+    # either, and are resumed by osdize.
+    registry = device_registry.registry()
+    skip_states = device_registry.processed_states(
+        config('ignore-device-errors')) + (device_registry.PREPARING,)
+    touched_devices = set(dev for dev in devices
+                          if registry.state(dev) in skip_states)
     devices = [dev for dev in devices if dev not in touched_devices]
     log('Skipping osd devices previously processed by this unit: {}'
         .format(touched_devices))
@@ -459,26 +704,109 @@ def prepare_disks_and_activate():
                if not ceph.is_active_bluestore_device(dev)]
 
     log('Checking for pristine devices: "{}"'.format(devices), level=DEBUG)
-    if not all(ceph.is_pristine_disk(dev) for dev in devices):
-        status_set('blocked',
-                   'Non-pristine devices detected, consult '
-                   '`list-disks`, `zap-disk` and `blacklist-*` actions.')
+    pristine = {dev: ceph.is_pristine_disk(dev) for dev in devices}
+    for dev, is_pristine in pristine.items():
+        current = registry.state(dev)
+        state = (device_registry.PRISTINE if is_pristine
+                 else device_registry.DISCOVERED)
+        if current != state and current in (None, device_registry.DISCOVERED,
+                                            device_registry.PRISTINE):
+            registry.transition(dev, state)
+    if not all(pristine.values()):
+        status_set('blocked', NON_PRISTINE_MESSAGE)
+        db.set(NON_PRISTINE_KEY, True)
         return
+    db.unset(NON_PRISTINE_KEY)
+    db.unset(VAULT_REFUSED_KEY)
 
     if ceph.is_bootstrapped():
+        # only devices about to be encrypted need Vault
+        if (devices and use_vaultlocker() and
+                not check_vault_credentials(context)):
+            return
         log('ceph bootstrapped, rescanning disks')
         emit_cephconf()
-        for dev in get_devices():
-            ceph.osdize(dev, config('osd-format'),
-                        osd_journal,
-                        config('ignore-device-errors'),
-                        config('osd-encrypt'),
-                        config('bluestore'),
-                        config('osd-encrypt-keymanager'))
-            # Make it fast!
-            if config('autotune'):
+        devices = get_devices()
+        for dev in devices:
+            if not dev.startswith('/dev'):
+                ceph.osdize_dir(dev, config('osd-encrypt'),
+                                config('bluestore'))
+        prepared = list(ceph.osdize_devs(
+            [dev for dev in devices if dev.startswith('/dev')],
+            config('osd-format'),
+            osd_journal,
+            config('ignore-device-errors'),
+            config('osd-encrypt'),
+            config('bluestore'),
+            config('osd-encrypt-keymanager')))
+        # Make it fast!
+        if config('autotune'):
+            for dev in devices:
                 ceph.tune_dev(dev)
-        ceph.start_osds(get_devices())
+        tune_dm_crypt()
+        ceph.start_osds(devices, new_devices=prepared,
+                        start_stopped=not is_unit_paused_set())
+        charm_agent.invalidate()
+
+
+def crush_initial_weight():
+    """CRUSH weight new OSDs join the cluster with.
+
+    OSDs ramped in gradually start at 0, whatever crush-initial-weight
+    says.
+    """
+    if config('osd-weight-ramp-step'):
+        return 0
+    return config('crush-initial-weight')
+
+
+# ceph.weight_ramp.RAMP_KEY
+WEIGHT_RAMP_KEY = 'osd-weight-ramp'
+
+
+def weight_ramp_active():
+    """Whether the weight ramp is enabled or still has OSDs to ramp in.
+
+    Reads the ramp from kv() directly, so that units which do not ramp
+    OSDs in never import ceph.weight_ramp.
+    """
+    return bool(config('osd-weight-ramp-step') or kv().get(WEIGHT_RAMP_KEY))
+
+
+def advance_weight_ramp():
+    """Raise the CRUSH weight of OSDs being ramped in by one step once the
+    cluster has absorbed the previous one.
+
+    Local OSDs which joined the cluster with a weight of 0 are enrolled
+    while the ramp is enabled; OSDs still ramping when it is disabled go to
+    their full weight in one step.
+    """
+    if is_unit_paused_set() or not weight_ramp_active():
+        return
+    try:
+        weight_ramp.advance(
+            'osd-upgrade',
+            step=config('osd-weight-ramp-step') or 1.0,
+            max_misplaced=config('osd-weight-ramp-misplaced-ratio'),
+            enroll_new=bool(config('osd-weight-ramp-step')))
+    except (subprocess.CalledProcessError, ValueError) as e:
+        log('Unable to advance the OSD weight ramp: {}'.format(e),
+            level=WARNING)
+
+
+def tune_dm_crypt():
+    """Bypass the dm-crypt workqueues of encrypted OSD devices if
+    configured to.
+
+    The tuning does not persist across reboots, so it is re-applied by
+    update-status as well as after devices are prepared.
+    """
+    if config('osd-encrypt') and config('osd-encrypt-bypass-workqueues'):
+        try:
+            ceph.tune_dm_crypt_devices()
+        except subprocess.CalledProcessError as e:
+            log('Unable to tune dm-crypt devices: {}'.format(e),
+                level=WARNING)
 
 
 def get_mon_hosts():
@@ -545,8 +873,7 @@ def get_devices():
     devices.extend((storage_get('location', s) for s in storage_ids))
 
     # Filter out any devices in the action managed unit-local device blacklist
-    _blacklist = get_blacklist()
-    return [device for device in devices if device not in _blacklist]
+    return filter_blacklisted(devices)
 
 
 @hooks.hook('mon-relation-changed',
@@ -573,6 +900,9 @@ def upgrade_charm():
                 fatal=True)
     install_udev_rules()
     remap_resolved_targets()
+    # NRPE checks written by earlier releases are not recorded
+    if relation_ids('nrpe-external-master'):
+        update_nrpe_config()
 
 
 def remap_resolved_targets():
@@ -583,38 +913,77 @@ def remap_resolved_targets():
     # should be used in preference to the target path
     # to the block device as in some instances this
     # is not consistent between reboots (bcache).
-    db = kv()
-    touched_devices = db.get('osd-devices', [])
-    osd_devices = get_devices()
-    for dev in osd_devices:
+    # The registry keys devices by identity, so looking the provided path
+    # up indexes it against any record made under the resolved path.
+    registry = device_registry.registry()
+    for dev in get_devices():
         real_path = os.path.realpath(dev)
-        if real_path != dev and real_path in touched_devices:
+        if real_path != dev and registry.lookup(dev):
             log('Device {} already processed by charm using '
-                'actual device path {}, updating block device '
-                'usage with provided device path '
-                'and skipping'.format(dev,
-                                      real_path))
-            touched_devices.remove(real_path)
-            touched_devices.append(dev)
-    db.set('osd-devices', touched_devices)
-    db.flush()
+                'actual device path {}, recording provided device path '
+                'and skipping'.format(dev, real_path))
+    registry.db.flush()
+
+
+NAGIOS_PLUGINS = '/usr/local/lib/nagios/plugins'
+NRPE_OSD_IDS_KEY = 'nrpe-osd-ids'
 
 
 @hooks.hook('nrpe-external-master-relation-joined',
             'nrpe-external-master-relation-changed')
 def update_nrpe_config():
-    # python-dbus is used by check_upstart_job
-    apt_install('python3-dbus')
     hostname = nrpe.get_nagios_hostname()
     current_unit = nrpe.get_nagios_unit_name()
     nrpe_setup = nrpe.NRPE(hostname=hostname)
-    nrpe_setup.add_check(
-        shortname='ceph-osd',
-        description='process check {%s}' % current_unit,
-        check_cmd=('/bin/cat /var/lib/ceph/osd/ceph-*/whoami |'
-                   'xargs -I@ status ceph-osd id=@ && exit 0 || exit 2')
-    )
+    db = kv()
+    osd_ids = sorted(ceph.get_local_osd_ids(), key=int)
+    # NOTE: single check for all OSDs registered by previous charm releases
+    nrpe_setup.remove_check(shortname='ceph-osd')
+    for osd_id in db.get(NRPE_OSD_IDS_KEY, []):
+        if osd_id not in osd_ids:
+            nrpe_setup.remove_check(shortname='ceph-osd-{}'.format(osd_id))
+
+    if ceph.systemd():
+        mkdir(NAGIOS_PLUGINS)
+        shutil.copy('files/nagios/check_ceph_osd_services.py',
+                    NAGIOS_PLUGINS)
+        check_cmd = 'check_ceph_osd_services.py {}'
+    else:
+        # python-dbus is used by check_upstart_job
+        apt_install('python3-dbus')
+        check_cmd = 'check_upstart_job ceph-osd id={}'
+    for osd_id in osd_ids:
+        nrpe_setup.add_check(
+            shortname='ceph-osd-{}'.format(osd_id),
+            description='osd.{} process check {{{}}}'.format(osd_id,
+                                                             current_unit),
+            check_cmd=check_cmd.format(osd_id)
+        )
     nrpe_setup.write()
+    db.set(NRPE_OSD_IDS_KEY, osd_ids)
+    db.flush()
+
+
+@hooks.hook('nrpe-external-master-relation-broken')
+def nrpe_relation_broken():
+    db = kv()
+    db.unset(NRPE_OSD_IDS_KEY)
+    db.flush()
+
+
+def refresh_nrpe_checks():
+    """Update NRPE checks if the set of local OSDs has changed.
+
+    The OSDs are only listed on units which wrote NRPE checks, as recorded
+    by update_nrpe_config(), which saves every hook a relation-ids call.
+    """
+    checked = kv().get(NRPE_OSD_IDS_KEY)
+    if checked is None:
+        return
+    osd_ids = sorted(ceph.get_local_osd_ids(), key=int)
+    if osd_ids != checked:
+        log('Local OSDs changed to {}, updating NRPE checks'.format(osd_ids))
+        update_nrpe_config()
 
 
 @hooks.hook('secrets-storage-relation-joined')
@@ -638,59 +1007,150 @@ def secrets_storage_changed():
 
 
 VERSION_PACKAGE = 'ceph-common'
+DPKG_STATUS = '/var/lib/dpkg/status'
+STATUS_FACTS_KEY = 'status-facts'
+STATUS_SET_KEY = 'status-set'
 
 
-def assess_status():
-    """Assess status of current unit"""
-    # check to see if the unit is paused.
-    application_version_set(get_upstream_version(VERSION_PACKAGE))
-    if is_unit_paused_set():
-        status_set('maintenance',
-                   "Paused. Use 'resume' action to resume normal service.")
-        return
-    # Check for mon relation
+def _dpkg_status_mtime():
+    try:
+        return os.path.getmtime(DPKG_STATUS)
+    except OSError:
+        return None
+
+
+def _relation_status():
+    """Status implied by the mon and secrets-storage relations.
+
+    :returns: (workload, message) tuple or None if the relations are ready
+    """
     if len(relation_ids('mon')) < 1:
-        status_set('blocked', 'Missing relation: monitor')
-        return
+        return ('blocked', 'Missing relation: monitor')
 
     # Check for monitors with presented addresses
     # Check for bootstrap key presentation
     monitors = get_mon_hosts()
     if len(monitors) < 1 or not get_conf('osd_bootstrap_key'):
-        status_set('waiting', 'Incomplete relation: monitor')
-        return
+        return ('waiting', 'Incomplete relation: monitor')
 
     # Check for vault
     if use_vaultlocker():
         if not relation_ids('secrets-storage'):
-            status_set('blocked', 'Missing relation: vault')
-            return
+            return ('blocked', 'Missing relation: vault')
         if not vaultlocker.vault_relation_complete():
-            status_set('waiting', 'Incomplete relation: vault')
-            return
+            return ('waiting', 'Incomplete relation: vault')
+    return None
+
+
+def get_status_facts():
+    """Return the cached facts which assess_status() is computed from.
+
+    Relation data and charm config only change in the hook which delivers
+    the change, so their outcome is re-evaluated by every hook except
+    update-status, which reuses the cached result. The workload version is
+    cached against the modification time of the dpkg status database.
+
+    :returns: dict with 'relations' and 'version' keys
+    """
+    db = kv()
+    facts = db.get(STATUS_FACTS_KEY) or {}
+    if hookenv.hook_name() != 'update-status' or 'relations' not in facts:
+        facts['relations'] = _relation_status()
+    dpkg_mtime = _dpkg_status_mtime()
+    if (dpkg_mtime is None or 'version' not in facts or
+            facts.get('dpkg-mtime') != dpkg_mtime):
+        facts['version'] = get_upstream_version(VERSION_PACKAGE)
+        facts['dpkg-mtime'] = dpkg_mtime
+    db.set(STATUS_FACTS_KEY, facts)
+    return facts
+
+
+def _set_status(workload, message, version):
+    """Publish the workload status and version if they changed.
+
+    Other hooks may set intermediate states along the way, so the status is
+    always published outside of update-status.
+    """
+    db = kv()
+    published = db.get(STATUS_SET_KEY) or {}
+    always = hookenv.hook_name() != 'update-status'
+    if always or published.get('version') != version:
+        application_version_set(version)
+    if always or published.get('status') != [workload, message]:
+        status_set(workload, message)
+    db.set(STATUS_SET_KEY, {'status': [workload, message],
+                            'version': version})
+    db.flush()
+
+
+def forget_published_status():
+    """Forget the status last published by assess_status().
+
+    Hooks and actions may set a status of their own, e.g. 'maintenance'
+    while devices are prepared, and stop before assess_status() runs, so
+    the record is dropped when they start and the next update-status
+    publishes its status whatever the record said.
+    """
+    db = kv()
+    db.unset(STATUS_SET_KEY)
+    db.flush()
 
-    # Check for OSD device creation parity i.e. at least some devices
-    # must have been presented and used for this charm to be operational
-    (prev_status, prev_message) = status_get()
-    running_osds = ceph.get_running_osds()
-    if not prev_message.startswith('Non-pristine'):
+
+def assess_status():
+    """Assess status of current unit"""
+    facts = get_status_facts()
+    # check to see if the unit is paused.
+    if is_unit_paused_set():
+        workload, message = (
+            'maintenance',
+            "Paused. Use 'resume' action to resume normal service.")
+    elif facts['relations']:
+        workload, message = facts['relations']
+    elif kv().get(VAULT_REFUSED_KEY):
+        workload, message = ('blocked', VAULT_REFUSED_MESSAGE)
+    elif kv().get(NON_PRISTINE_KEY):
+        workload, message = ('blocked', NON_PRISTINE_MESSAGE)
+    else:
+        # Check for OSD device creation parity i.e. at least some devices
+        # must have been presented and used for this charm to be
+        # operational
+        running_osds = ceph.get_running_osds()
         if not running_osds:
-            status_set('blocked',
-                       'No block devices detected using current configuration')
+            workload, message = (
+                'blocked',
+                'No block devices detected using current configuration')
         else:
-            status_set('active',
-                       'Unit is ready ({} OSD)'.format(len(running_osds)))
+            workload = 'active'
+            message = 'Unit is ready ({} OSD)'.format(len(running_osds))
+            ramp = weight_ramp_active() and weight_ramp.progress(kv())
+            if ramp:
+                message += ', ramping in {} OSD ({}%)'.format(*ramp)
+            problems = get_device_health_problems()
+            if problems:
+                message += ', unhealthy devices: {}'.format(
+                    ', '.join(sorted(problems)))
+    _set_status(workload, message, facts['version'])
 
 
 @hooks.hook('update-status')
 @harden()
 def update_status():
     log('Updating status.')
+    sample_device_health()
+    tune_dm_crypt()
+    optimize_primary_affinity()
+    advance_weight_ramp()
 
 
 if __name__ == '__main__':
+    start = time.time()
+    log_buffer.install(config('charm-log-level'))
+    if hookenv.hook_name() != 'update-status':
+        forget_published_status()
     try:
         hooks.execute(sys.argv)
     except UnregisteredHookError as e:
         log('Unknown hook {} - skipping.'.format(e))
+    refresh_nrpe_checks()
     assess_status()
+    update_metrics_state(hookenv.hook_name(), time.time() - start)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Optional long running agent serving the disk inventory to hooks.
+
+Classifying the disks of a unit (unmounted, in use by bluestore, holding
+foreign data) enumerates udev and forks LVM tools for every disk, each time
+a hook or action asks. When the charm-agent option is set, a systemd
+service started from this file keeps the inventory in memory, discards it
+only when udev reports a block device event or a hook reports a change,
+and answers queries over a unix socket.
+
+Clients use inventory(), which falls back to scanning locally when the
+agent is not running, so the agent is never required for correctness.
+"""
+
+import argparse
+import json
+import logging
+import os
+import select
+import socket
+import sys
+import time
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+for _path in (_HERE, os.path.join(os.path.dirname(_HERE), 'lib')):
+    if _path not in sys.path:
+        sys.path.append(_path)
+
+AGENT_UNIT = 'charm-ceph-osd-agent'
+AGENT_SOCKET = '/run/{}/agent.sock'.format(AGENT_UNIT)
+
+# Requests and replies are single lines of JSON
+MAX_MESSAGE_BYTES = 1024 * 1024
+
+# Seconds a connected client may take to send its request
+CLIENT_TIMEOUT = 5
+
+
+class AgentUnavailable(Exception):
+    pass
+
+
+def _read_line(sock):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+        if len(data) > MAX_MESSAGE_BYTES:
+            raise ValueError('Message exceeds {} bytes'
+                             .format(MAX_MESSAGE_BYTES))
+    return data
+
+
+def call(method, timeout=60, socket_path=AGENT_SOCKET, **params):
+    """Invoke a method of the agent.
+
+    :param method: str. Name of the agent method
+    :param timeout: float. Seconds to wait for the reply
+    :param socket_path: str. Path of the agent's socket
+    :returns: The result of the method
+    :raises: AgentUnavailable if the agent is not running or the call fails
+    """
+    if not os.path.exists(socket_path):
+        raise AgentUnavailable('{} does not exist'.format(socket_path))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps({'method': method,
+                                 'params': params}).encode('UTF-8') + b'\n')
+        reply = json.loads(_read_line(sock).decode('UTF-8'))
+    except (socket.error, socket.timeout, ValueError) as e:
+        raise AgentUnavailable('{} failed: {}'.format(method, e))
+    finally:
+        sock.close()
+    if 'error' in reply:
+        raise AgentUnavailable('{} failed: {}'.format(method, reply['error']))
+    return reply['result']
+
+
+def scan_inventory():
+    """Classify the unmounted disks of this host.
+
+    :returns: dict. 'disks' lists the unmounted disks and 'non-pristine'
+              those of them which hold data but are not active bluestore
+              devices
+    """
+    import ceph.utils
+
+    disks = sorted(ceph.utils.unmounted_disks())
+    non_pristine = [dev for dev in disks
+                    if not ceph.utils.is_active_bluestore_device(dev) and
+                    not ceph.utils.is_pristine_disk(dev)]
+    return {
+        'disks': disks,
+        'non-pristine': non_pristine,
+        'timestamp': time.time(),
+    }
+
+
+def inventory(socket_path=AGENT_SOCKET):
+    """Return the disk inventory of this host.
+
+    :returns: dict. As returned by scan_inventory(), from the agent if it
+              is running and scanned locally otherwise
+    """
+    try:
+        return call('inventory', socket_path=socket_path)
+    except AgentUnavailable:
+        return scan_inventory()
+
+
+def invalidate(socket_path=AGENT_SOCKET):
+    """Tell a running agent that the disks of this host have changed.
+
+    Mounting an OSD does not raise a udev event, so hooks and actions
+    which prepare, activate or zap devices call this once they are done.
+    """
+    try:
+        call('invalidate', timeout=CLIENT_TIMEOUT, socket_path=socket_path)
+    except AgentUnavailable:
+        pass
+
+
+class Agent(object):
+    """Unix socket server answering inventory queries from memory.
+
+    :param socket_path: str. Path to listen on
+    :param monitor: pyudev.Monitor for block devices, or None
+    """
+
+    def __init__(self, socket_path=AGENT_SOCKET, monitor=None):
+        self.socket_path = socket_path
+        self.monitor = monitor
+        self.started = time.time()
+        self.running = False
+        self._inventory = None
+        self.methods = {
+            'ping': self.ping,
+            'inventory': self.inventory,
+            'invalidate': self.invalidate,
+        }
+
+    def ping(self):
+        return {'pid': os.getpid(), 'uptime': time.time() - self.started}
+
+    def inventory(self):
+        if self._inventory is None:
+            self._inventory = scan_inventory()
+        return self._inventory
+
+    def invalidate(self):
+        self._inventory = None
+        return True
+
+    def handle(self, request):
+        """Dispatch a decoded request and return the reply."""
+        try:
+            method = self.methods[request['method']]
+        except (KeyError, TypeError):
+            return {'error': 'Unknown method'}
+        try:
+            return {'result': method(**request.get('params') or {})}
+        except Exception as e:
+            logging.exception('%s failed', request['method'])
+            return {'error': str(e)}
+
+    def _serve_connection(self, conn):
+        conn.settimeout(CLIENT_TIMEOUT)
+        try:
+            try:
+                request = json.loads(_read_line(conn).decode('UTF-8'))
+            except ValueError as e:
+                reply = {'error': 'Invalid request: {}'.format(e)}
+            else:
+                reply = self.handle(request)
+            conn.sendall(json.dumps(reply).encode('UTF-8') + b'\n')
+        except (socket.error, socket.timeout) as e:
+            logging.warning('Dropped client: %s', e)
+        finally:
+            conn.close()
+
+    def _udev_events(self):
+        # drain every pending event; one refresh covers them all
+        while self.monitor.poll(timeout=0) is not None:
+            pass
+        logging.debug('Block device event, discarding inventory')
+        self.invalidate()
+
+    def _listen(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            server.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+        return server
+
+    def serve_forever(self, poll_interval=1.0):
+        """Answer requests until stop() is called."""
+        server = self._listen()
+        readers = [server]
+        if self.monitor is not None:
+            self.monitor.start()
+            readers.append(self.monitor)
+        self.running = True
+        try:
+            while self.running:
+                ready, _, _ = select.select(readers, [], [], poll_interval)
+                if self.monitor is not None and self.monitor in ready:
+                    self._udev_events()
+                if server in ready:
+                    conn, _ = server.accept()
+                    self._serve_connection(conn)
+        finally:
+            server.close()
+            os.unlink(self.socket_path)
+
+    def stop(self):
+        self.running = False
+
+
+def _block_monitor():
+    try:
+        import pyudev
+    except ImportError:
+        logging.warning('pyudev unavailable, not watching udev events')
+        return None
+    monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+    monitor.filter_by('block')
+    return monitor
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--socket', default=AGENT_SOCKET,
+                        help='path of the unix socket to listen on')
+    options = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(levelname)s %(message)s')
+    from charmhelpers.core import hookenv
+    import log_buffer
+    # There is no juju-log outside of hook context; use the journal
+    hookenv.set_log_handler(
+        lambda message, level: logging.log(
+            log_buffer.LEVELS.get(level or log_buffer.DEFAULT_LEVEL,
+                                  logging.INFO), message))
+
+    agent = Agent(options.socket, _block_monitor())
+    # warm the inventory before the first hook asks for it
+    agent.handle({'method': 'inventory'})
+    agent.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
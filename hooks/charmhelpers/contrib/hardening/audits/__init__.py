@@ -12,6 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
+
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+)
+
+FINGERPRINTS_KEY = 'hardening:audit-fingerprints'
+
 
 class BaseAudit(object):  # NO-QA
     """Base class for hardening checks.
@@ -52,3 +63,55 @@ class BaseAudit(object):  # NO-QA
             return not self.unless()
 
         return not self.unless
+
+    def fingerprint(self):
+        """Returns a value which changes whenever the outcome of this audit
+        may change.
+
+        Audits with an unchanged fingerprint since they last ran are skipped
+        by run_audits(). The default of None means that the audit cannot be
+        fingerprinted and always runs.
+        """
+        return None
+
+
+def _digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True,
+                                     default=str).encode('UTF-8')).hexdigest()
+
+
+def run_audits(audits, settings=None):
+    """Ensure compliance of each audit, skipping unchanged audits.
+
+    After each audit has run its fingerprint is recorded together with the
+    stack settings. Audits whose fingerprint and settings are unchanged since
+    then are not run again.
+
+    :param audits: list of BaseAudit objects.
+    :param settings: stack settings the audits were generated from.
+    """
+    kv = unitdata.kv()
+    fingerprints = kv.get(FINGERPRINTS_KEY) or {}
+    settings_digest = _digest(settings)
+    for audit in audits:
+        name = audit.__class__.__name__
+        paths = getattr(audit, 'paths', None)
+        audit_id = _digest([name, sorted(paths) if paths else paths])
+        fingerprint = audit.fingerprint()
+        if (fingerprint is not None and fingerprints.get(audit_id) ==
+                _digest([settings_digest, fingerprint])):
+            log("Skipping unchanged '%s' check" % (name), level=DEBUG)
+            continue
+
+        log("Running '%s' check" % (name), level=DEBUG)
+        audit.ensure_compliance()
+        # Compliance may have changed the audited resources, so record the
+        # fingerprint of their state after the audit.
+        fingerprint = audit.fingerprint()
+        if fingerprint is None:
+            fingerprints.pop(audit_id, None)
+        else:
+            fingerprints[audit_id] = _digest([settings_digest, fingerprint])
+
+    kv.set(FINGERPRINTS_KEY, fingerprints)
+    kv.flush()
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 from __future__ import absolute_import  # required for external apt import
+import os
+
 from apt import apt_pkg
 from six import string_types
 
@@ -27,6 +29,19 @@ from charmhelpers.core.hookenv import (
 )
 from charmhelpers.contrib.hardening.audits import BaseAudit
 
+DPKG_STATUS = '/var/lib/dpkg/status'
+APT_CONF_PATHS = ['/etc/apt/apt.conf', '/etc/apt/apt.conf.d']
+
+
+def _mtimes(paths):
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
 
 class AptConfig(BaseAudit):
 
@@ -45,6 +60,9 @@ class AptConfig(BaseAudit):
     def ensure_compliance(self):
         self.verify_config()
 
+    def fingerprint(self):
+        return [self.config, _mtimes(APT_CONF_PATHS)]
+
 
 class RestrictedPackages(BaseAudit):
     """Class used to audit restricted packages on the system."""
@@ -56,6 +74,11 @@ class RestrictedPackages(BaseAudit):
         else:
             self.pkgs = pkgs
 
+    def fingerprint(self):
+        if self.unless is not None:
+            return None
+        return [sorted(self.pkgs), _mtimes([DPKG_STATUS])]
+
     def ensure_compliance(self):
         cache = apt_cache()
 
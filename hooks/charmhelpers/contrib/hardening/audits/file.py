@@ -46,6 +46,26 @@ from charmhelpers.contrib.hardening.templating import (
 from charmhelpers.contrib.hardening import utils
 
 
+def _is_plain(value):
+    if value is None or isinstance(value, (bool, int, float) + string_types):
+        return True
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return all(_is_plain(v) for v in value)
+    if isinstance(value, dict):
+        return all(_is_plain(k) and _is_plain(v) for k, v in value.items())
+    return False
+
+
+def _stat_fingerprint(path):
+    """Ownership, mode, size and change times of path, or None."""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    return [st.st_mode, st.st_uid, st.st_gid, st.st_size, st.st_mtime,
+            st.st_ctime]
+
+
 class BaseFileAudit(BaseAudit):
     """Base class for file audits.
 
@@ -101,6 +121,27 @@ class BaseFileAudit(BaseAudit):
         """
         raise NotImplementedError
 
+    def fingerprint(self):
+        """Fingerprint of the audit settings and audited paths.
+
+        Audits which inspect the contents of directory trees, or which hold
+        settings that cannot be serialised such as template contexts and
+        callbacks, are not fingerprinted.
+        """
+        if getattr(self, 'recursive', False):
+            return None
+
+        settings = {}
+        for key, value in vars(self).items():
+            if not _is_plain(value):
+                return None
+            if isinstance(value, (set, frozenset)):
+                value = sorted(value)
+            settings[key] = value
+
+        return [self.__class__.__name__, settings,
+                [_stat_fingerprint(p) for p in sorted(self.paths)]]
+
     @classmethod
     def _get_stat(cls, path):
         """Returns the Posix st_stat information for the specified file path.
@@ -237,6 +278,8 @@ class DirectoryPermissionAudit(FilePermissionAudit):
 
 class ReadOnly(BaseFileAudit):
     """Audits that files and folders are read only."""
+    recursive = True
+
     def __init__(self, paths, *args, **kwargs):
         super(ReadOnly, self).__init__(paths=paths, *args, **kwargs)
 
@@ -273,6 +316,8 @@ class NoReadWriteForOther(BaseFileAudit):
     """Ensures that the files found under the base path are readable or
     writable by anyone other than the owner or the group.
     """
+    recursive = True
+
     def __init__(self, paths):
         super(NoReadWriteForOther, self).__init__(paths)
 
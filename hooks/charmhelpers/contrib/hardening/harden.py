@@ -22,10 +22,21 @@ from charmhelpers.core.hookenv import (
     DEBUG,
     WARNING,
 )
-from charmhelpers.contrib.hardening.host.checks import run_os_checks
-from charmhelpers.contrib.hardening.ssh.checks import run_ssh_checks
-from charmhelpers.contrib.hardening.mysql.checks import run_mysql_checks
-from charmhelpers.contrib.hardening.apache.checks import run_apache_checks
+
+
+def _run_catalog():
+    # The hardening stacks are imported only once hardening is enabled, as
+    # they are expensive to import and every decorated hook would otherwise
+    # pay for them.
+    from charmhelpers.contrib.hardening.host.checks import run_os_checks
+    from charmhelpers.contrib.hardening.ssh.checks import run_ssh_checks
+    from charmhelpers.contrib.hardening.mysql.checks import run_mysql_checks
+    from charmhelpers.contrib.hardening.apache.checks import (
+        run_apache_checks)
+    return OrderedDict([('os', run_os_checks),
+                        ('ssh', run_ssh_checks),
+                        ('mysql', run_mysql_checks),
+                        ('apache', run_apache_checks)])
 
 
 def harden(overrides=None):
@@ -48,16 +59,11 @@ def harden(overrides=None):
     :returns: Returns value returned by decorated function once executed.
     """
     def _harden_inner1(f):
-        log("Hardening function '%s'" % (f.__name__), level=DEBUG)
-
         def _harden_inner2(*args, **kwargs):
-            RUN_CATALOG = OrderedDict([('os', run_os_checks),
-                                       ('ssh', run_ssh_checks),
-                                       ('mysql', run_mysql_checks),
-                                       ('apache', run_apache_checks)])
-
             enabled = overrides or (config("harden") or "").split()
             if enabled:
+                log("Hardening function '%s'" % (f.__name__), level=DEBUG)
+                RUN_CATALOG = _run_catalog()
                 modules_to_run = []
                 # modules will always be performed in the following order
                 for module, func in six.iteritems(RUN_CATALOG):
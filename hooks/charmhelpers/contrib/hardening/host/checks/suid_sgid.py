@@ -13,9 +13,12 @@
 # limitations under the License.
 
 import subprocess
+import time
 
+from charmhelpers.core import unitdata
 from charmhelpers.core.hookenv import (
     log,
+    DEBUG,
     INFO,
 )
 from charmhelpers.contrib.hardening.audits.file import NoSUIDSGIDAudit
@@ -109,21 +112,55 @@ def get_audits():
         # suid/sgid bits then find all of the paths which have the suid/sgid
         # bit set and then remove the whitelisted paths.
         root_path = settings['environment']['root_path']
-        unknown_paths = find_paths_with_suid_sgid(root_path) - set(whitelist)
+        unknown_paths = find_paths_with_suid_sgid(
+            root_path,
+            skip_paths=settings['security']['suid_sgid_scan_skip_paths'],
+            interval=settings['security']['suid_sgid_scan_interval'])
+        unknown_paths -= set(whitelist)
         checks.append(NoSUIDSGIDAudit(unknown_paths, unless=dry_run))
 
     return checks
 
 
-def find_paths_with_suid_sgid(root_path):
+SCAN_KEY = 'hardening:suid-sgid-scan'
+
+
+def find_paths_with_suid_sgid(root_path, skip_paths=None, interval=0):
     """Finds all paths/files which have an suid/sgid bit enabled.
 
     Starting with the root_path, this will recursively find all paths which
-    have an suid or sgid bit set.
+    have an suid or sgid bit set, without descending into skip_paths. As
+    the walk is expensive its result is stored and reused until interval
+    seconds have passed or the walk parameters change.
+
+    :param root_path: path to start the walk from.
+    :param skip_paths: list of paths not to descend into.
+    :param interval: seconds for which a previous walk is reused.
+    :returns: set of paths.
     """
-    cmd = ['find', root_path, '-perm', '-4000', '-o', '-perm', '-2000',
-           '-type', 'f', '!', '-path', '/proc/*', '-print']
+    skip_paths = sorted(skip_paths or [])
+    kv = unitdata.kv()
+    previous = kv.get(SCAN_KEY)
+    if (interval and previous and
+            previous['root_path'] == root_path and
+            previous['skip_paths'] == skip_paths and
+            time.time() - previous['timestamp'] < interval):
+        log("Reusing suid/sgid scan of %s from %d" %
+            (root_path, previous['timestamp']), level=DEBUG)
+        return set(previous['paths'])
+
+    cmd = ['find', root_path]
+    for path in skip_paths:
+        cmd.extend(['-path', path, '-prune', '-o'])
+    cmd.extend(['-type', 'f', '(', '-perm', '-4000', '-o', '-perm', '-2000',
+                ')', '-print'])
 
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     out, _ = p.communicate()
-    return set(out.split('\n'))
+    paths = set(path for path in out.decode('UTF-8').split('\n') if path)
+    kv.set(SCAN_KEY, {'root_path': root_path,
+                      'skip_paths': skip_paths,
+                      'timestamp': time.time(),
+                      'paths': sorted(paths)})
+    kv.flush()
+    return paths
@@ -16,14 +16,14 @@ from charmhelpers.core.hookenv import (
     log,
     DEBUG,
 )
+from charmhelpers.contrib.hardening.audits import run_audits
+from charmhelpers.contrib.hardening.utils import get_settings
 from charmhelpers.contrib.hardening.mysql.checks import config
 
 
 def run_mysql_checks():
     log("Starting MySQL hardening checks.", level=DEBUG)
     checks = config.get_audits()
-    for check in checks:
-        log("Running '%s' check" % (check.__class__.__name__), level=DEBUG)
-        check.ensure_compliance()
+    run_audits(checks, get_settings('mysql'))
 
     log("MySQL hardening checks complete.", level=DEBUG)
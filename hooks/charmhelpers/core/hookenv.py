@@ -91,13 +91,29 @@ def flush(key):
         del cache[item]
 
 
+_log_handler = None
+
+
+def set_log_handler(handler):
+    """Route log() messages through handler instead of juju-log.
+
+    :param handler: callable taking (message, level), or None to restore
+                    calling juju-log for every message
+    """
+    global _log_handler
+    _log_handler = handler
+
+
 def log(message, level=None):
     """Write a message to the juju log"""
+    if not isinstance(message, six.string_types):
+        message = repr(message)
+    if _log_handler is not None:
+        _log_handler(message, level)
+        return
     command = ['juju-log']
     if level:
         command += ['-l', level]
-    if not isinstance(message, six.string_types):
-        message = repr(message)
     command += [message]
     # Missing juju-log should not cause failures in unit tests
     # Send log output to stderr
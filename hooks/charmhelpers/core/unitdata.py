@@ -158,6 +158,17 @@ import sys
 
 __author__ = 'Kapil Thangavelu <kapil.foss@gmail.com>'
 
+# INSERT ... ON CONFLICT DO UPDATE is only understood by SQLite >= 3.24
+_HAVE_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+# Lowest limit on bound parameters per statement across SQLite releases
+_MAX_VARIABLES = 999
+
+# Number of most recent hook executions whose history compact() keeps, and
+# how often (in hook executions) hook_scope() compacts the history.
+REVISION_RETENTION = 100
+COMPACT_INTERVAL = 50
+
 
 class Storage(object):
     """Simple key value database for local unit state within charms.
@@ -170,6 +181,11 @@ class Storage(object):
     Note: to facilitate unit testing, ':memory:' can be passed as the
     path parameter which causes sqlite3 to only build the db in memory.
     This should only be used for testing purposes.
+
+    On disk databases use a write-ahead log with synchronous=NORMAL, so a
+    commit costs an append to the log rather than a journal rewrite and
+    fsync. A committed transaction survives the hook process crashing but
+    may be lost if the machine loses power before the next checkpoint.
     """
     def __init__(self, path=None):
         self.db_path = path
@@ -186,6 +202,8 @@ class Storage(object):
         self.cursor = self.conn.cursor()
         self.revision = None
         self._closed = False
+        if self.db_path != ':memory:':
+            self._tune()
         self._init()
 
     def close(self):
@@ -234,8 +252,28 @@ class Storage(object):
         :param str prefix: Optional prefix to apply to all keys in `mapping`
             before setting
         """
-        for k, v in mapping.items():
-            self.set("%s%s" % (prefix, k), v)
+        items = [("%s%s" % (prefix, k), json.dumps(v))
+                 for k, v in mapping.items()]
+        keys = [k for k, _ in items]
+        current = {}
+        for i in range(0, len(keys), _MAX_VARIABLES):
+            chunk = keys[i:i + _MAX_VARIABLES]
+            self.cursor.execute(
+                'select key, data from kv where key in (%s)' %
+                ','.join(['?'] * len(chunk)), chunk)
+            current.update(self.cursor.fetchall())
+
+        # Skip mutations to the same value
+        changed = [(k, data) for k, data in items if current.get(k) != data]
+        if not changed:
+            return
+        self.cursor.executemany(
+            'insert or replace into kv (key, data) values (?, ?)', changed)
+        if self.revision:
+            self.cursor.executemany(
+                '''insert or replace into kv_revisions (
+                revision, key, data) values (?, ?, ?)''',
+                [(self.revision, k, data) for k, data in changed])
 
     def unset(self, key):
         """
@@ -280,46 +318,32 @@ class Storage(object):
         """
         serialized = json.dumps(value)
 
-        self.cursor.execute('select data from kv where key=?', [key])
-        exists = self.cursor.fetchone()
-
         # Skip mutations to the same value
-        if exists:
-            if exists[0] == serialized:
+        if _HAVE_UPSERT:
+            self.cursor.execute('''
+            insert into kv (key, data) values (?, ?)
+            on conflict (key) do update
+            set data = excluded.data
+            where data != excluded.data''', (key, serialized))
+            if not self.cursor.rowcount:
+                return value
+        else:
+            self.cursor.execute('select data from kv where key=?', [key])
+            exists = self.cursor.fetchone()
+            if exists and exists[0] == serialized:
                 return value
-
-        if not exists:
             self.cursor.execute(
-                'insert into kv (key, data) values (?, ?)',
+                'insert or replace into kv (key, data) values (?, ?)',
                 (key, serialized))
-        else:
-            self.cursor.execute('''
-            update kv
-            set data = ?
-            where key = ?''', [serialized, key])
 
         # Save
         if not self.revision:
             return value
 
         self.cursor.execute(
-            'select 1 from kv_revisions where key=? and revision=?',
-            [key, self.revision])
-        exists = self.cursor.fetchone()
-
-        if not exists:
-            self.cursor.execute(
-                '''insert into kv_revisions (
-                revision, key, data) values (?, ?, ?)''',
-                (self.revision, key, serialized))
-        else:
-            self.cursor.execute(
-                '''
-                update kv_revisions
-                set data = ?
-                where key = ?
-                and   revision = ?''',
-                [serialized, key, self.revision])
+            '''insert or replace into kv_revisions (
+            revision, key, data) values (?, ?, ?)''',
+            (self.revision, key, serialized))
 
         return value
 
@@ -362,6 +386,8 @@ class Storage(object):
             (name or sys.argv[0],
              datetime.datetime.utcnow().isoformat()))
         self.revision = self.cursor.lastrowid
+        if self.revision % COMPACT_INTERVAL == 0:
+            self.compact(REVISION_RETENTION)
         try:
             yield self.revision
             self.revision = None
@@ -380,6 +406,37 @@ class Storage(object):
         else:
             self.conn.rollback()
 
+    def compact(self, retention=REVISION_RETENTION):
+        """
+        Discard the history of all but the most recent hook executions.
+
+        kv_revisions and hooks otherwise grow with every hook execution.
+        Current values in kv are not affected.
+
+        :param int retention: Number of most recent hook executions whose
+            history is kept
+        :return int: Number of revisions removed
+        """
+        self.cursor.execute('select max(version) from hooks')
+        latest = self.cursor.fetchone()[0]
+        if latest is None:
+            return 0
+        oldest = latest - retention + 1
+        self.cursor.execute('delete from kv_revisions where revision < ?',
+                            [oldest])
+        removed = self.cursor.rowcount
+        self.cursor.execute('delete from hooks where version < ?', [oldest])
+        return removed
+
+    def _tune(self):
+        try:
+            self.cursor.execute('pragma journal_mode=wal')
+            self.cursor.execute('pragma synchronous=normal')
+        except sqlite3.OperationalError:
+            # e.g. file systems without shared memory support; the
+            # default rollback journal still works there
+            pass
+
     def _init(self):
         self.cursor.execute('''
             create table if not exists kv (
@@ -0,0 +1,273 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Device health telemetry for OSD, journal, WAL and DB devices.
+
+Latency counters from /sys/class/block/<dev>/stat and SMART or NVMe health data
+from smartctl are sampled periodically and kept in a fixed size ring
+buffer file per device, so that trends such as growing reallocated sector
+counts or rising I/O latency can be detected without unbounded storage.
+"""
+
+import collections
+import os
+import re
+import struct
+import subprocess
+import time
+
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    WARNING,
+)
+
+SYS_BLOCK = '/sys/class/block'
+
+HISTORY_SIZE = 288
+
+# Flag a device whose average I/O latency over the last sample interval is
+# above AWAIT_MIN_MS and AWAIT_MEDIAN_FACTOR times the median of the other
+# monitored devices.
+AWAIT_MIN_MS = 50.0
+AWAIT_MEDIAN_FACTOR = 4.0
+
+Sample = collections.namedtuple('Sample', [
+    'timestamp',
+    'reads',
+    'read_ticks',
+    'writes',
+    'write_ticks',
+    'smart_ok',
+    'reallocated',
+    'pending',
+    'media_errors',
+])
+
+# SMART counters which are unknown for a device are stored as -1
+UNKNOWN = -1
+
+
+class RingBuffer(object):
+    """Fixed capacity on-disk history of samples for a single device.
+
+    The file holds a small header followed by `capacity` fixed size
+    records; once full the oldest record is overwritten.
+    """
+
+    MAGIC = b'CDH1'
+    HEADER = struct.Struct('<4sII')
+    RECORD = struct.Struct('<IQQQQbiii')
+
+    def __init__(self, path, capacity=HISTORY_SIZE):
+        self.path = path
+        self.capacity = capacity
+
+    def _read_header(self, f):
+        data = f.read(self.HEADER.size)
+        if len(data) != self.HEADER.size:
+            return None
+        magic, capacity, count = self.HEADER.unpack(data)
+        if magic != self.MAGIC or capacity != self.capacity:
+            return None
+        return count
+
+    def append(self, sample):
+        """Append a sample, overwriting the oldest one if full."""
+        if not os.path.exists(self.path):
+            with open(self.path, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, self.capacity, 0))
+        with open(self.path, 'r+b') as f:
+            count = self._read_header(f)
+            if count is None:
+                log('Discarding unreadable device history {}'
+                    .format(self.path), level=WARNING)
+                f.truncate(0)
+                count = 0
+            f.seek(self.HEADER.size +
+                   (count % self.capacity) * self.RECORD.size)
+            f.write(self.RECORD.pack(*sample))
+            f.seek(0)
+            f.write(self.HEADER.pack(self.MAGIC, self.capacity, count + 1))
+
+    def samples(self):
+        """Return the stored samples, oldest first."""
+        try:
+            with open(self.path, 'rb') as f:
+                count = self._read_header(f)
+                if not count:
+                    return []
+                data = f.read(self.capacity * self.RECORD.size)
+        except (IOError, OSError):
+            return []
+        stored = min(count, self.capacity)
+        records = [Sample(*self.RECORD.unpack_from(data,
+                                                   i * self.RECORD.size))
+                   for i in range(stored)]
+        start = count % self.capacity if count > self.capacity else 0
+        return records[start:] + records[:start]
+
+
+def device_name(device):
+    """Kernel name of a device path, e.g. /dev/disk/by-id/x -> sdb."""
+    return os.path.basename(os.path.realpath(device))
+
+
+def read_block_stat(name, sys_block=SYS_BLOCK):
+    """Return (reads, read_ticks, writes, write_ticks) for a block device.
+
+    :returns: tuple or None if the device has no stat file
+    """
+    try:
+        with open(os.path.join(sys_block, name, 'stat')) as f:
+            fields = [int(v) for v in f.read().split()]
+    except (IOError, OSError, ValueError):
+        return None
+    return fields[0], fields[3], fields[4], fields[7]
+
+
+def _smartctl(device):
+    try:
+        return subprocess.check_output(
+            ['smartctl', '-H', '-A', device],
+            stderr=subprocess.STDOUT).decode('UTF-8')
+    except subprocess.CalledProcessError as e:
+        # smartctl encodes disk problems in its exit status bitmask
+        # while still printing the data we need.
+        return e.output.decode('UTF-8')
+    except OSError:
+        return ''
+
+
+def parse_smartctl(output):
+    """Extract health indicators from 'smartctl -H -A' output.
+
+    Handles both the ATA attribute table and the NVMe health log.
+
+    :returns: dict with smart_ok, reallocated, pending and media_errors
+    """
+    health = {
+        'smart_ok': UNKNOWN,
+        'reallocated': UNKNOWN,
+        'pending': UNKNOWN,
+        'media_errors': UNKNOWN,
+    }
+    match = re.search(r'(?:overall-health self-assessment test result|'
+                      r'SMART Health Status):\s*(\S+)', output)
+    if match:
+        health['smart_ok'] = int(match.group(1) in ('PASSED', 'OK'))
+
+    for line in output.splitlines():
+        fields = line.split()
+        # ATA: ID# ATTRIBUTE_NAME FLAG VALUE WORST THRESH TYPE UPDATED
+        #      WHEN_FAILED RAW_VALUE
+        if len(fields) >= 10 and fields[0].isdigit():
+            raw = re.match(r'\d+', fields[9])
+            if not raw:
+                continue
+            if fields[1] == 'Reallocated_Sector_Ct':
+                health['reallocated'] = int(raw.group(0))
+            elif fields[1] == 'Current_Pending_Sector':
+                health['pending'] = int(raw.group(0))
+        elif line.startswith('Media and Data Integrity Errors:'):
+            health['media_errors'] = int(fields[-1].replace(',', ''))
+        elif line.startswith('Critical Warning:'):
+            if int(fields[-1], 16):
+                health['smart_ok'] = 0
+    return health
+
+
+def sample_device(device, sys_block=SYS_BLOCK, smartctl=_smartctl):
+    """Take a health sample for device.
+
+    :returns: Sample or None if the device does not exist
+    """
+    stat = read_block_stat(device_name(device), sys_block)
+    if stat is None:
+        return None
+    health = parse_smartctl(smartctl(device))
+    return Sample(int(time.time()), stat[0], stat[1], stat[2], stat[3],
+                  health['smart_ok'], health['reallocated'],
+                  health['pending'], health['media_errors'])
+
+
+def _history(device, health_dir):
+    return RingBuffer(os.path.join(health_dir,
+                                   '{}.ring'.format(device_name(device))))
+
+
+def record_samples(devices, health_dir, sys_block=SYS_BLOCK,
+                   smartctl=_smartctl):
+    """Sample every device and append the result to its history."""
+    if not os.path.isdir(health_dir):
+        os.makedirs(health_dir)
+    for device in sorted(set(devices)):
+        sample = sample_device(device, sys_block, smartctl)
+        if sample is None:
+            log('Unable to sample health of {}'.format(device), level=DEBUG)
+            continue
+        _history(device, health_dir).append(sample)
+
+
+def get_history(devices, health_dir):
+    """Return stored samples for each device, keyed by device path."""
+    return {device: _history(device, health_dir).samples()
+            for device in sorted(set(devices))}
+
+
+def _await_ms(older, newer):
+    ios = (newer.reads - older.reads) + (newer.writes - older.writes)
+    if ios <= 0:
+        return 0.0
+    ticks = ((newer.read_ticks - older.read_ticks) +
+             (newer.write_ticks - older.write_ticks))
+    return float(ticks) / ios
+
+
+def _grew(history, field):
+    values = [getattr(s, field) for s in history
+              if getattr(s, field) != UNKNOWN]
+    return len(values) > 1 and values[-1] > values[0]
+
+
+def assess_devices(history):
+    """Identify devices with degraded health.
+
+    :param history: dict. Samples keyed by device, from get_history()
+    :returns: dict. List of reasons keyed by each unhealthy device
+    """
+    awaits = {device: _await_ms(samples[-2], samples[-1])
+              for device, samples in history.items() if len(samples) > 1}
+
+    def peer_median(device):
+        peers = sorted(v for d, v in awaits.items() if d != device)
+        return peers[len(peers) // 2] if peers else 0.0
+
+    problems = {}
+    for device, samples in history.items():
+        if not samples:
+            continue
+        reasons = []
+        if samples[-1].smart_ok == 0:
+            reasons.append('SMART health check failed')
+        for field in ('reallocated', 'pending', 'media_errors'):
+            if _grew(samples, field):
+                reasons.append('{} growing'.format(field.replace('_', ' ')))
+        await_ms = awaits.get(device, 0.0)
+        if (await_ms > AWAIT_MIN_MS and
+                await_ms > AWAIT_MEDIAN_FACTOR * peer_median(device)):
+            reasons.append('await {:.0f}ms'.format(await_ms))
+        if reasons:
+            problems[device] = reasons
+    return problems
@@ -0,0 +1,62 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deferred imports for the hook entry point.
+
+Every hook executes ceph_hooks.py, so anything it imports at module level
+is paid for by every hook invocation, including the frequent update-status
+hook. Modules only needed by some handlers are bound through these helpers
+and imported the first time they are actually used.
+"""
+
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Module proxy which imports the real module on first attribute use.
+
+    Attribute assignment and deletion are forwarded to the real module so
+    that mock.patch against the proxy behaves as it would for the module.
+    """
+
+    def __init__(self, name):
+        super(LazyModule, self).__init__(name)
+
+    def _load(self):
+        return importlib.import_module(self.__name__)
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        if attr in ('__name__', '__doc__'):
+            return super(LazyModule, self).__setattr__(attr, value)
+        setattr(self._load(), attr, value)
+
+    def __delattr__(self, attr):
+        delattr(self._load(), attr)
+
+
+def lazy_callable(module, name):
+    """Return a callable deferring the import of module until first call.
+
+    :param module: str. Name of the module which defines the callable
+    :param name: str. Name of the function or class within the module
+    :returns: callable with the same call signature as module.name
+    """
+    def _call(*args, **kwargs):
+        return getattr(importlib.import_module(module), name)(*args, **kwargs)
+    _call.__name__ = name
+    return _call
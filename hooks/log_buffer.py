@@ -0,0 +1,143 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Buffered juju-log backend.
+
+hookenv.log() forks a juju-log process for every message, which adds up
+quickly in storage hooks that log per device and per partition. The
+BufferedJujuLog handler collects messages in memory and hands them to
+juju-log in batches, one process per run of messages at the same level.
+"""
+
+from __future__ import print_function
+
+import atexit
+import errno
+import logging
+import subprocess
+import sys
+
+from charmhelpers.core import hookenv
+
+# juju-log levels mapped onto the standard logging levels
+LEVELS = {
+    hookenv.TRACE: 5,
+    hookenv.DEBUG: logging.DEBUG,
+    hookenv.INFO: logging.INFO,
+    hookenv.WARNING: logging.WARNING,
+    hookenv.ERROR: logging.ERROR,
+    hookenv.CRITICAL: logging.CRITICAL,
+}
+
+# juju-log logs at INFO when no level is given
+DEFAULT_LEVEL = hookenv.INFO
+
+# Flush once this many bytes are buffered; keeps each juju-log argument
+# well below the kernel's per-argument limit of 128KiB.
+MAX_BUFFER_BYTES = 32 * 1024
+
+
+def _juju_level(levelno):
+    """Map a logging level number onto the closest juju-log level."""
+    for name, value in sorted(LEVELS.items(), key=lambda item: -item[1]):
+        if levelno >= value:
+            return name
+    return hookenv.TRACE
+
+
+class BufferedJujuLog(logging.Handler):
+    """Collect log messages in memory and write them to juju-log in batches.
+
+    Messages are flushed when MAX_BUFFER_BYTES is reached, when flush() is
+    called (registered with atexit by install()) and immediately for ERROR
+    and CRITICAL messages. Messages below the handler's level are dropped
+    without spawning any process.
+    """
+
+    def __init__(self, level=hookenv.DEBUG, max_bytes=MAX_BUFFER_BYTES):
+        logging.Handler.__init__(self, LEVELS.get(level, logging.DEBUG))
+        self.max_bytes = max_bytes
+        self.buffer = []
+        self.buffered_bytes = 0
+
+    def log(self, message, level=None):
+        """hookenv.log() compatible entry point."""
+        level = level or DEFAULT_LEVEL
+        levelno = LEVELS.get(level, logging.INFO)
+        if levelno < self.level:
+            return
+        self.acquire()
+        try:
+            self.buffer.append((level, message))
+            self.buffered_bytes += len(message)
+            if (levelno >= logging.ERROR or
+                    self.buffered_bytes >= self.max_bytes):
+                self._flush()
+        finally:
+            self.release()
+
+    def emit(self, record):
+        try:
+            message = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self.log(message, _juju_level(record.levelno))
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        logging.Handler.close(self)
+
+    def _flush(self):
+        batch = []
+        for level, message in self.buffer:
+            if batch and batch[0][0] != level:
+                self._write(batch[0][0], [m for _, m in batch])
+                batch = []
+            batch.append((level, message))
+        if batch:
+            self._write(batch[0][0], [m for _, m in batch])
+        self.buffer = []
+        self.buffered_bytes = 0
+
+    def _write(self, level, messages):
+        message = '\n'.join(messages)
+        try:
+            subprocess.call(['juju-log', '-l', level, message])
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Missing juju-log should not cause failures in unit tests
+            for line in messages:
+                print('juju-log: {}: {}'.format(level, line),
+                      file=sys.stderr)
+
+
+def install(level=hookenv.DEBUG):
+    """Route hookenv.log() through a BufferedJujuLog for this process.
+
+    :param level: str. Minimum juju-log level to record
+    :returns: BufferedJujuLog. The installed handler
+    """
+    handler = BufferedJujuLog(level)
+    hookenv.set_log_handler(handler.log)
+    atexit.register(handler.flush)
+    return handler
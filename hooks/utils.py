@@ -38,30 +38,45 @@ from charmhelpers.core.host import (
     CompareHostReleases,
 )
 
-from charmhelpers.contrib.network.ip import (
-    get_address_in_network,
-    get_ipv6_addr
-)
+from ceph import device_registry
+from lazy_import import lazy_callable
+
+# The network helpers import netifaces and netaddr, which most hook
+# invocations never need.
+get_address_in_network = lazy_callable('charmhelpers.contrib.network.ip',
+                                       'get_address_in_network')
+get_ipv6_addr = lazy_callable('charmhelpers.contrib.network.ip',
+                              'get_ipv6_addr')
 
 
 TEMPLATES_DIR = 'templates'
 
-try:
-    import jinja2
-except ImportError:
-    apt_install(filter_installed_packages(['python3-jinja2']),
-                fatal=True)
-    import jinja2
 
-try:
-    import dns.resolver
-except ImportError:
-    apt_install(filter_installed_packages(['python3-dnspython']),
-                fatal=True)
-    import dns.resolver
+# jinja2 and dnspython are imported when first needed rather than at module
+# level, as most hook invocations (update-status in particular) never use
+# them.
+def _import_jinja2():
+    try:
+        import jinja2
+    except ImportError:
+        apt_install(filter_installed_packages(['python3-jinja2']),
+                    fatal=True)
+        import jinja2
+    return jinja2
+
+
+def _import_dns_resolver():
+    try:
+        import dns.resolver
+    except ImportError:
+        apt_install(filter_installed_packages(['python3-dnspython']),
+                    fatal=True)
+        import dns.resolver
+    return dns.resolver
 
 
 def render_template(template_name, context, template_dir=TEMPLATES_DIR):
+    jinja2 = _import_jinja2()
     templates = jinja2.Environment(
         loader=jinja2.FileSystemLoader(template_dir))
     template = templates.get_template(template_name)
@@ -98,7 +113,7 @@ def get_host_ip(hostname=None):
     except socket.error:
         # This may throw an NXDOMAIN exception; in which case
         # things are badly broken so just let it kill the hook
-        answers = dns.resolver.query(hostname, 'A')
+        answers = _import_dns_resolver().query(hostname, 'A')
         if answers:
             return answers[0].address
 
@@ -215,9 +230,19 @@ def is_unit_paused_set():
 
 
 def get_blacklist():
-    """Get blacklist stored in the local kv() store"""
-    db = unitdata.kv()
-    return db.get('osd-blacklist', [])
+    """Get the paths of blacklisted devices from the device registry"""
+    return device_registry.registry().paths(device_registry.BLACKLISTED)
+
+
+def filter_blacklisted(devices):
+    """Drop blacklisted devices, matched by identity, from devices.
+
+    :param devices: iterable. Device paths
+    :returns: list. The devices which are not blacklisted, in order
+    """
+    devices = list(devices)
+    blacklisted = device_registry.registry().blacklisted(devices)
+    return [device for device in devices if device not in blacklisted]
 
 
 def get_journal_devices():
@@ -229,6 +254,27 @@ def get_journal_devices():
     devices.extend((storage_get('location', s) for s in storage_ids))
 
     # Filter out any devices in the action managed unit-local device blacklist
-    _blacklist = get_blacklist()
-    return set(device for device in devices
-               if device not in _blacklist and os.path.exists(device))
+    return set(device for device in filter_blacklisted(devices)
+               if os.path.exists(device))
+
+
+def has_aes_instructions(cpuinfo='/proc/cpuinfo'):
+    """Determine whether the CPU has AES instructions (AES-NI on x86,
+    the crypto extensions on arm64).
+
+    :param cpuinfo: str. Path to read CPU information from
+    :returns: bool, or None if the CPU features could not be read
+    """
+    try:
+        with open(cpuinfo) as f:
+            lines = f.readlines()
+    except (IOError, OSError):
+        return None
+    found = None
+    for line in lines:
+        key, _, value = line.partition(':')
+        if key.strip() in ('flags', 'Features'):
+            if 'aes' in value.split():
+                return True
+            found = False
+    return found
@@ -0,0 +1,148 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Vault AppRole credential check for the vaultlocker preflight.
+
+Before devices are encrypted, the charm checks that Vault accepts the
+AppRole credentials vaultlocker is configured with, so that a revoked or
+expired secret_id blocks the unit before any device is touched instead of
+failing preparation device by device.
+
+Only the acceptance of the credentials matters, the token the login
+returns is never used, so a successful check is recorded in unitdata and
+trusted for CHECK_INTERVAL, or the lease of the token if longer, however
+short-lived the tokens Vault issues. New credentials are always checked.
+
+Requests are made with the standard library rather than hvac, which is
+only needed by vaultlocker itself.
+"""
+
+import hashlib
+import json
+import ssl
+import time
+
+from charmhelpers.core.unitdata import kv
+
+CHECK_KEY = 'vault-approle-check'
+
+# Seconds for which credentials Vault accepted are trusted without logging
+# in again
+CHECK_INTERVAL = 3600
+
+# Seconds to wait for Vault to answer a request
+REQUEST_TIMEOUT = 10
+
+
+class VaultError(Exception):
+    pass
+
+
+class VaultRefused(VaultError):
+    """Vault answered, but refused the request."""
+    pass
+
+
+def _request(url, path, data=None, ca=None, timeout=REQUEST_TIMEOUT):
+    """POST to the Vault HTTP API.
+
+    :param url: str. Base URL of the Vault server
+    :param path: str. API path, e.g. '/v1/auth/approle/login'
+    :param data: dict. Request body
+    :param ca: str. PEM encoded CA certificate to verify Vault against,
+               instead of the system CAs
+    :returns: dict. Decoded response body
+    :raises: VaultRefused if Vault refuses the request, VaultError if it
+             cannot be reached or fails to answer it
+    """
+    from urllib.error import HTTPError, URLError
+    from urllib.request import Request, urlopen
+
+    request = Request(url.rstrip('/') + path,
+                      data=json.dumps(data or {}).encode('UTF-8'),
+                      headers={'Content-Type': 'application/json'})
+    try:
+        context = ssl.create_default_context(cadata=ca) if ca else None
+        response = urlopen(request, timeout=timeout, context=context)
+        try:
+            return json.loads(response.read().decode('UTF-8') or '{}')
+        finally:
+            response.close()
+    except HTTPError as e:
+        try:
+            errors = json.loads(e.read().decode('UTF-8')).get('errors')
+        except ValueError:
+            errors = None
+        message = '{} returned {}: {}'.format(
+            path, e.code, '; '.join(errors or []) or e.reason)
+        if 400 <= e.code < 500:
+            raise VaultRefused(message)
+        raise VaultError(message)
+    except (URLError, OSError, ValueError, ssl.SSLError) as e:
+        raise VaultError('{} failed: {}'.format(path, e))
+
+
+def approle_login(url, role_id, secret_id, ca=None):
+    """Log in to Vault with AppRole credentials.
+
+    :param ca: str. PEM encoded CA certificate of Vault
+    :returns: dict. The 'auth' section of the response, holding
+              'client_token' and 'lease_duration'
+    :raises: VaultRefused if Vault refuses the credentials, VaultError if
+             the login fails otherwise
+    """
+    response = _request(url, '/v1/auth/approle/login',
+                        {'role_id': role_id, 'secret_id': secret_id}, ca)
+    if not (response.get('auth') or {}).get('client_token'):
+        raise VaultError('Login returned no token')
+    return response['auth']
+
+
+def _digest(*values):
+    return hashlib.sha256(
+        '\0'.join(values).encode('UTF-8')).hexdigest()
+
+
+def check_credentials(url, role_id, secret_id, ca=None, db=None, now=None):
+    """Check that Vault accepts AppRole credentials.
+
+    Credentials accepted by an earlier call are not checked again until
+    CHECK_INTERVAL, or the lease of the token the login returned if
+    longer, has passed.
+
+    :param url: str. Base URL of the Vault server
+    :param role_id: str. AppRole role_id
+    :param secret_id: str. AppRole secret_id
+    :param ca: str. PEM encoded CA certificate of Vault
+    :param db: unitdata.Storage to record the check in, defaults to kv()
+    :param now: float. Current time, for testing
+    :raises: VaultRefused if there is no secret_id or Vault refuses the
+             credentials, VaultError if Vault cannot be reached
+    """
+    if not secret_id:
+        raise VaultRefused('No secret_id retrieved from Vault')
+    db = db or kv()
+    now = time.time() if now is None else now
+    credentials = _digest(url, role_id, secret_id)
+    checked = db.get(CHECK_KEY)
+    if (checked and checked['credentials'] == credentials and
+            now < checked['until']):
+        return
+    auth = approle_login(url, role_id, secret_id, ca)
+    lease = auth.get('lease_duration') or 0
+    db.set(CHECK_KEY, {
+        'credentials': credentials,
+        'until': now + max(lease, CHECK_INTERVAL),
+    })
+    db.flush()
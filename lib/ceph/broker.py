@@ -15,6 +15,7 @@
 import collections
 import json
 import os
+import re
 
 from tempfile import NamedTemporaryFile
 
@@ -24,6 +25,7 @@ from ceph.utils import (
 )
 from ceph.crush_utils import Crushmap
 
+from charmhelpers.core.host import cmp_pkgrevno
 from charmhelpers.core.hookenv import (
     log,
     DEBUG,
@@ -34,6 +36,7 @@ from charmhelpers.contrib.storage.linux.ceph import (
     create_erasure_profile,
     delete_pool,
     erasure_profile_exists,
+    get_erasure_profile,
     get_osds,
     monitor_key_get,
     monitor_key_set,
@@ -359,6 +362,88 @@ def get_group_key(group_name):
     return 'cephx.groups.{}'.format(group_name)
 
 
+def _validate_device_class(device_class):
+    """Check a device-class requested for a pool.
+
+    :returns: str. Error message, or None if the class may be used
+    """
+    if not re.match(r'^[A-Za-z0-9_.-]+$', str(device_class)):
+        return "Invalid device-class '{}'".format(device_class)
+    if cmp_pkgrevno('ceph', '12.0.0') < 0:
+        return 'device-class requires Ceph Luminous or later'
+    return None
+
+
+def _crush_rules(service):
+    """Names of the CRUSH rules in the cluster."""
+    return json.loads(check_output(
+        ['ceph', '--id', service, 'osd', 'crush', 'rule', 'ls',
+         '--format=json']).decode('UTF-8'))
+
+
+def device_class_rule(service, device_class, erasure_profile=None):
+    """Return the CRUSH rule placing data on OSDs of device_class.
+
+    Replicated rules place each replica on a different host under the
+    default root. Erasure rules are built from a copy of the erasure
+    profile restricted to the class. A rule left by an earlier request is
+    reused.
+
+    :param service: The ceph client to run the command under.
+    :param device_class: str. CRUSH device class, e.g. 'ssd'
+    :param erasure_profile: str. Erasure profile for an erasure rule
+    :returns: str. Name of the rule
+    :raises: CalledProcessError if creating the rule fails
+    """
+    if erasure_profile is None:
+        rule_name = 'replicated_{}'.format(device_class)
+    else:
+        rule_name = '{}_{}'.format(erasure_profile, device_class)
+    if rule_name in _crush_rules(service):
+        return rule_name
+
+    if erasure_profile is None:
+        log("Creating crush rule '{}'".format(rule_name), level=INFO)
+        check_call(['ceph', '--id', service, 'osd', 'crush', 'rule',
+                    'create-replicated', rule_name, 'default', 'host',
+                    device_class])
+        return rule_name
+
+    profile = get_erasure_profile(service=service, name=erasure_profile)
+    if not profile:
+        raise ValueError('erasure-profile {} does not exist'
+                         .format(erasure_profile))
+    profile['crush-device-class'] = device_class
+    log("Creating erasure profile and crush rule '{}'".format(rule_name),
+        level=INFO)
+    check_call(['ceph', '--id', service, 'osd', 'erasure-code-profile',
+                'set', rule_name] +
+               ['{}={}'.format(k, v) for k, v in sorted(profile.items())] +
+               ['--force'])
+    check_call(['ceph', '--id', service, 'osd', 'crush', 'rule',
+                'create-erasure', rule_name, rule_name])
+    return rule_name
+
+
+def _apply_device_class(service, pool_name, device_class,
+                        erasure_profile=None):
+    """Move a pool onto the OSDs of device_class.
+
+    :returns: dict. exit-code and reason if not 0, else None.
+    """
+    try:
+        rule_name = device_class_rule(service, device_class,
+                                      erasure_profile)
+        pool_set(service=service, pool_name=pool_name, key='crush_rule',
+                 value=rule_name)
+    except (CalledProcessError, ValueError) as e:
+        msg = ("Unable to place pool {} on device class {}: {}"
+               .format(pool_name, device_class, e))
+        log(msg, level=ERROR)
+        return {'exit-code': 1, 'stderr': msg}
+    return None
+
+
 def handle_erasure_pool(request, service):
     """Create a new erasure coded pool.
 
@@ -372,6 +457,8 @@ def handle_erasure_pool(request, service):
     weight = request.get('weight')
     group_name = request.get('group')
 
+    device_class = request.get('device-class')
+
     if erasure_profile is None:
         erasure_profile = "default-canonical"
 
@@ -383,6 +470,12 @@ def handle_erasure_pool(request, service):
         log(msg, level=ERROR)
         return {'exit-code': 1, 'stderr': msg}
 
+    if device_class:
+        msg = _validate_device_class(device_class)
+        if msg:
+            log(msg, level=ERROR)
+            return {'exit-code': 1, 'stderr': msg}
+
     if group_name:
         group_namespace = request.get('group-namespace')
         # Add the pool to the group named "group_name"
@@ -407,6 +500,12 @@ def handle_erasure_pool(request, service):
             .format(pool.name, erasure_profile), level=INFO)
         pool.create()
 
+    if device_class:
+        ret = _apply_device_class(service, pool_name, device_class,
+                                  erasure_profile)
+        if ret:
+            return ret
+
     # Set a quota if requested
     if quota is not None:
         set_pool_quota(service=service, pool_name=pool_name, max_bytes=quota)
@@ -424,6 +523,7 @@ def handle_replicated_pool(request, service):
     quota = request.get('max-bytes')
     weight = request.get('weight')
     group_name = request.get('group')
+    device_class = request.get('device-class')
 
     # Optional params
     pg_num = request.get('pg_num')
@@ -440,6 +540,12 @@ def handle_replicated_pool(request, service):
         log(msg, level=ERROR)
         return {'exit-code': 1, 'stderr': msg}
 
+    if device_class:
+        msg = _validate_device_class(device_class)
+        if msg:
+            log(msg, level=ERROR)
+            return {'exit-code': 1, 'stderr': msg}
+
     if group_name:
         group_namespace = request.get('group-namespace')
         # Add the pool to the group named "group_name"
@@ -467,6 +573,11 @@ def handle_replicated_pool(request, service):
         log("Pool '{}' already exists - skipping create".format(pool.name),
             level=DEBUG)
 
+    if device_class:
+        ret = _apply_device_class(service, pool_name, device_class)
+        if ret:
+            return ret
+
     # Set a quota if requested
     if quota is not None:
         set_pool_quota(service=service, pool_name=pool_name, max_bytes=quota)
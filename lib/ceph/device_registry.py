@@ -0,0 +1,331 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Registry of the block devices this unit has seen and what it did to them.
+
+Each device is recorded once under a stable identity (WWN, EUI or serial
+taken from /dev/disk/by-id, falling back to the kernel path) together with
+every path it has been referred to by, its lifecycle state, when it
+entered each state and the ids of the OSDs it backs, so that a device split
+into several OSDs is zapped and blacklisted as one. Records and the path
+index are individual unitdata keys, so looking up or updating one device
+never reads or rewrites the others.
+"""
+
+import os
+import time
+
+from charmhelpers.core.hookenv import (
+    cached,
+    log,
+    DEBUG,
+)
+from charmhelpers.core.unitdata import kv
+
+DISCOVERED = 'discovered'
+PRISTINE = 'pristine'
+PREPARING = 'preparing'
+ACTIVE = 'active'
+FAILED = 'failed'
+BLACKLISTED = 'blacklisted'
+ZAPPED = 'zapped'
+
+STATES = (DISCOVERED, PRISTINE, PREPARING, ACTIVE, FAILED, BLACKLISTED,
+          ZAPPED)
+
+
+# Permitted transitions between states. Any device may be blacklisted or
+# zapped in addition; zapping a blacklisted device leaves it blacklisted
+# and removing a device from the blacklist restores its previous state.
+TRANSITIONS = {
+    None: (DISCOVERED, PRISTINE, PREPARING, ACTIVE, FAILED),
+    DISCOVERED: (PRISTINE, PREPARING, ACTIVE, FAILED),
+    PRISTINE: (DISCOVERED, PREPARING, ACTIVE),
+    PREPARING: (PREPARING, ACTIVE, FAILED),
+    ACTIVE: (FAILED,),
+    FAILED: (PREPARING, ACTIVE),
+    BLACKLISTED: (),
+    ZAPPED: (DISCOVERED, PRISTINE, PREPARING),
+}
+
+DEVICE_KEY = 'device-registry.'
+PATH_KEY = 'device-registry-path.'
+
+# Flat lists used by earlier releases of the charm
+LEGACY_DEVICES_KEY = 'osd-devices'
+LEGACY_BLACKLIST_KEY = 'osd-blacklist'
+
+BY_ID_DIR = '/dev/disk/by-id'
+
+# by-id link prefixes in order of preference as stable identities
+ID_PREFIXES = ('wwn-', 'nvme-eui.', 'nvme-', 'scsi-', 'ata-', 'virtio-')
+
+
+class InvalidTransition(ValueError):
+    pass
+
+
+def _id_rank(name):
+    for rank, prefix in enumerate(ID_PREFIXES):
+        if name.startswith(prefix):
+            return rank
+    return len(ID_PREFIXES)
+
+
+@cached
+def read_by_id(by_id_dir=BY_ID_DIR):
+    """Map kernel device paths to their preferred /dev/disk/by-id name.
+
+    The links are read once per hook.
+
+    :param by_id_dir: str. Directory holding the by-id symlinks
+    :returns: dict. by-id name keyed by the resolved device path
+    """
+    identities = {}
+    try:
+        names = os.listdir(by_id_dir)
+    except OSError:
+        return identities
+    for name in sorted(names, key=lambda n: (_id_rank(n), n)):
+        target = os.path.realpath(os.path.join(by_id_dir, name))
+        identities.setdefault(target, name)
+    return identities
+
+
+class DeviceRegistry(object):
+    """Lifecycle state of block devices, persisted in unitdata.
+
+    :param db: unitdata.Storage to keep the registry in, defaults to kv()
+    :param by_id_dir: str. Directory holding the by-id symlinks
+    """
+
+    def __init__(self, db=None, by_id_dir=BY_ID_DIR):
+        self.db = db or kv()
+        self.by_id_dir = by_id_dir
+        self._by_id = None
+        self._migrate()
+
+    def _migrate(self):
+        for key, state in ((LEGACY_DEVICES_KEY, ACTIVE),
+                           (LEGACY_BLACKLIST_KEY, BLACKLISTED)):
+            paths = self.db.get(key)
+            if paths is None:
+                continue
+            for path in paths:
+                if state == BLACKLISTED:
+                    self.blacklist(path)
+                elif self.state(path) != state:
+                    self.transition(path, state)
+            self.db.unset(key)
+            log('Migrated {} to the device registry'.format(key),
+                level=DEBUG)
+
+    def identity(self, path):
+        """Stable identity of the device at path.
+
+        :param path: str. Path to the block device
+        :returns: str. by-id name of the device, or its resolved path
+        """
+        if self._by_id is None:
+            self._by_id = read_by_id(self.by_id_dir)
+        real_path = os.path.realpath(path)
+        return self._by_id.get(real_path, real_path)
+
+    def lookup(self, path):
+        """Return the record of the device at path.
+
+        Paths seen before are looked up through the path index, which is
+        checked against the current identity of the device so that a path
+        the kernel has since given to another disk is moved to that disk's
+        record; a new path to a known device is added to the index.
+
+        :param path: str. Path to the block device
+        :returns: dict or None if the device is not registered
+        """
+        indexed = self.db.get(PATH_KEY + path)
+        identity = self.identity(path)
+        # devices without a by-id link are known by their kernel path
+        if indexed and indexed in (identity, os.path.realpath(path)):
+            return self.db.get(DEVICE_KEY + indexed)
+        if indexed:
+            self._remove_path(indexed, path)
+        record = self.db.get(DEVICE_KEY + identity)
+        if record:
+            self._add_path(record, path)
+        return record
+
+    def _remove_path(self, identity, path):
+        log('{} no longer refers to {}'.format(path, identity), level=DEBUG)
+        record = self.db.get(DEVICE_KEY + identity)
+        if record and path in record['paths']:
+            record['paths'].remove(path)
+            self.db.set(DEVICE_KEY + identity, record)
+        self.db.unset(PATH_KEY + path)
+
+    def state(self, path):
+        """Return the state of the device at path or None if unknown."""
+        record = self.lookup(path)
+        return record['state'] if record else None
+
+    def _add_path(self, record, path):
+        if path not in record['paths']:
+            record['paths'].append(path)
+            self.db.set(DEVICE_KEY + record['id'], record)
+        self.db.set(PATH_KEY + path, record['id'])
+
+    def _save(self, path, record, state, osd_ids=None):
+        record['state'] = state
+        record['timestamps'][state] = time.time()
+        if osd_ids:
+            record['osd_id'] = osd_ids[0]
+            record['osd_ids'] = list(osd_ids)
+        if path not in record['paths']:
+            record['paths'].append(path)
+        self.db.set(DEVICE_KEY + record['id'], record)
+        self.db.set(PATH_KEY + path, record['id'])
+        return record
+
+    def _new(self, path):
+        return {
+            'id': self.identity(path),
+            'paths': [],
+            'state': None,
+            'previous_state': None,
+            'osd_id': None,
+            'osd_ids': [],
+            'timestamps': {},
+        }
+
+    def transition(self, path, state, osd_id=None, osd_ids=None):
+        """Move the device at path to state.
+
+        :param path: str. Path to the block device
+        :param state: str. One of STATES
+        :param osd_id: int. The OSD the device backs, if known
+        :param osd_ids: list. The OSDs the device backs, if it backs more
+                        than one
+        :returns: dict. The updated record
+        :raises: InvalidTransition if state may not follow the current one
+        """
+        record = self.lookup(path) or self._new(path)
+        current = record['state']
+        if state == BLACKLISTED:
+            return self.blacklist(path)
+        if state != ZAPPED and state not in TRANSITIONS[current]:
+            raise InvalidTransition('{}: cannot move from {} to {}'
+                                    .format(path, current, state))
+        if state == ZAPPED:
+            record['osd_id'] = None
+            record['osd_ids'] = []
+            if current == BLACKLISTED:
+                # stays blacklisted, but is no longer in use once removed
+                # from the blacklist
+                record['previous_state'] = ZAPPED
+                return self._save(path, record, BLACKLISTED)
+        record['previous_state'] = current
+        if osd_id is not None:
+            osd_ids = [osd_id]
+        return self._save(path, record, state, osd_ids)
+
+    def blacklist(self, path):
+        """Exclude the device at path from use by the charm.
+
+        :returns: dict. The updated record
+        """
+        record = self.lookup(path) or self._new(path)
+        if record['state'] == BLACKLISTED:
+            return record
+        record['previous_state'] = record['state']
+        return self._save(path, record, BLACKLISTED)
+
+    def unblacklist(self, path):
+        """Return a blacklisted device to the state it was blacklisted in.
+
+        :returns: dict. The updated record
+        :raises: InvalidTransition if the device is not blacklisted
+        """
+        record = self.lookup(path)
+        if not record or record['state'] != BLACKLISTED:
+            raise InvalidTransition('{}: device not in blacklist'
+                                    .format(path))
+        previous = record['previous_state'] or DISCOVERED
+        record['previous_state'] = BLACKLISTED
+        return self._save(path, record, previous)
+
+    def blacklisted(self, paths):
+        """Return which of paths refer to blacklisted devices.
+
+        Devices are matched by identity, so a blacklisted disk stays
+        excluded when the kernel gives it a different name.
+
+        :param paths: list. Device paths
+        :returns: set. The blacklisted paths
+        """
+        identities = set(record['id']
+                         for record in self.devices(BLACKLISTED))
+        if not identities:
+            return set()
+        return set(path for path in paths
+                   if self.identity(path) in identities)
+
+    def devices(self, state=None):
+        """Return all registered devices, optionally only those in state.
+
+        :returns: list. Device records ordered by identity
+        """
+        records = self.db.getrange(DEVICE_KEY, strip=True)
+        return [records[k] for k in sorted(records)
+                if state is None or records[k]['state'] == state]
+
+    def paths(self, *states):
+        """Return every path of the devices in any of states.
+
+        :returns: set. Device paths
+        """
+        return set(path for record in self.devices()
+                   if record['state'] in states
+                   for path in record['paths'])
+
+
+def osd_ids(record):
+    """Return the ids of the OSDs the device of record backs.
+
+    :param record: dict. Device record, or None
+    :returns: list. OSD ids
+    """
+    if not record:
+        return []
+    if record.get('osd_ids'):
+        return record['osd_ids']
+    # records written before devices could back several OSDs
+    return [record['osd_id']] if record['osd_id'] is not None else []
+
+
+def processed_states(ignore_errors=False):
+    """States of devices which hooks do not consider again until zapped.
+
+    Devices which failed to initialize are retried by later hooks, unless
+    errors are being ignored.
+
+    :param ignore_errors: bool. Whether device errors are being ignored
+    :returns: tuple. Device states
+    """
+    if ignore_errors:
+        return (ACTIVE, FAILED)
+    return (ACTIVE,)
+
+
+def registry():
+    """Return the device registry of this unit."""
+    return DeviceRegistry()
@@ -0,0 +1,300 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import json
+import math
+import time
+
+from subprocess import check_call, check_output
+
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    INFO,
+)
+
+DEFAULT_PGS_PER_OSD_TARGET = 100
+DEFAULT_MAX_PGS_PER_OSD = 200
+DEFAULT_MINIMUM_PGS = 2
+DEFAULT_PG_STEP = 64
+
+# PG states which indicate that a pg_num/pgp_num change has not yet
+# been absorbed by the cluster.
+PG_SETTLING_STATES = ['creating', 'peering', 'activating', 'unknown']
+
+PoolPlan = collections.namedtuple('PoolPlan', [
+    'name',
+    'size',
+    'root',
+    'osd_count',
+    'bytes_used',
+    'pg_num',
+    'pgp_num',
+    'target_pg_num',
+])
+
+
+def _ceph_json(service, *args):
+    """Run a ceph command with JSON output and return the parsed result.
+
+    :param service: str. The cephx id to run the command as
+    :param args: ceph command arguments
+    :returns: The decoded JSON document
+    :raises: CalledProcessError if the ceph command fails
+    :raises: ValueError if the output is not valid JSON
+    """
+    cmd = ['ceph', '--id', service]
+    cmd.extend(args)
+    cmd.append('--format=json')
+    return json.loads(check_output(cmd).decode('UTF-8'))
+
+
+def nearest_power_of_two(num_pg):
+    """Round a PG count to a power of two.
+
+    The CRUSH algorithm has a slight optimization for placement groups with
+    powers of 2, so round to the nearest power of 2 such that 2^n <= num_pg,
+    unless that is more than 25% below the requested value in which case the
+    next highest power of 2 is used. This matches Pool.get_pgs() in
+    charmhelpers.
+
+    :param num_pg: float. Requested number of placement groups
+    :returns: int. Number of placement groups rounded to a power of two
+    """
+    if num_pg < DEFAULT_MINIMUM_PGS:
+        num_pg = DEFAULT_MINIMUM_PGS
+    nearest = 2 ** int(math.floor(math.log(num_pg, 2)))
+    if (num_pg - nearest) > (num_pg * 0.25):
+        return int(nearest * 2)
+    return int(nearest)
+
+
+def _count_osds_under(nodes, root_id):
+    """Count the OSDs in the CRUSH subtree starting at root_id.
+
+    :param nodes: dict. CRUSH tree nodes keyed by id
+    :param root_id: int. The id of the bucket to count from
+    :returns: int. Number of OSDs beneath the bucket
+    """
+    count = 0
+    pending = [root_id]
+    while pending:
+        node = nodes.get(pending.pop())
+        if not node:
+            continue
+        if node['type'] == 'osd':
+            count += 1
+        pending.extend(node.get('children', []))
+    return count
+
+
+def get_cluster_pg_state(service):
+    """Collect the state needed to plan placement groups for every pool.
+
+    The pool list, usage, CRUSH rules and OSD tree are each read exactly
+    once, so planning costs four mon round trips regardless of the number
+    of pools in the cluster.
+
+    :param service: str. The cephx id to run ceph commands as
+    :returns: list. A PoolPlan for every pool with target_pg_num unset
+    :raises: CalledProcessError if any ceph command fails
+    """
+    pools = _ceph_json(service, 'osd', 'pool', 'ls', 'detail')
+    usage = _ceph_json(service, 'df')
+    rules = _ceph_json(service, 'osd', 'crush', 'rule', 'dump')
+    tree = _ceph_json(service, 'osd', 'tree')
+
+    nodes = {node['id']: node for node in tree['nodes']}
+    rule_roots = {}
+    for rule in rules:
+        for step in rule.get('steps', []):
+            if step.get('op') == 'take':
+                rule_roots[rule['rule_id']] = step['item']
+                break
+
+    bytes_used = {pool['name']: pool['stats'].get('bytes_used', 0)
+                  for pool in usage.get('pools', [])}
+
+    osd_counts = {}
+    plans = []
+    for pool in pools:
+        rule_id = pool.get('crush_rule', pool.get('crush_ruleset'))
+        root = rule_roots.get(rule_id)
+        if root not in osd_counts:
+            osd_counts[root] = _count_osds_under(nodes, root)
+        plans.append(PoolPlan(
+            name=pool['pool_name'],
+            size=pool['size'],
+            root=root,
+            osd_count=osd_counts[root],
+            bytes_used=bytes_used.get(pool['pool_name'], 0),
+            pg_num=pool['pg_num'],
+            pgp_num=pool['pg_placement_num'],
+            target_pg_num=None))
+    return plans
+
+
+def plan_pgs(pools, target_pgs_per_osd=DEFAULT_PGS_PER_OSD_TARGET,
+             max_pgs_per_osd=DEFAULT_MAX_PGS_PER_OSD):
+    """Compute target pg_num for all pools sharing each CRUSH root.
+
+    Each root's PG budget (target PGs per OSD * OSD count) is split between
+    its pools in proportion to the bytes each pool stores, or evenly if the
+    pools are empty. Targets never shrink an existing pool, as placement
+    groups cannot be merged on the supported ceph releases. If the resulting
+    per-OSD PG count would exceed max_pgs_per_osd, the largest planned
+    increase is halved repeatedly until the root fits again.
+
+    :param pools: list. PoolPlan entries from get_cluster_pg_state()
+    :param target_pgs_per_osd: int. Desired PG replicas per OSD
+    :param max_pgs_per_osd: int. Hard ceiling of PG replicas per OSD
+    :returns: list. PoolPlan entries with target_pg_num populated
+    """
+    by_root = collections.OrderedDict()
+    for pool in pools:
+        by_root.setdefault(pool.root, []).append(pool)
+
+    planned = {}
+    for root, members in by_root.items():
+        osd_count = members[0].osd_count
+        if not osd_count:
+            log('No OSDs found beneath CRUSH root {}, leaving pools {} '
+                'unchanged'.format(root, [p.name for p in members]), DEBUG)
+            for pool in members:
+                planned[pool.name] = pool.pg_num
+            continue
+
+        total_used = sum(p.bytes_used for p in members)
+        budget = target_pgs_per_osd * osd_count
+        targets = {}
+        for pool in members:
+            if total_used:
+                share = float(pool.bytes_used) / total_used
+            else:
+                share = 1.0 / len(members)
+            wanted = nearest_power_of_two(budget * share / pool.size)
+            targets[pool.name] = max(pool.pg_num, wanted)
+
+        def per_osd():
+            return sum(targets[p.name] * p.size
+                       for p in members) / float(osd_count)
+
+        while per_osd() > max_pgs_per_osd:
+            growing = [p for p in members if targets[p.name] > p.pg_num]
+            if not growing:
+                break
+            pool = max(growing, key=lambda p: targets[p.name] * p.size)
+            targets[pool.name] = max(pool.pg_num, targets[pool.name] // 2)
+            log('Reduced planned pg_num of pool {} to {} to stay within {} '
+                'PGs per OSD'.format(pool.name, targets[pool.name],
+                                     max_pgs_per_osd), INFO)
+        planned.update(targets)
+
+    return [pool._replace(target_pg_num=planned[pool.name])
+            for pool in pools]
+
+
+def _pgs_settled(service):
+    """Determine whether all PGs have finished creating and peering.
+
+    :param service: str. The cephx id to run ceph commands as
+    :returns: bool. True if no PG is in a settling state
+    """
+    stat = _ceph_json(service, 'pg', 'stat')
+    # luminous nests the summary under 'pg_summary'
+    stat = stat.get('pg_summary', stat)
+    for entry in stat.get('num_pg_by_state', []):
+        for state in PG_SETTLING_STATES:
+            if state in entry['name']:
+                return False
+    return True
+
+
+def pgs_active_clean(service):
+    """Determine whether every PG is active+clean.
+
+    :param service: str. The cephx id to run ceph commands as
+    :returns: bool. True if all PGs are active+clean
+    """
+    stat = _ceph_json(service, 'pg', 'stat')
+    stat = stat.get('pg_summary', stat)
+    clean = sum(entry['num'] for entry in stat.get('num_pg_by_state', [])
+                if entry['name'] == 'active+clean')
+    return clean == stat.get('num_pgs', 0)
+
+
+def wait_for_active_clean(service, timeout, interval=5):
+    """Wait for every PG to become active+clean.
+
+    :returns: bool. True if the PGs were clean before the timeout
+    """
+    deadline = time.time() + timeout
+    while not pgs_active_clean(service):
+        if time.time() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def _wait_for_pgs(service, timeout, interval=5):
+    """Wait for newly split PGs to settle.
+
+    :returns: bool. True if the PGs settled before the timeout
+    """
+    deadline = time.time() + timeout
+    while not _pgs_settled(service):
+        if time.time() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def apply_pg_plan(service, plans, step=DEFAULT_PG_STEP, timeout=600):
+    """Grow pg_num and pgp_num of each pool towards its planned target.
+
+    Growth happens in increments of at most `step` PGs; after each
+    increment pg_num is raised first and pgp_num follows once the new PGs
+    have been created, so that only a bounded amount of data is remapped
+    at any one time.
+
+    :param service: str. The cephx id to run ceph commands as
+    :param plans: list. PoolPlan entries from plan_pgs()
+    :param step: int. Maximum number of PGs to add per increment
+    :param timeout: int. Seconds to wait for PGs to settle per increment
+    :returns: dict. Final pg_num keyed by pool name
+    :raises: RuntimeError if PGs do not settle within the timeout
+    """
+    applied = {}
+    for plan in plans:
+        pg_num = plan.pg_num
+        pgp_num = plan.pgp_num
+        while pgp_num < plan.target_pg_num:
+            if pg_num < plan.target_pg_num:
+                pg_num = min(plan.target_pg_num, pg_num + step)
+                log('Setting pg_num of pool {} to {}'.format(plan.name,
+                                                             pg_num), INFO)
+                check_call(['ceph', '--id', service, 'osd', 'pool', 'set',
+                            plan.name, 'pg_num', str(pg_num)])
+                if not _wait_for_pgs(service, timeout):
+                    raise RuntimeError('Timed out waiting for PGs of pool {} '
+                                       'to be created'.format(plan.name))
+            pgp_num = pg_num
+            check_call(['ceph', '--id', service, 'osd', 'pool', 'set',
+                        plan.name, 'pgp_num', str(pgp_num)])
+            if not _wait_for_pgs(service, timeout):
+                raise RuntimeError('Timed out waiting for PGs of pool {} '
+                                   'to peer'.format(plan.name))
+        applied[plan.name] = pg_num
+    return applied
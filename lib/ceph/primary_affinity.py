@@ -0,0 +1,225 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Primary affinity of local OSDs from their measured latency.
+
+Clients read from the primary OSD of each placement group, so in a cluster
+mixing device types the slow devices serve as many reads as the fast ones.
+Each unit lowers the primary affinity of its own OSDs in proportion to how
+much slower they are than the fastest OSD in the cluster, making it more
+likely that a faster replica is chosen as primary. Affinities move by at
+most a bounded step per run and only when they are further than the
+hysteresis from their target, so that latency noise does not keep
+remapping primaries.
+"""
+
+import collections
+import json
+import os
+import time
+
+from subprocess import CalledProcessError, check_output
+
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    INFO,
+)
+
+from ceph.utils import (
+    get_ceph_volume_osds,
+    get_local_osd_ids,
+    set_primary_affinity,
+)
+
+DEFAULT_STEP = 0.25
+DEFAULT_HYSTERESIS = 0.1
+DEFAULT_MIN_AFFINITY = 0.1
+
+# Latencies below this are treated as equal; ceph osd perf reports whole
+# milliseconds, so an idle fast OSD often reports 0.
+LATENCY_FLOOR_MS = 1.0
+
+DISKSTATS = '/proc/diskstats'
+
+AffinityPlan = collections.namedtuple('AffinityPlan', [
+    'osd_id',
+    'latency_ms',
+    'affinity',
+    'target',
+    'new_affinity',
+])
+
+
+def _ceph_json(service, *args):
+    cmd = ['ceph', '--id', service]
+    cmd.extend(args)
+    cmd.append('--format=json')
+    return json.loads(check_output(cmd).decode('UTF-8'))
+
+
+def get_osd_perf(service):
+    """Read the commit and apply latency of every OSD in the cluster.
+
+    :param service: str. The cephx id to run ceph commands as
+    :returns: dict. The larger of the two latencies, in ms, keyed by
+              OSD id
+    :raises: CalledProcessError if the ceph command fails
+    """
+    perf = _ceph_json(service, 'osd', 'perf')
+    # nautilus nests the list under 'osdstats'
+    perf = perf.get('osdstats', perf)
+    latencies = {}
+    for info in perf.get('osd_perf_infos', []):
+        stats = info.get('perf_stats', {})
+        latencies[int(info['id'])] = float(max(
+            stats.get('commit_latency_ms', 0),
+            stats.get('apply_latency_ms', 0)))
+    return latencies
+
+
+def read_diskstats(path=DISKSTATS):
+    """Read the I/O counters of every block device.
+
+    :returns: dict. (completed I/Os, ms spent on them) keyed by kernel
+              device name
+    """
+    stats = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 11:
+                continue
+            stats[fields[2]] = (int(fields[3]) + int(fields[7]),
+                                int(fields[6]) + int(fields[10]))
+    return stats
+
+
+def get_local_await(interval=5, path=DISKSTATS):
+    """Measure the await of the devices backing the local OSDs.
+
+    Used when the cluster latencies cannot be read. Two samples of
+    /proc/diskstats are taken interval seconds apart; OSDs sharing a
+    device share its await.
+
+    :param interval: int. Seconds between the samples
+    :returns: dict. Await in ms keyed by OSD id
+    """
+    devices = {}
+    for device, osd_ids in get_ceph_volume_osds().items():
+        for osd_id in osd_ids:
+            devices[osd_id] = os.path.basename(device)
+    before = read_diskstats(path)
+    time.sleep(interval)
+    after = read_diskstats(path)
+    latencies = {}
+    for osd_id, name in devices.items():
+        if name not in before or name not in after:
+            continue
+        ios = after[name][0] - before[name][0]
+        ticks = after[name][1] - before[name][1]
+        latencies[osd_id] = float(ticks) / ios if ios > 0 else 0.0
+    return latencies
+
+
+def get_primary_affinities(service):
+    """Read the primary affinity of every OSD in the cluster.
+
+    :returns: dict. Affinity keyed by OSD id
+    :raises: CalledProcessError if the ceph command fails
+    """
+    dump = _ceph_json(service, 'osd', 'dump')
+    return dict((osd['osd'], float(osd.get('primary_affinity', 1.0)))
+                for osd in dump.get('osds', []))
+
+
+def plan_primary_affinity(latencies, affinities, osd_ids,
+                          step=DEFAULT_STEP, hysteresis=DEFAULT_HYSTERESIS,
+                          min_affinity=DEFAULT_MIN_AFFINITY):
+    """Plan the primary affinity of osd_ids.
+
+    Each OSD targets the ratio of the lowest latency in latencies to its
+    own, bounded below by min_affinity. An affinity is only changed when it
+    is more than hysteresis from its target, and then by at most step.
+
+    :param latencies: dict. Latency in ms keyed by OSD id, of every OSD
+                      measured
+    :param affinities: dict. Current primary affinity keyed by OSD id
+    :param osd_ids: list. The OSDs to plan, those of this unit
+    :returns: list. An AffinityPlan for each of osd_ids with a latency
+    """
+    if not latencies:
+        return []
+    fastest = max(min(latencies.values()), LATENCY_FLOOR_MS)
+    plans = []
+    for osd_id in sorted(osd_ids):
+        if osd_id not in latencies:
+            continue
+        latency = max(latencies[osd_id], LATENCY_FLOOR_MS)
+        target = round(max(min_affinity, min(1.0, fastest / latency)), 2)
+        affinity = affinities.get(osd_id, 1.0)
+        new_affinity = affinity
+        if abs(target - affinity) > hysteresis:
+            delta = max(-step, min(step, target - affinity))
+            new_affinity = round(affinity + delta, 2)
+        plans.append(AffinityPlan(osd_id=osd_id,
+                                  latency_ms=latencies[osd_id],
+                                  affinity=affinity,
+                                  target=target,
+                                  new_affinity=new_affinity))
+    return plans
+
+
+def plan_local_primary_affinity(service, step=DEFAULT_STEP,
+                                hysteresis=DEFAULT_HYSTERESIS,
+                                min_affinity=DEFAULT_MIN_AFFINITY,
+                                interval=5):
+    """Measure latencies and plan the primary affinity of the local OSDs.
+
+    :param service: str. The cephx id to run ceph commands as
+    :param interval: int. Seconds to sample /proc/diskstats for, if the
+                     cluster latencies cannot be read
+    :returns: list. AffinityPlan entries of the local OSDs
+    :raises: CalledProcessError if the affinities cannot be read
+    """
+    osd_ids = [int(osd_id) for osd_id in get_local_osd_ids()]
+    try:
+        latencies = get_osd_perf(service)
+    except (CalledProcessError, ValueError) as e:
+        log('Unable to read OSD latencies, measuring local devices: {}'
+            .format(e), level=DEBUG)
+        latencies = {}
+    if not any(osd_id in latencies for osd_id in osd_ids):
+        latencies = get_local_await(interval)
+    return plan_primary_affinity(latencies,
+                                 get_primary_affinities(service),
+                                 osd_ids, step, hysteresis, min_affinity)
+
+
+def apply_primary_affinity(plans):
+    """Set the primary affinities planned for the local OSDs.
+
+    :param plans: list. AffinityPlan entries
+    :returns: list. Ids of the OSDs whose affinity was changed
+    """
+    changed = []
+    for plan in plans:
+        if plan.new_affinity == plan.affinity:
+            continue
+        log('Setting primary affinity of osd.{} to {} ({}ms, target {})'
+            .format(plan.osd_id, plan.new_affinity, plan.latency_ms,
+                    plan.target), level=INFO)
+        if set_primary_affinity(plan.osd_id, plan.new_affinity):
+            changed.append(plan.osd_id)
+    return changed
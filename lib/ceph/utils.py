@@ -16,7 +16,6 @@ import collections
 import glob
 import json
 import os
-import pyudev
 import random
 import re
 import socket
@@ -26,6 +25,7 @@ import time
 import uuid
 
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 from charmhelpers.core import hookenv
 from charmhelpers.core import templating
@@ -37,6 +37,7 @@ from charmhelpers.core.host import (
     mkdir,
     owner,
     service_restart,
+    service_running,
     service_start,
     service_stop,
     CompareHostReleases,
@@ -56,26 +57,37 @@ from charmhelpers.fetch import (
     apt_cache,
     add_source, apt_install, apt_update
 )
-from charmhelpers.contrib.storage.linux.ceph import (
-    get_mon_map,
-    monitor_key_set,
-    monitor_key_exists,
-    monitor_key_get,
-)
 from charmhelpers.contrib.storage.linux.utils import (
     is_block_device,
     is_device_mounted,
-)
-from charmhelpers.contrib.openstack.utils import (
-    get_os_codename_install_source,
+    zap_disk,
 )
 from charmhelpers.contrib.storage.linux import lvm
-from charmhelpers.core.unitdata import kv
+
+from ceph import device_registry
 
 CEPH_BASE_DIR = os.path.join(os.sep, 'var', 'lib', 'ceph')
 OSD_BASE_DIR = os.path.join(CEPH_BASE_DIR, 'osd')
 HDPARM_FILE = os.path.join(os.sep, 'etc', 'hdparm.conf')
 
+# Upper bound on the time spent waiting for udev after triggering events
+UDEV_SETTLE_TIMEOUT = 30
+
+# Number of OSDs started together, and the seconds to wait for each wave
+# to report up before starting the next, when the osd-start-wave-size and
+# osd-start-wave-timeout options are not set
+OSD_START_WAVE_SIZE = 4
+OSD_START_WAVE_TIMEOUT = 120
+OSD_UP_POLL_INTERVAL = 5
+
+# Flags set while the OSDs of a host are under maintenance
+MAINTENANCE_FLAGS = ('noout', 'norebalance')
+
+# The maintenance flags set on the host's CRUSH bucket from Mimic; the
+# cluster-wide flags are not set then, as the first host to resume would
+# clear them while other hosts are still under maintenance
+GROUP_MAINTENANCE_FLAGS = ('noout',)
+
 LEADER = 'leader'
 PEON = 'peon'
 QUORUM = [LEADER, PEON]
@@ -84,6 +96,13 @@ PACKAGES = ['ceph', 'gdisk', 'btrfs-tools', 'python-ceph',
             'radosgw', 'xfsprogs', 'python-pyudev',
             'lvm2', 'parted']
 
+# lvmcache modes for HDD data devices cached on flash; writecache uses
+# dm-writecache, the others dm-cache
+CACHE_MODES = ('writeback', 'writethrough', 'writecache')
+HYBRID_VG_PREFIX = 'ceph-hybrid-'
+# share of a cache device kept free for dm-cache metadata
+CACHE_METADATA_RESERVE = 0.02
+
 CEPH_KEY_MANAGER = 'ceph'
 VAULT_KEY_MANAGER = 'vault'
 KEY_MANAGERS = [
@@ -171,6 +190,8 @@ class Partition(object):
 
 def unmounted_disks():
     """List of unmounted block devices on the current host."""
+    import pyudev
+
     disks = []
     context = pyudev.Context()
     for device in context.list_devices(DEVTYPE='disk'):
@@ -897,9 +918,7 @@ def is_pristine_disk(dev):
 
 
 def is_osd_disk(dev):
-    db = kv()
-    osd_devices = db.get('osd-devices', [])
-    if dev in osd_devices:
+    if device_registry.registry().state(dev) == device_registry.ACTIVE:
         log('Device {} already processed by charm,'
             ' skipping'.format(dev))
         return True
@@ -923,26 +942,131 @@ def is_osd_disk(dev):
     return False
 
 
-def start_osds(devices):
+def start_osds(devices, new_devices=None, start_stopped=True):
+    """Start the OSDs on devices.
+
+    :param devices: list. OSD devices and directories of this unit
+    :param new_devices: list. Devices prepared by the calling hook; udev
+                        rules are re-run for these only. None re-runs them
+                        for every block device on the host.
+    :param start_stopped: bool. Whether to start the OSDs of new_devices
+                          which are not running, e.g. False while the unit
+                          is paused
+    """
     # Scan for ceph block devices
-    rescan_osd_devices()
+    if new_devices is None or new_devices:
+        rescan_osd_devices(new_devices)
     if cmp_pkgrevno('ceph', "0.56.6") >= 0:
         # Use ceph-disk activate for directory based OSD's
         for dev_or_path in devices:
             if os.path.exists(dev_or_path) and os.path.isdir(dev_or_path):
                 subprocess.check_call(['ceph-disk', 'activate', dev_or_path])
+    if start_stopped and new_devices and systemd():
+        # Bring up the new OSDs which did not start with their device,
+        # without starting them all at once. Other stopped OSDs may have
+        # been stopped on purpose and are left alone.
+        registry = device_registry.registry()
+        stopped = [osd_id for dev in new_devices
+                   for osd_id in device_registry.osd_ids(registry.lookup(dev))
+                   if not service_running('ceph-osd@{}'.format(osd_id))]
+        if stopped:
+            start_osds_staggered(stopped)
+
+
+def _block_sysnames(dev, sys_block='/sys/class/block'):
+    """Kernel names of a block device, its partitions and every device
+    stacked on top of them (LVM, dm-crypt, bcache).
+
+    :param dev: str. Path to the block device
+    :returns: set. Kernel device names, e.g. {'sdb', 'sdb1', 'dm-3'}
+    """
+    names = set()
+    pending = [os.path.basename(os.path.realpath(dev))]
+    while pending:
+        name = pending.pop()
+        if name in names:
+            continue
+        names.add(name)
+        path = os.path.join(sys_block, name)
+        try:
+            children = os.listdir(path)
+        except OSError:
+            continue
+        pending.extend(child for child in children
+                       if child.startswith(name) and
+                       os.path.exists(os.path.join(path, child, 'partition')))
+        try:
+            pending.extend(os.listdir(os.path.join(path, 'holders')))
+        except OSError:
+            pass
+    return names
+
 
+def _block_monitor():
+    """Return a started pyudev monitor for block device events, or None
+    if pyudev is not available."""
+    try:
+        import pyudev
+    except ImportError:
+        return None
+    monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+    monitor.filter_by('block')
+    monitor.start()
+    return monitor
+
+
+def rescan_osd_devices(devices=None, timeout=UDEV_SETTLE_TIMEOUT):
+    """Re-run the udev rules which activate and set permissions on OSD
+    devices.
+
+    With a list of devices only they, their partitions and the devices
+    stacked on them are triggered, and completion is detected from the
+    udev events for those devices. Otherwise every block device on the
+    host is triggered and the whole udev queue is waited for.
 
-def rescan_osd_devices():
+    :param devices: list. Paths of the block devices to rescan, or None
+    :param timeout: int. Maximum seconds to wait for udev to finish
+    """
     cmd = [
         'udevadm', 'trigger',
         '--subsystem-match=block', '--action=add'
     ]
+    if devices is None:
+        subprocess.call(cmd)
+        subprocess.call(['udevadm', 'settle',
+                         '--timeout={}'.format(timeout)])
+        return
 
-    subprocess.call(cmd)
+    sysnames = set()
+    for dev in devices:
+        sysnames.update(_block_sysnames(dev))
+    if not sysnames:
+        return
+    cmd.extend('--sysname-match={}'.format(name)
+               for name in sorted(sysnames))
 
-    cmd = ['udevadm', 'settle']
+    monitor = _block_monitor()
     subprocess.call(cmd)
+    if monitor is None:
+        subprocess.call(['udevadm', 'settle',
+                         '--timeout={}'.format(timeout)])
+        return
+
+    # The udev (rather than kernel) netlink source reports an event once
+    # udev has finished running the rules for the device.
+    deadline = time.time() + timeout
+    pending = set(sysnames)
+    while pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        device = monitor.poll(timeout=remaining)
+        if device is None:
+            break
+        pending.discard(device.sys_name)
+    if pending:
+        log('Timed out waiting for udev to process {}'
+            .format(', '.join(sorted(pending))), level=WARNING)
 
 
 _bootstrap_keyring = "/var/lib/ceph/bootstrap-osd/ceph.keyring"
@@ -1123,6 +1247,19 @@ osd_upgrade_caps = collections.OrderedDict([
              'allow command "osd in"',
              'allow command "osd rm"',
              'allow command "auth del"',
+             'allow command "osd dump"',
+             'allow command "osd set"',
+             'allow command "osd unset"',
+             'allow command "osd set-group"',
+             'allow command "osd unset-group"',
+             'allow command "pg stat"',
+             'allow command "osd perf"',
+             'allow command "osd primary-affinity"',
+             'allow command "osd crush reweight"',
+             'allow command "osd pool ls"',
+             'allow command "df"',
+             'allow command "osd crush rule dump"',
+             'allow command "osd pool set"',
              ])
 ])
 
@@ -1407,9 +1544,9 @@ def get_devices(name):
 def osdize(dev, osd_format, osd_journal, ignore_errors=False, encrypt=False,
            bluestore=False, key_manager=CEPH_KEY_MANAGER):
     if dev.startswith('/dev'):
-        osdize_dev(dev, osd_format, osd_journal,
-                   ignore_errors, encrypt,
-                   bluestore, key_manager)
+        return osdize_dev(dev, osd_format, osd_journal,
+                          ignore_errors, encrypt,
+                          bluestore, key_manager)
     else:
         osdize_dir(dev, encrypt, bluestore)
 
@@ -1421,6 +1558,9 @@ def osdize_dev(dev, osd_format, osd_journal, ignore_errors=False,
 
     A block device will only be prepared once during the lifetime
     of the calling charm unit; future executions will be skipped.
+    Progress is tracked in the device registry, so a device left in the
+    preparing state by an interrupted hook is either recognised as an OSD
+    or prepared again.
 
     :param: dev: Full path to block device to use
     :param: osd_format: Format for OSD filesystem
@@ -1430,6 +1570,7 @@ def osdize_dev(dev, osd_format, osd_journal, ignore_errors=False,
     :param: encrypt: Encrypt block devices using 'key_manager'
     :param: bluestore: Use bluestore native ceph block device format
     :param: key_manager: Key management approach for encryption keys
+    :returns: bool: True if the device was prepared by this call
     :raises subprocess.CalledProcessError: in the event that any supporting
                                            subprocess operation failed
     :raises ValueError: if an invalid key_manager is provided
@@ -1437,58 +1578,226 @@ def osdize_dev(dev, osd_format, osd_journal, ignore_errors=False,
     if key_manager not in KEY_MANAGERS:
         raise ValueError('Unsupported key manager: {}'.format(key_manager))
 
-    db = kv()
-    osd_devices = db.get('osd-devices', [])
-    if dev in osd_devices:
+    registry = device_registry.registry()
+    if not _can_osdize_dev(registry, dev, ignore_errors):
+        return
+    cmds = None
+    try:
+        cmds = _plan_osdize_dev(registry, dev, osd_format, osd_journal,
+                                encrypt, bluestore, key_manager)
+        _run_osdize_cmds(dev, cmds)
+    except subprocess.CalledProcessError as e:
+        _finish_osdize_dev(registry, dev, cmds, e, ignore_errors)
+        return
+    return _finish_osdize_dev(registry, dev, cmds)
+
+
+def osdize_devs(devices, osd_format, osd_journal, ignore_errors=False,
+                encrypt=False, bluestore=False, key_manager=CEPH_KEY_MANAGER,
+                parallel=OSD_START_WAVE_SIZE):
+    """Prepare several block devices for use as Ceph OSDs concurrently.
+
+    Devices are checked, and any journal, DB or WAL volumes they need are
+    allocated, one at a time as osdize_dev does; the vaultlocker encryption
+    of the devices and the ceph-volume (or ceph-disk) runs which then
+    create the OSDs, which take most of the time, are run up to parallel
+    at a time.
+
+    :param devices: list. Full paths to block devices to use
+    :param parallel: int. Maximum number of devices prepared at once
+    :returns: dict. Seconds taken to prepare each device prepared by this
+              call, keyed by device path
+    :raises subprocess.CalledProcessError: if a device fails to initialize
+                                           and errors are not ignored, once
+                                           every device has been attempted
+    :raises ValueError: if an invalid key_manager is provided
+    """
+    if key_manager not in KEY_MANAGERS:
+        raise ValueError('Unsupported key manager: {}'.format(key_manager))
+
+    registry = device_registry.registry()
+    devices = [dev for dev in devices
+               if _can_osdize_dev(registry, dev, ignore_errors)]
+    timings = dict((dev, 0.0) for dev in devices)
+    errors = []
+
+    def _record(dev, seconds, e, cmds=None):
+        try:
+            _finish_osdize_dev(registry, dev, cmds, e, ignore_errors)
+        except Exception:
+            errors.append(e)
+        if e is None:
+            timings[dev] += seconds
+        else:
+            del timings[dev]
+
+    osd_fsids = dict((dev, str(uuid.uuid4())) for dev in devices)
+    if (encrypt and key_manager == VAULT_KEY_MANAGER and
+            cmp_pkgrevno('ceph', '12.2.4') >= 0):
+        for dev in devices:
+            registry.transition(dev, device_registry.PREPARING)
+        registry.db.flush()
+        for dev, seconds, e in _run_parallel(
+                lambda dev: _encrypt_disk(dev, osd_fsids[dev]), devices,
+                parallel):
+            if e is not None:
+                _record(dev, seconds, e)
+            else:
+                timings[dev] += seconds
+
+    cmds = {}
+    for dev in devices:
+        if dev not in timings:
+            continue
+        # a device which cannot be planned fails on its own, the others
+        # still get their OSDs
+        try:
+            cmds[dev] = _plan_osdize_dev(registry, dev, osd_format,
+                                         osd_journal, encrypt, bluestore,
+                                         key_manager, osd_fsids[dev])
+        except Exception as e:
+            _record(dev, 0, e)
+    # the registry is only touched from this thread
+    for dev, seconds, e in _run_parallel(
+            lambda dev: _run_osdize_cmds(dev, cmds[dev]), list(cmds),
+            parallel):
+        _record(dev, seconds, e, cmds[dev])
+    if errors:
+        raise errors[0]
+    return timings
+
+
+def _run_parallel(func, items, parallel):
+    """Call func on each of items from up to parallel threads.
+
+    :param func: callable. Called with each item
+    :param items: list. Items to call func on
+    :param parallel: int. Maximum number of concurrent calls
+    :returns: iterator. (item, seconds taken, exception raised or None)
+              tuples in the order the calls complete, consumed in the
+              calling thread
+    """
+    def _call(item):
+        started = time.time()
+        try:
+            func(item)
+        except Exception as e:
+            return item, time.time() - started, e
+        return item, time.time() - started, None
+
+    if not items:
+        return
+    pool = ThreadPool(max(1, min(parallel or 1, len(items))))
+    try:
+        for result in pool.imap_unordered(_call, items):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _can_osdize_dev(registry, dev, ignore_errors):
+    """Check that dev may be prepared as an OSD.
+
+    :returns: bool. False if the device is to be skipped
+    """
+    state = registry.state(dev)
+    if state in device_registry.processed_states(ignore_errors):
         log('Device {} already processed by charm,'
             ' skipping'.format(dev))
-        return
+        return False
 
     if not os.path.exists(dev):
         log('Path {} does not exist - bailing'.format(dev))
-        return
+        return False
 
     if not is_block_device(dev):
         log('Path {} is not a block device - bailing'.format(dev))
-        return
+        return False
 
     if is_osd_disk(dev):
         log('Looks like {} is already an'
             ' OSD data or journal, skipping.'.format(dev))
-        return
+        _resume_prepare(registry, dev, state)
+        return False
 
     if is_device_mounted(dev):
         log('Looks like {} is in use, skipping.'.format(dev))
-        return
+        return False
 
     if is_active_bluestore_device(dev):
         log('{} is in use as an active bluestore block device,'
             ' skipping.'.format(dev))
-        return
+        _resume_prepare(registry, dev, state)
+        return False
 
     if is_mapped_luks_device(dev):
         log('{} is a mapped LUKS device,'
             ' skipping.'.format(dev))
-        return
+        return False
+
+    return True
+
 
+def _plan_osdize_dev(registry, dev, osd_format, osd_journal, encrypt,
+                     bluestore, key_manager, osd_fsid=None):
+    """Allocate what dev needs to become an OSD and record it as being
+    prepared.
+
+    :param osd_fsid: str. UUID for the (first) new OSD, generated if not
+                     provided
+    :returns: list. The commands which create the OSDs, one per OSD
+    """
+    # recorded first, so that a device whose allocation fails or is
+    # interrupted is not taken for a pristine one
+    registry.transition(dev, device_registry.PREPARING)
+    registry.db.flush()
     if cmp_pkgrevno('ceph', '12.2.4') >= 0:
-        cmd = _ceph_volume(dev,
+        dev_class = config('osd-device-class') or device_class(dev)
+        count = osds_per_device(dev, bluestore)
+        if count > 1:
+            cmds = _ceph_volume_split(dev, count, encrypt, key_manager,
+                                      osd_fsid, crush_device_class=dev_class)
+        else:
+            cmds = [_ceph_volume(dev,
+                                 osd_journal,
+                                 encrypt,
+                                 bluestore,
+                                 key_manager,
+                                 osd_fsid,
+                                 crush_device_class=dev_class)]
+    else:
+        cmds = [_ceph_disk(dev,
+                           osd_format,
                            osd_journal,
                            encrypt,
-                           bluestore,
-                           key_manager)
-    else:
-        cmd = _ceph_disk(dev,
-                         osd_format,
-                         osd_journal,
-                         encrypt,
-                         bluestore)
+                           bluestore)]
+    return cmds
 
-    try:
-        status_set('maintenance', 'Initializing device {}'.format(dev))
+
+def _run_osdize_cmds(dev, cmds):
+    status_set('maintenance', 'Initializing device {}'.format(dev))
+    for cmd in cmds:
         log("osdize cmd: {}".format(cmd))
         subprocess.check_call(cmd)
-    except subprocess.CalledProcessError:
+
+
+def _finish_osdize_dev(registry, dev, cmds, error=None, ignore_errors=False):
+    """Record the outcome of preparing dev.
+
+    :param cmds: list. The commands which created the OSDs, None if
+                 preparation failed before they were run
+    :param error: Exception raised preparing the device, if it failed
+    :returns: bool. True if the device was prepared
+    :raises: error, unless errors are ignored
+    """
+    if error is not None:
+        # OSDs created before the failure, on a device holding several,
+        # are live and stay recorded against it
+        registry.transition(dev, device_registry.FAILED,
+                            osd_ids=_created_osd_ids(cmds))
+        registry.db.flush()
+        lsblk_output = None
         try:
             lsblk_output = subprocess.check_output(
                 ['lsblk', '-P']).decode('UTF-8')
@@ -1502,14 +1811,129 @@ def osdize_dev(dev, osd_format, osd_journal, ignore_errors=False,
             log('Unable to initialize device: {}'.format(dev), ERROR)
             if lsblk_output:
                 log('lsblk output: {}'.format(lsblk_output), WARNING)
-            raise
+            raise error
+        return False
+
+    # NOTE: Devices are recorded as active or failed so that the charm
+    #       only tries to initialize a device for OSD usage once during
+    #       its lifetime.
+    registry.transition(dev, device_registry.ACTIVE,
+                        osd_ids=_created_osd_ids(cmds))
+    registry.db.flush()
+    return True
+
+
+def _created_osd_ids(cmds):
+    """Ids of the OSDs which the ceph-volume commands cmds have created.
+
+    :param cmds: list. Commands run to create the OSDs, or None
+    :returns: list. Ids of the OSDs found mounted, as ints
+    """
+    osd_ids = []
+    for cmd in cmds or []:
+        if '--osd-fsid' in cmd:
+            osd_ids.append(_osd_id_for_fsid(cmd[cmd.index('--osd-fsid') + 1]))
+    return [osd_id for osd_id in osd_ids if osd_id is not None]
+
+
+def _untagged_osd_volumes(vg_name):
+    """OSD data volumes in vg_name which ceph-volume has not taken into
+    use.
+
+    :returns: list. Names of the volumes
+    """
+    output = subprocess.check_output(
+        ['lvs', '--noheadings', '--options', 'lv_name,lv_tags',
+         '--select', 'vg_name={}'.format(vg_name)]).decode('UTF-8')
+    volumes = []
+    for line in output.splitlines():
+        fields = line.split()
+        if (fields and fields[0].startswith('osd-block-') and
+                'ceph.osd_id=' not in ''.join(fields[1:])):
+            volumes.append(fields[0])
+    return sorted(volumes)
+
+
+def _resume_prepare(registry, dev, state):
+    """Complete a device whose preparation was interrupted, or failed,
+    after ceph had already taken it into use.
 
-    # NOTE: Record processing of device only on success to ensure that
-    #       the charm only tries to initialize a device of OSD usage
-    #       once during its lifetime.
-    osd_devices.append(dev)
-    db.set('osd-devices', osd_devices)
-    db.flush()
+    Volumes allocated for OSDs which were never created, as when one of
+    several OSDs on a device failed, become OSDs now, and the ids of every
+    OSD on the device are recorded.
+    """
+    if state not in (device_registry.PREPARING, device_registry.FAILED):
+        return
+    vg_name, volumes = _pv_logical_volumes(dev)
+    error = None
+    if vg_name:
+        try:
+            for volume in _untagged_osd_volumes(vg_name):
+                log('Creating the OSD of {}/{}'.format(vg_name, volume))
+                subprocess.check_call(_ceph_volume(
+                    dev, [], config('osd-encrypt'), True,
+                    config('osd-encrypt-keymanager') or CEPH_KEY_MANAGER,
+                    volume[len('osd-block-'):],
+                    data='{}/{}'.format(vg_name, volume),
+                    crush_device_class=(config('osd-device-class') or
+                                        device_class(dev))))
+        except subprocess.CalledProcessError as e:
+            log('Unable to complete the OSDs of {}: {}'.format(dev, e),
+                level=ERROR)
+            error = e
+    osd_ids = []
+    for volume in sorted(volumes):
+        for prefix in ('osd-block-', 'osd-data-'):
+            if volume.startswith(prefix):
+                osd_ids.append(_osd_id_for_fsid(volume[len(prefix):]))
+    osd_ids = [osd_id for osd_id in osd_ids if osd_id is not None]
+    if error is None:
+        log('Recording {} as active after interrupted preparation'
+            .format(dev))
+        registry.transition(dev, device_registry.ACTIVE, osd_ids=osd_ids)
+    elif state == device_registry.PREPARING:
+        registry.transition(dev, device_registry.FAILED, osd_ids=osd_ids)
+    registry.db.flush()
+
+
+def get_ceph_volume_osds():
+    """Map the devices backing local ceph-volume OSDs to the OSD ids.
+
+    :returns: dict. Sorted list of the ids, as ints, of the OSDs whose
+              block volumes each physical volume holds, keyed by its
+              resolved path
+    :raises: CalledProcessError if ceph-volume fails
+    """
+    listing = json.loads(subprocess.check_output(
+        ['ceph-volume', 'lvm', 'list', '--format', 'json']).decode('UTF-8'))
+    osds = collections.defaultdict(list)
+    for osd_id, volumes in listing.items():
+        for volume in volumes:
+            if volume.get('type') != 'block':
+                continue
+            for device in volume.get('devices', []):
+                osds[os.path.realpath(device)].append(int(osd_id))
+    return dict((device, sorted(ids)) for device, ids in osds.items())
+
+
+def _osd_id_for_fsid(osd_fsid, osd_path=OSD_BASE_DIR):
+    """Find the id of the local OSD with the given fsid.
+
+    :param: osd_fsid: str. The fsid the OSD was created with
+    :param: osd_path: str. Directory holding the OSD data directories
+    :returns: int or None if no mounted OSD has the fsid
+    """
+    for fsid_file in glob.glob(os.path.join(osd_path, 'ceph-*', 'fsid')):
+        try:
+            with open(fsid_file) as f:
+                if f.read().strip() != osd_fsid:
+                    continue
+        except IOError:
+            continue
+        osd_id = os.path.basename(os.path.dirname(fsid_file))[len('ceph-'):]
+        if osd_id.isdigit():
+            return int(osd_id)
+    return None
 
 
 def _ceph_disk(dev, osd_format, osd_journal, encrypt=False, bluestore=False):
@@ -1558,7 +1982,8 @@ def _ceph_disk(dev, osd_format, osd_journal, encrypt=False, bluestore=False):
 
 
 def _ceph_volume(dev, osd_journal, encrypt=False, bluestore=False,
-                 key_manager=CEPH_KEY_MANAGER):
+                 key_manager=CEPH_KEY_MANAGER, osd_fsid=None, data=None,
+                 crush_device_class=None):
     """
     Prepare and activate a device for usage as a Ceph OSD using ceph-volume.
 
@@ -1570,6 +1995,11 @@ def _ceph_volume(dev, osd_journal, encrypt=False, bluestore=False,
     :param: encrypt: Use block device encryption
     :param: bluestore: Use bluestore storage for OSD
     :param: key_manager: dm-crypt Key Manager to use
+    :param: osd_fsid: UUID for the new OSD, generated if not provided
+    :param: data: Logical volume already allocated on dev for the OSD
+                  data, in 'vg_name/lv_name' format
+    :param: crush_device_class: CRUSH device class for the new OSD, left
+                                to Ceph if not provided
     :raises subprocess.CalledProcessError: in the event that any supporting
                                            LVM operation failed.
     :returns: list. 'ceph-volume' command and required parameters for
@@ -1577,7 +2007,7 @@ def _ceph_volume(dev, osd_journal, encrypt=False, bluestore=False,
     """
     cmd = ['ceph-volume', 'lvm', 'create']
 
-    osd_fsid = str(uuid.uuid4())
+    osd_fsid = osd_fsid or str(uuid.uuid4())
     cmd.append('--osd-fsid')
     cmd.append(osd_fsid)
 
@@ -1591,6 +2021,10 @@ def _ceph_volume(dev, osd_journal, encrypt=False, bluestore=False,
     if encrypt and key_manager == CEPH_KEY_MANAGER:
         cmd.append('--dmcrypt')
 
+    if crush_device_class:
+        cmd.append('--crush-device-class')
+        cmd.append(crush_device_class)
+
     # On-disk journal volume creation
     if not osd_journal and not bluestore:
         journal_lv_type = 'journal'
@@ -1605,11 +2039,22 @@ def _ceph_volume(dev, osd_journal, encrypt=False, bluestore=False,
         )
 
     cmd.append('--data')
-    cmd.append(_allocate_logical_volume(dev=dev,
-                                        lv_type=main_device_type,
-                                        osd_fsid=osd_fsid,
-                                        encrypt=encrypt,
-                                        key_manager=key_manager))
+    cache_devices = get_devices('osd-cache-devices') if bluestore else None
+    if data:
+        cmd.append(data)
+    elif cache_devices and is_rotational(dev):
+        cmd.append(_allocate_cached_volume(dev=dev,
+                                           lv_type=main_device_type,
+                                           osd_fsid=osd_fsid,
+                                           cache_devices=cache_devices,
+                                           encrypt=encrypt,
+                                           key_manager=key_manager))
+    else:
+        cmd.append(_allocate_logical_volume(dev=dev,
+                                            lv_type=main_device_type,
+                                            osd_fsid=osd_fsid,
+                                            encrypt=encrypt,
+                                            key_manager=key_manager))
 
     if bluestore:
         for extra_volume in ('wal', 'db'):
@@ -1645,6 +2090,65 @@ def _ceph_volume(dev, osd_journal, encrypt=False, bluestore=False,
     return cmd
 
 
+def osds_per_device(dev, bluestore=True):
+    """Number of OSDs to create on dev.
+
+    Only non-rotational devices prepared for BlueStore are split, as one
+    OSD cannot saturate a fast flash device.
+
+    :param dev: str. Path to the data device
+    :param bluestore: bool. Whether BlueStore OSDs are being created
+    :returns: int
+    """
+    count = config('osds-per-device') or 1
+    if count > 1 and bluestore and is_rotational(dev) is False:
+        return count
+    return 1
+
+
+def _ceph_volume_split(dev, count, encrypt=False,
+                       key_manager=CEPH_KEY_MANAGER, osd_fsid=None,
+                       crush_device_class=None):
+    """
+    Prepare count BlueStore OSDs on equal shares of a device using
+    ceph-volume.
+
+    The device holds one volume group, named after the first OSD, with a
+    logical volume for each OSD.
+
+    :param: dev: Full path to the device to split
+    :param: count: Number of OSDs to create
+    :param: encrypt: Use block device encryption
+    :param: key_manager: dm-crypt Key Manager to use
+    :param: osd_fsid: UUID for the first OSD, generated if not provided
+    :param: crush_device_class: CRUSH device class for the new OSDs, left
+                                to Ceph if not provided
+    :raises subprocess.CalledProcessError: in the event that any supporting
+                                           LVM operation failed.
+    :returns: list. 'ceph-volume' commands, one per OSD
+    """
+    osd_fsids = [osd_fsid or str(uuid.uuid4())]
+    osd_fsids.extend(str(uuid.uuid4()) for _ in range(count - 1))
+    pv_dev = _initialize_disk(dev, osd_fsids[0], encrypt, key_manager)
+    if not lvm.is_lvm_physical_volume(pv_dev):
+        lvm.create_lvm_physical_volume(pv_dev)
+        vg_name = 'ceph-{}'.format(osd_fsids[0])
+        lvm.create_lvm_volume_group(vg_name, pv_dev)
+    else:
+        vg_name = lvm.list_lvm_volume_group(pv_dev)
+
+    cmds = []
+    for fsid in osd_fsids:
+        lv_name = 'osd-block-{}'.format(fsid)
+        subprocess.check_call(['lvcreate', '--yes',
+                               '-l', '{}%VG'.format(100 // count),
+                               '-n', lv_name, vg_name])
+        cmds.append(_ceph_volume(dev, [], encrypt, True, key_manager, fsid,
+                                 data='{}/{}'.format(vg_name, lv_name),
+                                 crush_device_class=crush_device_class))
+    return cmds
+
+
 def _partition_name(dev):
     """
     Derive the first partition name for a block device
@@ -1669,19 +2173,49 @@ def is_active_bluestore_device(dev):
     if not lvm.is_lvm_physical_volume(dev):
         return False
 
-    vg_name = lvm.list_lvm_volume_group(dev)
-    lv_name = lvm.list_logical_volumes('vg_name={}'.format(vg_name))[0]
+    # only the volumes on dev itself; its volume group may also hold the
+    # volumes of other devices, such as those sharing a flash cache
+    _, lv_names = _pv_logical_volumes(dev)
 
     block_symlinks = glob.glob('/var/lib/ceph/osd/ceph-*/block')
     for block_candidate in block_symlinks:
         if os.path.islink(block_candidate):
             target = os.readlink(block_candidate)
-            if target.endswith(lv_name):
+            if any(target.endswith('/' + lv_name) for lv_name in lv_names):
                 return True
 
     return False
 
 
+def _pv_logical_volumes(pv):
+    """Find the logical volumes with extents on a physical volume.
+
+    Hidden sub-volumes, such as the origin of a cached volume, are reported
+    as the volume they belong to.
+
+    :param pv: str. Path to the physical volume
+    :returns: tuple. Name of its volume group, or None, and the set of the
+              names of the volumes
+    """
+    try:
+        output = subprocess.check_output(
+            ['pvs', '--noheadings', '--options', 'vg_name,lv_name',
+             pv]).decode('UTF-8')
+    except subprocess.CalledProcessError:
+        return None, set()
+    vg_name = None
+    volumes = set()
+    for line in output.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        vg_name = fields[0]
+        if len(fields) > 1:
+            # segments of hidden sub-volumes, e.g. [osd-block-<id>_corig]
+            volumes.add(re.sub(r'_w?corig$', '', fields[1].strip('[]')))
+    return vg_name, volumes
+
+
 def is_luks_device(dev):
     """
     Determine if dev is a LUKS-formatted block device.
@@ -1707,6 +2241,110 @@ def is_mapped_luks_device(dev):
     return is_held and is_luks_device(dev)
 
 
+def _dm_open_counts():
+    """Return the open count of every device-mapper device, keyed by name.
+
+    :returns: dict. Number of openers of each mapping; empty if dmsetup
+              is unavailable
+    """
+    try:
+        out = subprocess.check_output(
+            ['dmsetup', 'info', '-c', '--noheadings', '--separator', ':',
+             '-o', 'name,open']).decode('UTF-8')
+    except (subprocess.CalledProcessError, OSError):
+        return {}
+    counts = {}
+    for line in out.splitlines():
+        name, _, count = line.strip().rpartition(':')
+        if name and count.isdigit():
+            counts[name] = int(count)
+    return counts
+
+
+def block_device_inventory(devices):
+    """Describe the block devices and everything stacked on them.
+
+    Every device is covered by one lsblk and one dmsetup call, rather than
+    the LVM and cryptsetup queries is_active_bluestore_device and
+    is_mapped_luks_device issue for each device.
+
+    :param devices: list. Paths of block devices
+    :returns: dict. For each path: 'mounted' and 'in-use' (backs an OSD or
+              has an open device-mapper mapping stacked on it),
+              'mappings' (names of the device-mapper devices stacked on it,
+              topmost first), 'fstype' and 'discard' (supports discard)
+    :raises: CalledProcessError if lsblk fails
+    """
+    out = subprocess.check_output(
+        ['lsblk', '--json', '--bytes',
+         '-o', 'NAME,KNAME,TYPE,FSTYPE,MOUNTPOINT,DISC-MAX'] +
+        list(devices)).decode('UTF-8')
+    trees = dict((node['kname'], node)
+                 for node in json.loads(out)['blockdevices'])
+    osd_blocks = set(
+        os.path.basename(os.path.realpath(link))
+        for link in glob.glob(os.path.join(OSD_BASE_DIR, 'ceph-*', 'block*')))
+    open_counts = None
+
+    inventory = {}
+    for dev in devices:
+        root = trees.get(os.path.basename(os.path.realpath(dev)))
+        if root is None:
+            continue
+        nodes = []
+        pending = [root]
+        while pending:
+            node = pending.pop()
+            nodes.append(node)
+            pending.extend(node.get('children') or [])
+        mappings = [node['name'] for node in reversed(nodes[1:])
+                    if node['kname'].startswith('dm-')]
+        leaves = [node['name'] for node in nodes[1:]
+                  if node['kname'].startswith('dm-') and
+                  not node.get('children')]
+        if leaves and open_counts is None:
+            open_counts = _dm_open_counts()
+        inventory[dev] = {
+            'mounted': any(node.get('mountpoint') for node in nodes),
+            'in-use': (any(node['kname'] in osd_blocks for node in nodes) or
+                       any((open_counts or {}).get(name) for name in leaves)),
+            'mappings': mappings,
+            'fstype': root.get('fstype'),
+            'discard': int(root.get('disc-max') or 0) > 0,
+        }
+    return inventory
+
+
+def wipe_block_device(dev, mappings=(), fstype=None, discard=False):
+    """Remove stale mappings from a device and wipe it for reuse.
+
+    :param dev: str. Path of the block device
+    :param mappings: list. Device-mapper devices stacked on dev, topmost
+                     first, as returned by block_device_inventory
+    :param fstype: str. Signature found on dev by block_device_inventory
+    :param discard: bool. Discard every block of the device first
+    :raises: CalledProcessError if a mapping cannot be removed or the
+             device cannot be wiped
+    """
+    if fstype in ('LVM2_member', 'crypto_LUKS'):
+        for pv in [dev] + ['/dev/mapper/{}'.format(name)
+                           for name in mappings
+                           if name.startswith('crypt-')]:
+            _release_hybrid_volumes(pv)
+    for name in mappings:
+        if not os.path.exists('/dev/mapper/{}'.format(name)):
+            # removed along with a cached volume
+            continue
+        log('Removing {} from {}'.format(name, dev), level=DEBUG)
+        subprocess.check_call(['dmsetup', 'remove', '--retry', name])
+    if fstype == 'LVM2_member':
+        # drop the PV, and the VG if this was its only PV, from LVM metadata
+        subprocess.call(['pvremove', '-ff', '-y', dev])
+    if discard:
+        subprocess.check_call(['blkdiscard', dev])
+    zap_disk(dev)
+
+
 def get_conf(variable):
     """
     Get the value of the given configuration variable from the
@@ -1801,20 +2439,173 @@ def _initialize_disk(dev, dev_uuid, encrypt=False,
         if luks_uuid:
             return '/dev/mapper/crypt-{}'.format(luks_uuid)
 
-    dm_crypt = '/dev/mapper/crypt-{}'.format(dev_uuid)
+    if use_vaultlocker:
+        return _vaultlocker_encrypt(dev, dev_uuid)
+    else:
+        return dev
 
-    if use_vaultlocker and not os.path.exists(dm_crypt):
+
+def _vaultlocker_encrypt(dev, dev_uuid):
+    """Encrypt dev with vaultlocker, unless already mapped.
+
+    :param dev: str. Path to block device to encrypt
+    :param dev_uuid: str. UUID to use for the dm-crypt mapping
+    :returns: str. Path to the dm-crypt mapping
+    :raises subprocess.CalledProcessError: if vaultlocker fails
+    """
+    dm_crypt = '/dev/mapper/crypt-{}'.format(dev_uuid)
+    if not os.path.exists(dm_crypt):
         subprocess.check_call([
             'vaultlocker',
             'encrypt',
             '--uuid', dev_uuid,
             dev,
         ])
+    return dm_crypt
 
-    if use_vaultlocker:
-        return dm_crypt
-    else:
-        return dev
+
+def _encrypt_disk(dev, osd_fsid):
+    """Encrypt an OSD data device with vaultlocker ahead of creating the
+    OSD, which then finds and uses the LUKS volume.
+
+    :param dev: str. Path to block device to encrypt
+    :param osd_fsid: str. UUID of the OSD to be created on dev
+    :returns: str. Path to the dm-crypt mapping
+    :raises subprocess.CalledProcessError: if vaultlocker fails
+    """
+    luks_uuid = _luks_uuid(dev)
+    if luks_uuid:
+        return '/dev/mapper/crypt-{}'.format(luks_uuid)
+    return _vaultlocker_encrypt(dev, osd_fsid)
+
+
+# dm-crypt options which process I/O in the submitting context rather than
+# handing it to kcryptd workqueues, available from kernel 5.9
+DM_CRYPT_WORKQUEUE_OPTIONS = ('no_read_workqueue', 'no_write_workqueue')
+DM_CRYPT_WORKQUEUE_VERSION = (1, 22, 0)
+# cryptsetup release which can set the options on an active mapping
+CRYPTSETUP_WORKQUEUE_VERSION = (2, 3, 4)
+
+
+@cached
+def dm_target_version(target):
+    """Return the version of a device-mapper target.
+
+    :param target: str. Name of the target, e.g. 'crypt'
+    :returns: tuple. Version as ints, or None if the target is not loaded
+    """
+    try:
+        output = subprocess.check_output(
+            ['dmsetup', 'targets']).decode('UTF-8')
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0] == target:
+            return tuple(int(v) for v in fields[1].lstrip('v').split('.'))
+    return None
+
+
+@cached
+def cryptsetup_version():
+    """Return the version of cryptsetup.
+
+    :returns: tuple. Version as ints, or None if cryptsetup is missing
+    """
+    try:
+        output = subprocess.check_output(
+            ['cryptsetup', '--version']).decode('UTF-8')
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    fields = output.split()
+    if len(fields) < 2:
+        return None
+    try:
+        return tuple(int(v) for v in fields[1].split('.'))
+    except ValueError:
+        return None
+
+
+def _refresh_dm_crypt_device(name):
+    """Set the workqueue options of a LUKS2 mapping with cryptsetup.
+
+    The options are also stored in the LUKS2 header, so they apply each
+    time the device is opened from then on.
+
+    :param name: str. Device-mapper name of the mapping
+    :returns: bool. True if the options were set
+    """
+    version = cryptsetup_version()
+    if version is None or version < CRYPTSETUP_WORKQUEUE_VERSION:
+        log('cryptsetup {} cannot bypass the workqueues of {}'
+            .format(version, name), level=DEBUG)
+        return False
+    try:
+        subprocess.check_call(
+            ['cryptsetup', 'refresh', '--perf-no_read_workqueue',
+             '--perf-no_write_workqueue', '--persistent', name],
+            stdin=subprocess.DEVNULL)
+    except subprocess.CalledProcessError as e:
+        log('Unable to bypass the dm-crypt workqueues of {}: {}'
+            .format(name, e), level=WARNING)
+        return False
+    return True
+
+
+def tune_dm_crypt_devices(prefix='crypt-'):
+    """Bypass the dm-crypt workqueues of the mapped devices named with
+    prefix.
+
+    The live table of each device is reloaded with the workqueue options
+    added; the tables hold the volume keys, so they are passed to dmsetup
+    on stdin and never logged. LUKS2 mappings whose table refers to a key
+    in the kernel keyring cannot be reloaded, as cryptsetup unlinks the key
+    once the device is open, so they are refreshed with cryptsetup
+    instead.
+
+    :param prefix: str. Prefix of the device-mapper names to tune
+    :returns: list. Names of the devices tuned by this call
+    :raises subprocess.CalledProcessError: if dmsetup fails
+    """
+    version = dm_target_version('crypt')
+    if version is None or version < DM_CRYPT_WORKQUEUE_VERSION:
+        log('dm-crypt target {} does not support bypassing workqueues'
+            .format(version), level=DEBUG)
+        return []
+    output = subprocess.check_output(
+        ['dmsetup', 'table', '--target', 'crypt',
+         '--showkeys']).decode('UTF-8')
+    tuned = []
+    for line in output.splitlines():
+        name, _, table = line.partition(': ')
+        fields = table.split()
+        if not name.startswith(prefix) or len(fields) < 8:
+            continue
+        # <start> <length> crypt <cipher> <key> <iv_offset> <device>
+        # <offset> [<#opt_params> <opt_params>]
+        options = fields[9:9 + int(fields[8])] if len(fields) > 8 else []
+        missing = [option for option in DM_CRYPT_WORKQUEUE_OPTIONS
+                   if option not in options]
+        if not missing:
+            continue
+        if fields[4].startswith(':'):
+            # :<key_size>:<key_type>:<key_description>
+            if _refresh_dm_crypt_device(name):
+                log('Bypassing dm-crypt workqueues of {}'.format(name))
+                tuned.append(name)
+            continue
+        options.extend(missing)
+        table = ' '.join(fields[:8] + [str(len(options))] + options)
+        reload_cmd = subprocess.Popen(['dmsetup', 'reload', name],
+                                      stdin=subprocess.PIPE)
+        reload_cmd.communicate(table.encode('UTF-8'))
+        if reload_cmd.returncode:
+            raise subprocess.CalledProcessError(
+                reload_cmd.returncode, ['dmsetup', 'reload', name])
+        subprocess.check_call(['dmsetup', 'resume', name])
+        log('Bypassing dm-crypt workqueues of {}'.format(name))
+        tuned.append(name)
+    return tuned
 
 
 def _allocate_logical_volume(dev, lv_type, osd_fsid,
@@ -1865,6 +2656,221 @@ def _allocate_logical_volume(dev, lv_type, osd_fsid,
     return "{}/{}".format(vg_name, lv_name)
 
 
+def is_rotational(dev, sys_block='/sys/class/block'):
+    """Whether the kernel reports dev as a rotational device.
+
+    :param dev: str. Path to a whole block device
+    :returns: bool, or None if unknown
+    """
+    name = os.path.basename(os.path.realpath(dev))
+    try:
+        with open(os.path.join(sys_block, name, 'queue',
+                               'rotational')) as f:
+            return f.read().strip() == '1'
+    except (IOError, OSError):
+        return None
+
+
+DEVICE_CLASSES = ('hdd', 'ssd', 'nvme')
+
+
+def device_class(dev, sys_block='/sys/class/block'):
+    """CRUSH device class of dev, worked out from sysfs.
+
+    NVMe namespaces, and devices whose controller reports an NVMe
+    transport, are 'nvme'; other non-rotational devices are 'ssd' and
+    rotational ones 'hdd'.
+
+    :param dev: str. Path to a whole block device
+    :returns: str. One of DEVICE_CLASSES, or None if unknown
+    """
+    name = os.path.basename(os.path.realpath(dev))
+    if name.startswith('nvme'):
+        return 'nvme'
+    try:
+        with open(os.path.join(sys_block, name, 'device',
+                               'transport')) as f:
+            if f.read().strip().startswith(('pcie', 'rdma', 'tcp', 'fc')):
+                return 'nvme'
+    except (IOError, OSError):
+        pass
+    rotational = is_rotational(dev, sys_block)
+    if rotational is None:
+        return None
+    return 'hdd' if rotational else 'ssd'
+
+
+def block_device_size(dev, sys_block='/sys/class/block'):
+    """Size of a block device in bytes, or 0 if unknown."""
+    name = os.path.basename(os.path.realpath(dev))
+    try:
+        with open(os.path.join(sys_block, name, 'size')) as f:
+            return int(f.read().strip()) * 512
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def _pv_free(pv):
+    """Unallocated bytes of an LVM physical volume."""
+    return int(subprocess.check_output(
+        ['pvs', '--noheadings', '--units', 'b', '--nosuffix',
+         '--options', 'pv_free', pv]).decode('UTF-8').strip() or 0)
+
+
+def _cache_size(dev, cache_pv, cache_devices):
+    """Size in bytes of the cache for data device dev.
+
+    The cache devices are shared between the rotational OSD devices in
+    proportion to their capacity, leaving room for cache metadata.
+
+    :param dev: str. Path to the data device being cached
+    :param cache_pv: str. The physical volume the cache is allocated from
+    :param cache_devices: set. Every configured cache device
+    :returns: int. Size in bytes
+    """
+    data_devices = set(d for d in get_devices('osd-devices')
+                       if is_rotational(d))
+    data_devices.add(dev)
+    data_size = sum(block_device_size(d) for d in data_devices)
+    cache_size = sum(block_device_size(d) for d in cache_devices)
+    share = cache_size * block_device_size(dev) // max(data_size, 1)
+    share = int(share * (1 - CACHE_METADATA_RESERVE))
+    return min(share, int(_pv_free(cache_pv) * (1 - CACHE_METADATA_RESERVE)))
+
+
+def _allocate_cached_volume(dev, lv_type, osd_fsid, cache_devices,
+                            encrypt=False, key_manager=CEPH_KEY_MANAGER):
+    """
+    Allocate a logical volume on a rotational device, cached by an LV on
+    the least used of the cache devices.
+
+    lvmcache needs the cache and the cached volume in the same volume
+    group, so each cache device holds a volume group which the data
+    devices it caches are added to.
+
+    :param: dev: path to the rotational data device
+    :param: lv_type: logical volume type to create (block)
+    :param: osd_fsid: UUID of the OSD associated with the LV
+    :param: cache_devices: set of paths to the flash cache devices
+    :param: encrypt: Encrypt OSD devices using dm-crypt
+    :param: key_manager: dm-crypt Key Manager to use
+    :raises subprocess.CalledProcessError: in the event that any supporting
+                                           LVM operation fails.
+    :raises ValueError: if osd-cache-mode is invalid
+    :returns: str: String in the format 'vg_name/lv_name'.
+    """
+    mode = config('osd-cache-mode') or 'writeback'
+    if mode not in CACHE_MODES:
+        raise ValueError('Unsupported cache mode: {}'.format(mode))
+
+    cache_dev = find_least_used_utility_device(cache_devices, lvs=True)
+    cache_pv = _initialize_disk(cache_dev, str(uuid.uuid4()), encrypt,
+                                key_manager)
+    if not lvm.is_lvm_physical_volume(cache_pv):
+        lvm.create_lvm_physical_volume(cache_pv)
+        vg_name = '{}{}'.format(HYBRID_VG_PREFIX, uuid.uuid4())
+        lvm.create_lvm_volume_group(vg_name, cache_pv)
+    else:
+        vg_name = lvm.list_lvm_volume_group(cache_pv)
+
+    data_pv = _initialize_disk(dev, osd_fsid, encrypt, key_manager)
+    if not lvm.is_lvm_physical_volume(data_pv):
+        lvm.create_lvm_physical_volume(data_pv)
+    if lvm.list_lvm_volume_group(data_pv) != vg_name:
+        _remove_missing_pvs(vg_name)
+        subprocess.check_call(['vgextend', vg_name, data_pv])
+
+    lv_name = 'osd-{}-{}'.format(lv_type, osd_fsid)
+    if lv_name in lvm.list_logical_volumes('vg_name={}'.format(vg_name)):
+        return '{}/{}'.format(vg_name, lv_name)
+
+    subprocess.check_call(['lvcreate', '--yes', '-l', '100%PVS',
+                           '-n', lv_name, vg_name, data_pv])
+    cache_lv = 'osd-cache-{}'.format(osd_fsid)
+    # whole 4MiB extents
+    cache_size = '{}m'.format(
+        _cache_size(dev, cache_pv, cache_devices) // 1048576 // 4 * 4)
+    if mode == 'writecache':
+        subprocess.check_call(['lvcreate', '--yes', '-L', cache_size,
+                               '-n', cache_lv, vg_name, cache_pv])
+        subprocess.check_call(['lvconvert', '--yes', '--type', 'writecache',
+                               '--cachevol', cache_lv,
+                               '{}/{}'.format(vg_name, lv_name)])
+    else:
+        subprocess.check_call(['lvcreate', '--yes', '--type', 'cache-pool',
+                               '-L', cache_size, '-n', cache_lv, vg_name,
+                               cache_pv])
+        subprocess.check_call([
+            'lvconvert', '--yes', '--type', 'cache',
+            '--cachepool', '{}/{}'.format(vg_name, cache_lv),
+            '--cachemode', mode,
+            '--cachepolicy', config('osd-cache-policy') or 'smq',
+            '{}/{}'.format(vg_name, lv_name)])
+    log('Cached {} on {} ({}, {})'.format(dev, cache_dev, mode, cache_size))
+    return '{}/{}'.format(vg_name, lv_name)
+
+
+def _remove_missing_pvs(vg_name):
+    """Drop the physical volumes of failed devices from a shared cache
+    volume group.
+
+    LVM refuses to change a volume group while any of its physical volumes
+    is missing, which would stop every other device on the cache device
+    from being added or removed. The volumes of the missing device, and
+    their caches, are removed with it, releasing their cache space.
+
+    :param vg_name: str. Name of the volume group
+    """
+    try:
+        missing = int(subprocess.check_output(
+            ['vgs', '--noheadings', '--options', 'vg_missing_pv_count',
+             vg_name]).decode('UTF-8').strip() or 0)
+    except (subprocess.CalledProcessError, ValueError):
+        return
+    if missing:
+        log('Removing {} missing devices and their volumes from {}'
+            .format(missing, vg_name), level=WARNING)
+        subprocess.check_call(['vgreduce', '--removemissing', '--force',
+                               vg_name])
+
+
+def _hybrid_volume_groups():
+    """Names of the shared cache volume groups on this unit."""
+    try:
+        output = subprocess.check_output(
+            ['vgs', '--noheadings', '--options', 'vg_name']).decode('UTF-8')
+    except subprocess.CalledProcessError:
+        return []
+    return [name for name in output.split()
+            if name.startswith(HYBRID_VG_PREFIX)]
+
+
+def _release_hybrid_volumes(pv):
+    """Remove the logical volumes on pv from a shared cache volume group,
+    together with their caches, and drop pv from the group.
+
+    Devices which have failed are dropped from every shared group as
+    well, as the device zapped may be the replacement of one of them.
+
+    :param pv: str. Path to the physical volume of a data device
+    """
+    for group in _hybrid_volume_groups():
+        try:
+            _remove_missing_pvs(group)
+        except subprocess.CalledProcessError as e:
+            log('Unable to remove missing devices from {}: {}'
+                .format(group, e), level=WARNING)
+    vg_name, volumes = _pv_logical_volumes(pv)
+    if vg_name is None or not vg_name.startswith(HYBRID_VG_PREFIX):
+        return
+    for volume in sorted(volumes):
+        log('Removing {}/{} from {}'.format(vg_name, volume, pv),
+            level=DEBUG)
+        subprocess.call(['lvremove', '--yes',
+                         '{}/{}'.format(vg_name, volume)])
+    subprocess.call(['vgreduce', vg_name, pv])
+
+
 def osdize_dir(path, encrypt=False, bluestore=False):
     """Ask ceph-disk to prepare a directory to become an osd.
 
@@ -1956,6 +2962,11 @@ def wait_for_all_monitors_to_upgrade(new_version, upgrade_key):
     :param new_version: str of the version to watch
     :param upgrade_key: the cephx key name to use
     """
+    from charmhelpers.contrib.storage.linux.ceph import (
+        get_mon_map,
+        monitor_key_exists,
+    )
+
     done = False
     start_time = time.time()
     monitor_list = []
@@ -1991,6 +3002,8 @@ def roll_monitor_cluster(new_version, upgrade_key):
     :param new_version: str of the version to upgrade to
     :param upgrade_key: the cephx key name to use when upgrading
     """
+    from charmhelpers.contrib.storage.linux.ceph import get_mon_map
+
     log('roll_monitor_cluster called with {}'.format(new_version))
     my_name = socket.gethostname()
     monitor_list = []
@@ -2108,6 +3121,8 @@ def lock_and_roll(upgrade_key, service, my_name, version):
     :param my_name: str. The current hostname
     :param version: str. The version we are upgrading to
     """
+    from charmhelpers.contrib.storage.linux.ceph import monitor_key_set
+
     start_timestamp = time.time()
 
     log('monitor_key_set {}_{}_{}_start {}'.format(
@@ -2152,6 +3167,11 @@ def wait_on_previous_node(upgrade_key, service, previous_node, version):
     :param version: str. The version we are upgrading to
     :returns: None
     """
+    from charmhelpers.contrib.storage.linux.ceph import (
+        monitor_key_exists,
+        monitor_key_get,
+    )
+
     log("Previous node is: {}".format(previous_node))
 
     previous_node_finished = monitor_key_exists(
@@ -2298,7 +3318,11 @@ def upgrade_osd(new_version):
         if not dirs_need_ownership_update('osd'):
             log('Restarting all OSDs to load new binaries', DEBUG)
             if systemd():
-                service_restart('ceph-osd.target')
+                # Stopping the target stops every OSD; starting them in
+                # waves avoids peering every OSD of the host at once
+                service_stop('ceph-osd.target')
+                start_osds_staggered(get_local_osd_ids())
+                service_start('ceph-osd.target')
             else:
                 service_restart('ceph-osd-all')
             return
@@ -2374,6 +3398,179 @@ def start_osd(osd_num):
         service_start('ceph-osd', id=osd_num)
 
 
+def get_osds_up(osd_ids):
+    """Return which of osd_ids are marked up in the OSD map.
+
+    The OSD map is read with the osd-upgrade key; if that fails the
+    admin socket of each local daemon is asked for its state instead.
+
+    :param osd_ids: list. OSD ids to check
+    :returns: set. The ids, as str, of the OSDs which are up
+    """
+    osd_ids = set(str(osd_id) for osd_id in osd_ids)
+    try:
+        dump = json.loads(subprocess.check_output(
+            ['ceph', '--id', 'osd-upgrade', 'osd', 'dump',
+             '--format=json']).decode('UTF-8'))
+        return set(str(osd['osd']) for osd in dump['osds']
+                   if osd['up'] and str(osd['osd']) in osd_ids)
+    except (subprocess.CalledProcessError, ValueError, KeyError) as e:
+        log('Unable to read the OSD map, asking the OSDs: {}'.format(e),
+            level=DEBUG)
+    up = set()
+    for osd_id in osd_ids:
+        try:
+            status = json.loads(subprocess.check_output(
+                ['ceph', 'daemon', 'osd.{}'.format(osd_id), 'status'],
+                stderr=subprocess.STDOUT).decode('UTF-8'))
+        except (subprocess.CalledProcessError, ValueError):
+            continue
+        if status.get('state') == 'active':
+            up.add(osd_id)
+    return up
+
+
+def wait_for_osds_up(osd_ids, timeout=OSD_START_WAVE_TIMEOUT, since=None,
+                     timings=None):
+    """Wait until every one of osd_ids is up, or timeout passes.
+
+    :param osd_ids: list. OSD ids to wait for
+    :param timeout: int. Maximum seconds to wait
+    :param since: float. Time the OSDs were started, defaults to now
+    :param timings: dict. If given, the seconds from since until each OSD
+                    was seen up are stored in it keyed by OSD id
+    :returns: set. The ids, as str, of the OSDs still down
+    """
+    pending = set(str(osd_id) for osd_id in osd_ids)
+    now = time.time()
+    since = now if since is None else since
+    deadline = now + timeout
+    while pending:
+        up = get_osds_up(pending)
+        if timings is not None:
+            for osd_id in up:
+                timings[osd_id] = time.time() - since
+        pending -= up
+        remaining = deadline - time.time()
+        if not pending or remaining <= 0:
+            break
+        time.sleep(min(OSD_UP_POLL_INTERVAL, remaining))
+    return pending
+
+
+def start_osds_staggered(osd_ids, wave_size=None, timeout=None,
+                         timings=None):
+    """Start OSDs in waves, waiting for each wave to come up before
+    starting the next.
+
+    Starting every OSD of a host at once makes them all peer, replay their
+    journals and size their caches together, which shows up as memory
+    pressure on the host and slow requests across the cluster.
+
+    :param osd_ids: list. OSD ids to start
+    :param wave_size: int. OSDs to start at a time, defaults to the
+                      osd-start-wave-size option
+    :param timeout: int. Seconds to wait for a wave to come up, defaults to
+                    the osd-start-wave-timeout option
+    :param timings: dict. If given, the seconds each OSD took to come up
+                    are stored in it keyed by OSD id
+    :returns: set. The ids, as str, of OSDs which did not come up in time
+    """
+    if wave_size is None:
+        wave_size = config('osd-start-wave-size') or OSD_START_WAVE_SIZE
+    if timeout is None:
+        timeout = config('osd-start-wave-timeout') or OSD_START_WAVE_TIMEOUT
+    osd_ids = sorted(set(str(osd_id) for osd_id in osd_ids), key=int)
+    down = set()
+    for start in range(0, len(osd_ids), wave_size):
+        wave = osd_ids[start:start + wave_size]
+        log('Starting OSDs {}'.format(', '.join(wave)), level=DEBUG)
+        since = time.time()
+        for osd_id in wave:
+            start_osd(osd_id)
+        pending = wait_for_osds_up(wave, timeout, since, timings)
+        if pending:
+            log('OSDs {} not up after {}s, continuing'
+                .format(', '.join(sorted(pending, key=int)), timeout),
+                level=WARNING)
+            down |= pending
+    return down
+
+
+def stop_osds_parallel(osd_ids, parallel=OSD_START_WAVE_SIZE):
+    """Stop OSDs, up to parallel of them at a time.
+
+    :param osd_ids: list. OSD ids to stop
+    :param parallel: int. Maximum number of OSDs stopping at once
+    :returns: dict. Seconds each OSD took to stop, keyed by OSD id
+    :raises: The first error raised stopping an OSD, once all have been
+             attempted
+    """
+    timings = {}
+    errors = []
+    for osd_id, seconds, error in _run_parallel(
+            stop_osd, [str(osd_id) for osd_id in osd_ids],
+            parallel or OSD_START_WAVE_SIZE):
+        if error is not None:
+            log('Failed to stop osd.{}: {}'.format(osd_id, error),
+                level=ERROR)
+            errors.append(error)
+        else:
+            timings[osd_id] = seconds
+    if errors:
+        raise errors[0]
+    return timings
+
+
+def mark_osds(osd_ids, state):
+    """Mark OSDs in or out with a single mon command.
+
+    :param osd_ids: list. OSD ids to mark
+    :param state: str. 'in' or 'out'
+    :raises: CalledProcessError if the ceph command fails
+    """
+    if osd_ids:
+        subprocess.check_call(
+            ['ceph', '--id', 'osd-upgrade', 'osd', state] +
+            [str(osd_id) for osd_id in osd_ids])
+
+
+def set_maintenance_flags(unset=False, flags=None):
+    """Set or unset MAINTENANCE_FLAGS for the OSDs of this host.
+
+    From Mimic only noout is set, on the host's CRUSH bucket, so that
+    hosts under maintenance at the same time do not clear each other's
+    flags; earlier releases set all of them for the whole cluster.
+
+    :param unset: bool. Whether to unset rather than set the flags
+    :param flags: dict. The flags to unset, as returned when they were set
+    :returns: dict. The CRUSH 'host' bucket, the 'group' flags set on it
+              and the 'cluster' flags set for the whole cluster
+    :raises: CalledProcessError if a ceph command fails
+    """
+    cmd = ['ceph', '--id', 'osd-upgrade', 'osd']
+    if unset:
+        flags = flags or {}
+        host = flags.get('host')
+        group = flags.get('group', [])
+        cluster = flags.get('cluster',
+                            [] if host else list(MAINTENANCE_FLAGS))
+    elif cmp_pkgrevno('ceph', '13.0.0') >= 0:
+        host = socket.gethostname()
+        group = list(GROUP_MAINTENANCE_FLAGS)
+        cluster = []
+    else:
+        host = None
+        group = []
+        cluster = list(MAINTENANCE_FLAGS)
+    if host and group:
+        subprocess.check_call(cmd + [
+            'unset-group' if unset else 'set-group', ','.join(group), host])
+    for flag in cluster:
+        subprocess.check_call(cmd + ['unset' if unset else 'set', flag])
+    return {'host': host, 'group': group, 'cluster': cluster}
+
+
 def disable_osd(osd_num):
     """Disables the specified OSD number.
 
@@ -2559,6 +3756,10 @@ def resolve_ceph_version(source):
     @param: source: source configuration option of charm
     :returns: ceph release codename or None if not resolvable
     """
+    from charmhelpers.contrib.openstack.utils import (
+        get_os_codename_install_source,
+    )
+
     os_release = get_os_codename_install_source(source)
     return UCA_CODENAME_MAP.get(os_release)
 
@@ -2613,19 +3814,24 @@ def get_ceph_health():
         raise
 
 
-def reweight_osd(osd_num, new_weight):
+def reweight_osd(osd_num, new_weight, service=None):
     """Changes the crush weight of an OSD to the value specified.
 
     :param osd_num: the osd id which should be changed
     :param new_weight: the new weight for the OSD
+    :param service: the cephx id to run the command as, the default if None
     :returns: bool. True if output looks right, else false.
     :raises CalledProcessError: if an error occurs invoking the systemd cmd
     """
+    cmd = ['ceph']
+    if service:
+        cmd.extend(['--id', service])
     try:
         cmd_result = str(subprocess
-                         .check_output(['ceph', 'osd', 'crush',
-                                        'reweight', "osd.{}".format(osd_num),
-                                        new_weight],
+                         .check_output(cmd + ['osd', 'crush',
+                                              'reweight',
+                                              "osd.{}".format(osd_num),
+                                              new_weight],
                                        stderr=subprocess.STDOUT)
                          .decode('UTF-8'))
         expected_result = "reweighted item id {ID} name \'osd.{ID}\'".format(
@@ -2640,6 +3846,36 @@ def reweight_osd(osd_num, new_weight):
         raise
 
 
+def set_primary_affinity(osd_num, affinity):
+    """Changes the primary affinity of an OSD to the value specified.
+
+    :param osd_num: the osd id which should be changed
+    :param affinity: the new primary affinity, between 0 and 1
+    :returns: bool. True if output looks right, else false.
+    :raises CalledProcessError: if an error occurs invoking the ceph cmd
+    """
+    # formatted as ceph echoes it back, e.g. 1 rather than 1.0
+    affinity = '{:g}'.format(affinity)
+    try:
+        cmd_result = str(subprocess
+                         .check_output(['ceph', '--id', 'osd-upgrade',
+                                        'osd', 'primary-affinity',
+                                        "osd.{}".format(osd_num),
+                                        affinity],
+                                       stderr=subprocess.STDOUT)
+                         .decode('UTF-8'))
+        expected_result = "set osd.{} primary-affinity to {}".format(
+                          osd_num, affinity)
+        log(cmd_result)
+        if expected_result in cmd_result:
+            return True
+        return False
+    except subprocess.CalledProcessError as e:
+        log("ceph osd primary-affinity command failed"
+            " with message: {}".format(e))
+        raise
+
+
 def determine_packages():
     """Determines packages for installation.
 
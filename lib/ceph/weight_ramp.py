@@ -0,0 +1,228 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Gradual CRUSH weight ramp-in of new OSDs.
+
+OSDs created while the ramp is enabled join the cluster with a CRUSH
+weight of 0. advance() enrolls each local OSD it finds at weight 0 in the
+CRUSH map, however it was created, with the weight its size calls for, and
+raises the weight of every enrolled OSD by a fraction of its target, but
+only once the cluster has absorbed the previous step, i.e. the ratio of
+misplaced objects is below a threshold. The enrolled OSDs and their weights
+are kept in unitdata, so the ramp carries on across hooks.
+"""
+
+import json
+import os
+import subprocess
+
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    INFO,
+    WARNING,
+)
+from charmhelpers.core.unitdata import kv
+
+from ceph.utils import (
+    OSD_BASE_DIR,
+    get_local_osd_ids,
+    reweight_osd,
+)
+
+RAMP_KEY = 'osd-weight-ramp'
+# local OSDs already considered for the ramp, so that one an operator later
+# weights to 0 by hand is left alone
+SEEN_KEY = 'osd-weight-ramp-seen'
+
+DEFAULT_STEP = 0.1
+DEFAULT_MAX_MISPLACED = 0.01
+
+# CRUSH weights are the size of the OSD in TiB
+TiB = 1024 ** 4
+
+
+def osd_target_weight(osd_id, osd_path=OSD_BASE_DIR):
+    """CRUSH weight Ceph would give a local OSD by default.
+
+    :param osd_id: int. Id of the OSD
+    :param osd_path: str. Directory holding the OSD data directories
+    :returns: float. Size of the OSD in TiB
+    :raises: CalledProcessError if the size of its block device cannot be
+             read
+    """
+    osd_dir = os.path.join(osd_path, 'ceph-{}'.format(osd_id))
+    block = os.path.join(osd_dir, 'block')
+    if os.path.exists(block):
+        size = int(subprocess.check_output(
+            ['blockdev', '--getsize64',
+             os.path.realpath(block)]).decode('UTF-8').strip())
+    else:
+        stat = os.statvfs(osd_dir)
+        size = stat.f_blocks * stat.f_frsize
+    return round(float(size) / TiB, 4)
+
+
+def misplaced_ratio(service):
+    """Fraction of the objects in the cluster which are misplaced.
+
+    :param service: str. The cephx id to run ceph commands as
+    :returns: float
+    :raises: CalledProcessError if the ceph command fails
+    """
+    stat = json.loads(subprocess.check_output(
+        ['ceph', '--id', service, 'pg', 'stat',
+         '--format=json']).decode('UTF-8'))
+    # nautilus nests the summary under 'pg_summary'
+    stat = stat.get('pg_summary', stat)
+    return float(stat.get('misplaced_ratio', 0.0))
+
+
+def get_crush_weights(service):
+    """Read the CRUSH weight of every OSD in the cluster.
+
+    :param service: str. The cephx id to run ceph commands as
+    :returns: dict. CRUSH weight keyed by OSD id
+    :raises: CalledProcessError if the ceph command fails
+    """
+    tree = json.loads(subprocess.check_output(
+        ['ceph', '--id', service, 'osd', 'tree',
+         '--format=json']).decode('UTF-8'))
+    return dict((node['id'], float(node.get('crush_weight', 0.0)))
+                for node in tree.get('nodes', []) + tree.get('stray', [])
+                if node.get('type') == 'osd')
+
+
+def discover(service, db=None):
+    """Enroll the local OSDs which joined the cluster with a weight of 0.
+
+    Only OSDs not seen before are enrolled, so an OSD an operator weights
+    to 0 after it was ramped in stays there. An OSD which cannot be
+    enrolled is tried again on the next call.
+
+    :param service: str. The cephx id to run ceph commands as
+    :param db: unitdata.Storage to keep the ramp in, defaults to kv()
+    :returns: dict. The enrolled OSDs
+    :raises: CalledProcessError if the ceph command fails
+    """
+    db = db or kv()
+    seen = set(db.get(SEEN_KEY) or [])
+    local = set(int(osd_id) for osd_id in get_local_osd_ids())
+    weights = get_crush_weights(service)
+    new = sorted(osd_id for osd_id in local - seen
+                 if weights.get(osd_id) == 0.0)
+    for osd_id in new:
+        try:
+            enroll([osd_id], db)
+        except (subprocess.CalledProcessError, OSError) as e:
+            log('Unable to ramp in osd.{}: {}'.format(osd_id, e),
+                level=WARNING)
+            local.discard(osd_id)
+    # OSDs not yet in the CRUSH map are looked at again once they are
+    db.set(SEEN_KEY, sorted(osd_id for osd_id in local | seen
+                            if osd_id in weights))
+    db.flush()
+    return db.get(RAMP_KEY) or {}
+
+
+def enroll(osd_ids, db=None):
+    """Start ramping the weight of new OSDs up from 0.
+
+    :param osd_ids: list. Ids of OSDs created with a CRUSH weight of 0
+    :param db: unitdata.Storage to keep the ramp in, defaults to kv()
+    :returns: dict. The enrolled OSDs
+    """
+    db = db or kv()
+    ramp = db.get(RAMP_KEY) or {}
+    for osd_id in osd_ids:
+        if str(osd_id) in ramp:
+            continue
+        target = osd_target_weight(osd_id)
+        log('Ramping osd.{} in to weight {}'.format(osd_id, target),
+            level=INFO)
+        ramp[str(osd_id)] = {'weight': 0.0, 'target': target}
+    db.set(RAMP_KEY, ramp)
+    db.flush()
+    return ramp
+
+
+def advance(service, step=DEFAULT_STEP, max_misplaced=DEFAULT_MAX_MISPLACED,
+            db=None, enroll_new=True):
+    """Raise the weight of the enrolled OSDs by one step.
+
+    Nothing changes while more than max_misplaced of the objects in the
+    cluster are misplaced. OSDs which reach their target, or which no
+    longer exist on the unit, leave the ramp.
+
+    :param service: str. The cephx id to run ceph commands as
+    :param step: float. Fraction of its target weight added to each OSD
+    :param max_misplaced: float. Misplaced object ratio below which the
+                          next step is taken
+    :param db: unitdata.Storage the ramp is kept in, defaults to kv()
+    :param enroll_new: bool. Whether to first enroll the local OSDs found
+                       at a CRUSH weight of 0
+    :returns: dict. The OSDs still ramping
+    :raises: CalledProcessError if a ceph command fails
+    """
+    db = db or kv()
+    if enroll_new:
+        ramp = discover(service, db)
+    else:
+        ramp = db.get(RAMP_KEY) or {}
+    if not ramp:
+        return ramp
+    ratio = misplaced_ratio(service)
+    if ratio > max_misplaced:
+        log('Waiting for misplaced objects to fall from {:.2%} to {:.2%} '
+            'before raising OSD weights'.format(ratio, max_misplaced),
+            level=DEBUG)
+        return ramp
+    local = set(str(osd_id) for osd_id in get_local_osd_ids())
+    for osd_id in sorted(ramp, key=int):
+        osd = ramp[osd_id]
+        if osd_id not in local:
+            log('osd.{} is gone, dropping it from the weight ramp'
+                .format(osd_id), level=INFO)
+            del ramp[osd_id]
+            continue
+        weight = round(min(osd['target'],
+                           osd['weight'] + osd['target'] * step), 4)
+        reweight_osd(osd_id, '{:g}'.format(weight), service)
+        osd['weight'] = weight
+        if weight >= osd['target']:
+            log('osd.{} reached its weight of {}'.format(osd_id, weight),
+                level=INFO)
+            del ramp[osd_id]
+        # record each step as it is made, so that a failure part way
+        # through does not repeat it
+        db.set(RAMP_KEY, ramp)
+        db.flush()
+    db.set(RAMP_KEY, ramp)
+    db.flush()
+    return ramp
+
+
+def progress(db=None):
+    """Report the progress of the ramp.
+
+    :returns: tuple. The number of OSDs ramping and the percentage of
+              their target weight reached, or None if no OSD is ramping
+    """
+    ramp = (db or kv()).get(RAMP_KEY)
+    if not ramp:
+        return None
+    target = sum(osd['target'] for osd in ramp.values())
+    weight = sum(osd['weight'] for osd in ramp.values())
+    percent = int(100 * weight / target) if target else 100
+    return len(ramp), percent
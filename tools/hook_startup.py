@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+#
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure the cold start cost of each charm hook.
+
+For every hook, a fresh interpreter is started in the charm directory which
+imports the Python module the hook executes, mirroring what happens before
+the hook handler is dispatched. The wall clock time of the whole process,
+the time spent importing the hook module and the number of modules loaded
+are reported. The slowest imports can be listed with --top.
+
+Run from the charm root:
+
+    python3 tools/hook_startup.py
+    python3 tools/hook_startup.py --runs 20 --top 10 update-status
+
+The exit status is 1 if the median start-up time of any hook exceeds the
+budget given by --budget-ms.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+HOOKS_DIR = 'hooks'
+
+# Start-up budget for a hook, see "Hook start-up cost" in README.md
+DEFAULT_BUDGET_MS = 250
+
+PROBE = """
+import json, sys, time
+sys.argv = [{hook!r}]
+sys.path.insert(0, 'hooks')
+sys.path.insert(0, 'lib')
+start = time.time()
+import {module}
+print(json.dumps({{'import': time.time() - start,
+                  'modules': len(sys.modules)}}))
+"""
+
+
+def hook_module(hook):
+    """Return the Python module executed by a hook, or None.
+
+    Shell wrappers such as install and add-storage exec a '<hook>.real' or
+    'storage.real' symlink, which is followed to its target module.
+    """
+    path = os.path.join(HOOKS_DIR, hook)
+    target = os.path.realpath(path)
+    if target.endswith('.py'):
+        return os.path.basename(target)[:-3]
+    with open(path) as f:
+        for line in f:
+            if line.startswith('exec ./hooks/'):
+                real = line.split()[1][len('./hooks/'):]
+                return hook_module(real)
+    return None
+
+
+def list_hooks():
+    hooks = []
+    for name in sorted(os.listdir(HOOKS_DIR)):
+        path = os.path.join(HOOKS_DIR, name)
+        if ('.' in name or not os.path.isfile(path) or
+                not os.access(path, os.X_OK)):
+            continue
+        if hook_module(name):
+            hooks.append(name)
+    return hooks
+
+
+def measure(hook, module, python=sys.executable):
+    start = time.time()
+    output = subprocess.check_output(
+        [python, '-c', PROBE.format(hook=hook, module=module)])
+    result = json.loads(output.decode('UTF-8').splitlines()[-1])
+    result['total'] = time.time() - start
+    return result
+
+
+def top_imports(hook, module, count, python=sys.executable):
+    """Return the count slowest imports by cumulative time in us."""
+    proc = subprocess.run(
+        [python, '-X', 'importtime', '-c',
+         PROBE.format(hook=hook, module=module)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    imports = []
+    for line in proc.stderr.decode('UTF-8').splitlines():
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        imports.append((int(fields[1]), fields[2].strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('hooks', nargs='*',
+                        help='Hooks to measure (default: all hooks)')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Cold starts to measure per hook')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help='Maximum median start-up time per hook')
+    parser.add_argument('--top', type=int, default=0,
+                        help='List the N slowest imports of each hook')
+    parser.add_argument('--python', default=sys.executable,
+                        help='Interpreter to run the hooks with')
+    options = parser.parse_args(args)
+
+    over_budget = []
+    print('{:<45} {:>9} {:>9} {:>8}'.format('hook', 'total ms', 'import ms',
+                                            'modules'))
+    for hook in options.hooks or list_hooks():
+        module = hook_module(hook)
+        results = [measure(hook, module, options.python)
+                   for _ in range(options.runs)]
+        total = median([r['total'] for r in results]) * 1000
+        print('{:<45} {:>9.1f} {:>9.1f} {:>8}'.format(
+            hook, total, median([r['import'] for r in results]) * 1000,
+            results[-1]['modules']))
+        if total > options.budget_ms:
+            over_budget.append(hook)
+        for usec, name in top_imports(hook, module, options.top,
+                                      options.python):
+            print('    {:>9.1f}  {}'.format(usec / 1000.0, name))
+
+    if over_budget:
+        print('Over the {}ms start-up budget: {}'.format(
+            options.budget_ms, ', '.join(over_budget)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,105 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stand-in for the parts of the Vault HTTP API the charm uses."""
+
+import json
+import ssl
+import threading
+import uuid
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class FakeVault(object):
+    """Vault server answering AppRole logins on a local port.
+
+    :param ttl: int. Lease duration of the tokens issued, in seconds
+    :param certfile: str. PEM file holding the certificate and key to serve
+                     HTTPS with, HTTP is served if not provided
+    """
+
+    def __init__(self, ttl=3600, certfile=None):
+        self.ttl = ttl
+        # role_id -> secret_ids accepted for it
+        self.approles = {}
+        self.tokens = set()
+        self.requests = []
+        self.server = HTTPServer(('127.0.0.1', 0), self._handler())
+        scheme = 'http'
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile)
+            self.server.socket = context.wrap_socket(self.server.socket,
+                                                     server_side=True)
+            scheme = 'https'
+        self.url = '{}://127.0.0.1:{}'.format(scheme,
+                                              self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       kwargs={'poll_interval': 0.05})
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def add_approle(self, role_id, secret_id):
+        """Accept secret_id for role_id."""
+        self.approles.setdefault(role_id, set()).add(secret_id)
+
+    def _issue(self):
+        token = str(uuid.uuid4())
+        self.tokens.add(token)
+        return token
+
+    def _auth(self, token):
+        return {'auth': {'client_token': token,
+                         'lease_duration': self.ttl,
+                         'renewable': True}}
+
+    def handle(self, path, body):
+        """Return the status and body of the reply to a request."""
+        self.requests.append(path)
+        if path == '/v1/auth/approle/login':
+            if body.get('secret_id') in self.approles.get(
+                    body.get('role_id'), ()):
+                return 200, self._auth(self._issue())
+            return 400, {'errors': ['invalid role or secret ID']}
+        return 404, {'errors': []}
+
+    def _handler(self):
+        vault = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length).decode('UTF-8') or
+                                  '{}')
+                status, reply = vault.handle(self.path, body)
+                data = json.dumps(reply).encode('UTF-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,76 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+
+from charmhelpers.core import unitdata
+
+from ceph import device_registry
+
+from actions import add_disk
+
+from test_utils import CharmTestCase
+
+
+class AddDiskActionTests(CharmTestCase):
+    def setUp(self):
+        super(AddDiskActionTests, self).setUp(
+            add_disk, ['hookenv', 'ch_ceph', 'ceph_hooks', 'charm_agent'])
+        self.hookenv.config.return_value = None
+        self.params = {'osd-devices': '/dev/vdb /dev/vdc /dev/vdd',
+                       'bucket': 'tray1', 'parallel': 2}
+        self.hookenv.action_get.side_effect = self.params.get
+        self.ch_ceph.CephBrokerRq.return_value.ops = []
+        self.registry = device_registry.DeviceRegistry(
+            unitdata.Storage(':memory:'), by_id_dir='/nonexistent')
+        _registry = mock.patch.object(add_disk.device_registry, 'registry',
+                                      return_value=self.registry)
+        _registry.start()
+        self.addCleanup(_registry.stop)
+        for name in ('osdize_devs', 'get_ceph_volume_osds', 'tune_dev'):
+            _patch = mock.patch.object(add_disk.ceph.utils, name)
+            setattr(self, name, _patch.start())
+            self.addCleanup(_patch.stop)
+
+    def test_add_disks(self):
+        self.osdize_devs.return_value = {'/dev/vdb': 42.04, '/dev/vdc': 40.0}
+        self.get_ceph_volume_osds.return_value = {'/dev/vdb': [3, 5]}
+        # encrypted devices are only known to the registry
+        self.registry.transition('/dev/vdc', device_registry.ACTIVE,
+                                 osd_id=4)
+        add_disk.add_disk()
+        self.osdize_devs.assert_called_once_with(
+            ['/dev/vdb', '/dev/vdc', '/dev/vdd'], None,
+            self.ceph_hooks.get_journal_devices.return_value,
+            None, None, None, None, parallel=2)
+        request = self.ch_ceph.CephBrokerRq.return_value
+        self.assertEqual(request.ops, [
+            {'op': 'move-osd-to-bucket', 'osd': 'osd.3', 'bucket': 'tray1'},
+            {'op': 'move-osd-to-bucket', 'osd': 'osd.5', 'bucket': 'tray1'},
+            {'op': 'move-osd-to-bucket', 'osd': 'osd.4', 'bucket': 'tray1'},
+        ])
+        self.ch_ceph.send_request_if_needed.assert_called_once_with(
+            request, relation='mon')
+        self.charm_agent.invalidate.assert_called_once_with()
+        self.hookenv.action_set.assert_called_once_with({
+            'osd-ids.vdb': '3 5', 'osd-ids.vdc': '4',
+            'timings.vdb': '42.0', 'timings.vdc': '40.0'})
+
+    def test_add_disks_without_bucket(self):
+        self.params['bucket'] = None
+        self.osdize_devs.return_value = {}
+        self.get_ceph_volume_osds.side_effect = OSError('no ceph-volume')
+        add_disk.add_disk()
+        self.ch_ceph.send_request_if_needed.assert_not_called()
+        self.hookenv.action_set.assert_not_called()
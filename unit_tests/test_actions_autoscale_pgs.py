@@ -0,0 +1,39 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ceph.pg_utils import PoolPlan
+
+from actions import autoscale_pgs
+
+from test_utils import CharmTestCase
+
+
+class AutoscalePgsActionTests(CharmTestCase):
+    def setUp(self):
+        super(AutoscalePgsActionTests, self).setUp(
+            autoscale_pgs, ['hookenv', 'get_cluster_pg_state', 'plan_pgs',
+                            'apply_pg_plan'])
+        self.params = {'apply': True, 'target-pgs-per-osd': 100,
+                       'max-pgs-per-osd': 200, 'step': 64}
+        self.hookenv.action_get.side_effect = self.params.get
+
+    def test_runs_as_osd_upgrade(self):
+        plan = PoolPlan._make([None] * len(PoolPlan._fields))._replace(
+            name='rbd', pg_num=32, pgp_num=32, target_pg_num=128,
+            size=3, osd_count=12)
+        self.plan_pgs.return_value = [plan]
+        autoscale_pgs.autoscale_pgs()
+        self.get_cluster_pg_state.assert_called_once_with('osd-upgrade')
+        self.apply_pg_plan.assert_called_once_with('osd-upgrade', [plan],
+                                                   step=64)
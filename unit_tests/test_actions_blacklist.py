@@ -15,6 +15,9 @@
 import mock
 
 from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
+
+from ceph import device_registry
 
 from actions import blacklist
 
@@ -25,87 +28,113 @@ class BlacklistActionTests(CharmTestCase):
     def setUp(self):
         super(BlacklistActionTests, self).setUp(
             blacklist, [])
+        self.registry = device_registry.DeviceRegistry(
+            unitdata.Storage(':memory:'), by_id_dir='/nonexistent')
+        _registry = mock.patch.object(blacklist.device_registry, 'registry',
+                                      return_value=self.registry)
+        _registry.start()
+        self.addCleanup(_registry.stop)
 
     @mock.patch('os.path.isabs')
     @mock.patch('os.path.exists')
-    @mock.patch('charmhelpers.core.unitdata.kv')
     @mock.patch('charmhelpers.core.hookenv.action_get')
-    def test_add_disk(self, _action_get, _kv, _exists, _isabs):
+    def test_add_disk(self, _action_get, _exists, _isabs):
         """Add device with absolute and existent path succeeds"""
         _action_get.return_value = '/dev/vda'
-        _kv.return_value = _kv
-        _kv.get.return_value = []
         _exists.return_value = True
         _isabs.return_value = True
         blacklist.blacklist_add()
         _exists.assert_called()
         _isabs.assert_called()
-        _kv.get.assert_called_with('osd-blacklist', [])
-        _kv.set.assert_called_with('osd-blacklist', ['/dev/vda'])
-        _kv.flush.assert_called()
+        self.assertEqual(
+            self.registry.paths(device_registry.BLACKLISTED),
+            set(['/dev/vda']))
 
     @mock.patch('os.path.isabs')
     @mock.patch('os.path.exists')
-    @mock.patch('charmhelpers.core.unitdata.kv')
     @mock.patch('charmhelpers.core.hookenv.action_get')
-    def test_add_disk_nonexistent(self, _action_get, _kv, _exists, _isabs):
+    def test_add_disk_nonexistent(self, _action_get, _exists, _isabs):
         """Add device with non-existent path raises exception"""
         _action_get.return_value = '/dev/vda'
-        _kv.return_value = _kv
-        _kv.get.return_value = []
         _exists.return_value = False
         _isabs.return_value = True
         with self.assertRaises(blacklist.Error):
             blacklist.blacklist_add()
         _isabs.assert_called()
         _exists.assert_called()
-        _kv.get.assert_called_with('osd-blacklist', [])
-        assert not _kv.set.called
-        assert not _kv.flush.called
+        self.assertEqual(self.registry.devices(), [])
 
     @mock.patch('os.path.isabs')
     @mock.patch('os.path.exists')
-    @mock.patch('charmhelpers.core.unitdata.kv')
     @mock.patch('charmhelpers.core.hookenv.action_get')
-    def test_add_disk_nonabsolute(self, _action_get, _kv, _exists, _isabs):
+    def test_add_disk_nonabsolute(self, _action_get, _exists, _isabs):
         """Add device with non-absolute path raises exception"""
         _action_get.return_value = 'vda'
-        _kv.return_value = _kv
-        _kv.get.return_value = []
         _exists.return_value = True
         _isabs.return_value = False
         with self.assertRaises(blacklist.Error):
             blacklist.blacklist_add()
         _isabs.assert_called()
-        _kv.get.assert_called_with('osd-blacklist', [])
         assert not _exists.called
-        assert not _kv.set.called
-        assert not _kv.flush.called
+        self.assertEqual(self.registry.devices(), [])
+
+    @mock.patch.object(blacklist.glob, 'glob')
+    @mock.patch('charmhelpers.core.hookenv.action_get')
+    def test_add_disk_pattern(self, _action_get, _glob):
+        """Add devices matching a by-path glob"""
+        _action_get.return_value = '/dev/disk/by-path/pci-0000:00:1f.2-ata-*'
+        _glob.return_value = ['/dev/disk/by-path/pci-0000:00:1f.2-ata-2',
+                              '/dev/disk/by-path/pci-0000:00:1f.2-ata-1']
+        blacklist.blacklist_add()
+        _glob.assert_called_once_with(
+            '/dev/disk/by-path/pci-0000:00:1f.2-ata-*')
+        self.assertEqual(
+            self.registry.paths(device_registry.BLACKLISTED),
+            set(_glob.return_value))
+
+        _action_get.return_value = '/dev/disk/by-path/pci-0000:00:1f.2-*-1'
+        _glob.return_value = []
+        blacklist.blacklist_remove()
+        self.assertEqual(
+            self.registry.paths(device_registry.BLACKLISTED),
+            set(['/dev/disk/by-path/pci-0000:00:1f.2-ata-2']))
+
+    @mock.patch.object(blacklist.glob, 'glob')
+    @mock.patch('charmhelpers.core.hookenv.action_get')
+    def test_add_disk_pattern_no_match(self, _action_get, _glob):
+        """Add devices with a glob matching nothing raises exception"""
+        _action_get.return_value = '/dev/disk/by-path/*-nvme-*'
+        _glob.return_value = []
+        with self.assertRaises(blacklist.Error):
+            blacklist.blacklist_add()
+        self.assertEqual(self.registry.devices(), [])
 
-    @mock.patch('charmhelpers.core.unitdata.kv')
     @mock.patch('charmhelpers.core.hookenv.action_get')
-    def test_remove_disk(self, _action_get, _kv):
+    def test_remove_disk(self, _action_get):
         """Remove action succeeds, and regardless of existence of device"""
         _action_get.return_value = '/nonexistent2'
-        _kv.return_value = _kv
-        _kv.get.return_value = ['/nonexistent1', '/nonexistent2']
+        self.registry.transition('/nonexistent2', device_registry.ACTIVE)
+        self.registry.blacklist('/nonexistent1')
+        self.registry.blacklist('/nonexistent2')
         blacklist.blacklist_remove()
-        _kv.get.assert_called_with('osd-blacklist', [])
-        _kv.set.assert_called_with('osd-blacklist', ['/nonexistent1'])
-        _kv.flush.assert_called()
+        self.assertEqual(
+            self.registry.paths(device_registry.BLACKLISTED),
+            set(['/nonexistent1']))
+        # the device returns to the state it was blacklisted in
+        self.assertEqual(self.registry.state('/nonexistent2'),
+                         device_registry.ACTIVE)
 
-    @mock.patch('charmhelpers.core.unitdata.kv')
     @mock.patch('charmhelpers.core.hookenv.action_get')
-    def test_remove_disk_nonlisted(self, _action_get, _kv):
+    def test_remove_disk_nonlisted(self, _action_get):
         """Remove action raises on removal of device not in list"""
-        _action_get.return_value = '/nonexistent3'
-        _kv.return_value = _kv
-        _kv.get.return_value = ['/nonexistent1', '/nonexistent2']
+        _action_get.return_value = '/nonexistent1 /nonexistent3'
+        self.registry.blacklist('/nonexistent1')
+        self.registry.blacklist('/nonexistent2')
         with self.assertRaises(blacklist.Error):
             blacklist.blacklist_remove()
-        _kv.get.assert_called_with('osd-blacklist', [])
-        assert not _kv.set.called
-        assert not _kv.flush.called
+        self.assertEqual(
+            self.registry.paths(device_registry.BLACKLISTED),
+            set(['/nonexistent1', '/nonexistent2']))
 
 
 class MainTestCase(CharmTestCase):
@@ -22,42 +22,96 @@ sys.path.append('hooks')
 
 import pause_resume as actions
 
+from charmhelpers.core import unitdata
+
 
 class PauseTestCase(CharmTestCase):
     def setUp(self):
         super(PauseTestCase, self).setUp(
-            actions, ["check_call",
-                      "get_local_osd_ids",
+            actions, ["get_local_osd_ids",
+                      "mark_osds",
+                      "set_maintenance_flags",
+                      "stop_osds_parallel",
+                      "action_get",
+                      "action_set",
+                      "kv",
                       "set_unit_paused",
                       "assess_status"])
+        self.db = unitdata.Storage(':memory:')
+        self.kv.return_value = self.db
+        self.params = {'set-flags': False, 'stop-osds': False,
+                       'parallel': 4}
+        self.action_get.side_effect = lambda key: self.params[key]
 
     def test_pauses_services(self):
         self.get_local_osd_ids.return_value = [5]
         actions.pause([])
-        cmd = ['ceph', '--id',
-               'osd-upgrade', 'osd', 'out', '5']
-        self.check_call.assert_called_once_with(cmd)
+        self.mark_osds.assert_called_once_with([5], 'out')
+        self.set_maintenance_flags.assert_not_called()
+        self.stop_osds_parallel.assert_not_called()
         self.set_unit_paused.assert_called_once_with()
         self.assess_status.assert_called_once_with()
 
+    def test_pause_for_maintenance(self):
+        self.get_local_osd_ids.return_value = ['5', '6']
+        self.params.update({'set-flags': True, 'stop-osds': True})
+        self.set_maintenance_flags.return_value = {
+            'host': 'host1', 'group': ['noout'], 'cluster': []}
+        self.stop_osds_parallel.return_value = {'5': 1.25, '6': 2.0}
+        actions.pause([])
+        actions.pause([])
+        self.set_maintenance_flags.assert_called_once_with()
+        self.assertEqual(self.db.get(actions.MAINTENANCE_FLAGS_KEY),
+                         self.set_maintenance_flags.return_value)
+        self.stop_osds_parallel.assert_called_with(['5', '6'], 4)
+        self.action_set.assert_called_with({'timings.osd-5': '1.2',
+                                            'timings.osd-6': '2.0'})
+
 
 class ResumeTestCase(CharmTestCase):
     def setUp(self):
         super(ResumeTestCase, self).setUp(
-            actions, ["check_call",
-                      "get_local_osd_ids",
+            actions, ["get_local_osd_ids",
+                      "mark_osds",
+                      "set_maintenance_flags",
+                      "start_osds_staggered",
+                      "wait_for_active_clean",
+                      "action_get",
+                      "action_set",
+                      "kv",
                       "clear_unit_paused",
                       "assess_status"])
+        self.db = unitdata.Storage(':memory:')
+        self.kv.return_value = self.db
+        self.params = {'parallel': 2, 'wait-timeout': 0}
+        self.action_get.side_effect = lambda key: self.params[key]
 
     def test_pauses_services(self):
         self.get_local_osd_ids.return_value = [5]
         actions.resume([])
-        cmd = ['ceph', '--id',
-               'osd-upgrade', 'osd', 'in', '5']
-        self.check_call.assert_called_once_with(cmd)
+        self.start_osds_staggered.assert_called_once_with(
+            [5], 2, timings={})
+        self.mark_osds.assert_called_once_with([5], 'in')
+        self.set_maintenance_flags.assert_not_called()
+        self.wait_for_active_clean.assert_not_called()
         self.clear_unit_paused.assert_called_once_with()
         self.assess_status.assert_called_once_with()
 
+    def test_resume_from_maintenance(self):
+        self.get_local_osd_ids.return_value = ['5']
+        flags = {'host': None, 'group': [],
+                 'cluster': ['noout', 'norebalance']}
+        self.db.set(actions.MAINTENANCE_FLAGS_KEY, flags)
+        self.params['wait-timeout'] = 300
+        self.wait_for_active_clean.return_value = True
+        actions.resume([])
+        self.set_maintenance_flags.assert_called_once_with(unset=True,
+                                                           flags=flags)
+        self.assertIsNone(self.db.get(actions.MAINTENANCE_FLAGS_KEY))
+        self.wait_for_active_clean.assert_called_once_with('osd-upgrade',
+                                                           300)
+        self.action_set.assert_called_with({'pgs-active-clean': True})
+
 
 class MainTestCase(CharmTestCase):
     def setUp(self):
@@ -14,42 +14,58 @@
 
 import mock
 
+from charmhelpers.core import unitdata
+
+from ceph import device_registry
+
 from actions import zap_disk
 
 from test_utils import CharmTestCase
 
 
+def _info(mounted=False, in_use=False, mappings=(), fstype=None,
+          discard=False):
+    return {'mounted': mounted, 'in-use': in_use, 'mappings': list(mappings),
+            'fstype': fstype, 'discard': discard}
+
+
 class ZapDiskActionTests(CharmTestCase):
     def setUp(self):
         super(ZapDiskActionTests, self).setUp(
             zap_disk, ['hookenv',
                        'is_block_device',
-                       'is_device_mounted',
-                       'is_active_bluestore_device',
-                       'is_mapped_luks_device',
-                       'kv'])
-        self.is_device_mounted.return_value = False
+                       'block_device_inventory',
+                       'wipe_block_device',
+                       'charm_agent',
+                       'refresh_nrpe_checks'])
         self.is_block_device.return_value = True
-        self.is_active_bluestore_device.return_value = False
-        self.is_mapped_luks_device.return_value = False
-        self.kv.return_value = self.kv
+        self.inventory = {}
+        self.block_device_inventory.side_effect = lambda devices: dict(
+            (device, self.inventory.get(device, _info()))
+            for device in devices)
         self.hookenv.local_unit.return_value = "ceph-osd-test/0"
+        self.params = {'i-really-mean-it': True, 'discard': False}
+        self.hookenv.action_get.side_effect = self.params.get
+        self.registry = device_registry.DeviceRegistry(
+            unitdata.Storage(':memory:'), by_id_dir='/nonexistent')
+        for device in ('/dev/vdb', '/dev/vdz'):
+            self.registry.transition(device, device_registry.ACTIVE)
+        _registry = mock.patch.object(zap_disk.device_registry, 'registry',
+                                      return_value=self.registry)
+        _registry.start()
+        self.addCleanup(_registry.stop)
 
-    @mock.patch.object(zap_disk, 'zap_disk')
-    def test_authorized_zap_single_disk(self,
-                                        _zap_disk):
+    def test_authorized_zap_single_disk(self):
         """Will zap disk with extra config set"""
-        def side_effect(arg):
-            return {
-                'devices': '/dev/vdb',
-                'i-really-mean-it': True,
-            }.get(arg)
-        self.hookenv.action_get.side_effect = side_effect
-        self.kv.get.return_value = ['/dev/vdb', '/dev/vdz']
+        self.params['devices'] = '/dev/vdb'
         zap_disk.zap()
-        _zap_disk.assert_called_with('/dev/vdb')
-        self.kv.get.assert_called_with('osd-devices', [])
-        self.kv.set.assert_called_with('osd-devices', ['/dev/vdz'])
+        self.wipe_block_device.assert_called_once_with(
+            '/dev/vdb', [], None, discard=False)
+        self.assertEqual(self.registry.paths(device_registry.ACTIVE),
+                         set(['/dev/vdz']))
+        self.charm_agent.invalidate.assert_called_once_with()
+        self.assertEqual(self.registry.state('/dev/vdb'),
+                         device_registry.ZAPPED)
         self.hookenv.action_set.assert_called_with({
             'message': "1 disk(s) have been zapped, to use "
                        "them as OSDs, run: \njuju "
@@ -57,24 +73,20 @@ class ZapDiskActionTests(CharmTestCase):
                        "osd-devices=\"/dev/vdb\""
         })
 
-    @mock.patch.object(zap_disk, 'zap_disk')
-    def test_authorized_zap_multiple_disks(self,
-                                           _zap_disk):
+    def test_authorized_zap_multiple_disks(self):
         """Will zap disk with extra config set"""
-        def side_effect(arg):
-            return {
-                'devices': '/dev/vdb /dev/vdc',
-                'i-really-mean-it': True,
-            }.get(arg)
-        self.hookenv.action_get.side_effect = side_effect
-        self.kv.get.return_value = ['/dev/vdb', '/dev/vdz']
+        self.params['devices'] = '/dev/vdb /dev/vdc'
         zap_disk.zap()
-        _zap_disk.assert_has_calls([
-            mock.call('/dev/vdb'),
-            mock.call('/dev/vdc'),
-        ])
-        self.kv.get.assert_called_with('osd-devices', [])
-        self.kv.set.assert_called_with('osd-devices', ['/dev/vdz'])
+        self.block_device_inventory.assert_called_once_with(
+            ['/dev/vdb', '/dev/vdc'])
+        self.wipe_block_device.assert_has_calls([
+            mock.call('/dev/vdb', [], None, discard=False),
+            mock.call('/dev/vdc', [], None, discard=False),
+        ], any_order=True)
+        self.assertEqual(self.registry.paths(device_registry.ACTIVE),
+                         set(['/dev/vdz']))
+        self.assertEqual(self.registry.state('/dev/vdb'),
+                         device_registry.ZAPPED)
         self.hookenv.action_set.assert_called_with({
             'message': "2 disk(s) have been zapped, to use "
                        "them as OSDs, run: \njuju "
@@ -82,91 +94,78 @@ class ZapDiskActionTests(CharmTestCase):
                        "osd-devices=\"/dev/vdb /dev/vdc\""
         })
 
-    @mock.patch.object(zap_disk, 'zap_disk')
-    def test_wont_zap_non_block_device(self,
-                                       _zap_disk,):
+    def test_wont_zap_non_block_device(self):
         """Will not zap a disk that isn't a block device"""
-        def side_effect(arg):
-            return {
-                'devices': '/dev/vdb',
-                'i-really-mean-it': True,
-            }.get(arg)
-        self.hookenv.action_get.side_effect = side_effect
+        self.params['devices'] = '/dev/vdb'
         self.is_block_device.return_value = False
         zap_disk.zap()
-        _zap_disk.assert_not_called()
+        self.wipe_block_device.assert_not_called()
+        self.block_device_inventory.assert_not_called()
         self.hookenv.action_fail.assert_called_with(
             "1 devices are not block devices: /dev/vdb")
 
-    @mock.patch.object(zap_disk, 'zap_disk')
-    def test_wont_zap_mounted_block_device(self,
-                                           _zap_disk):
+    def test_wont_zap_mounted_block_device(self):
         """Will not zap a disk that is mounted"""
-        def side_effect(arg):
-            return {
-                'devices': '/dev/vdb',
-                'i-really-mean-it': True,
-            }.get(arg)
-        self.hookenv.action_get.side_effect = side_effect
-        self.is_device_mounted.return_value = True
+        self.params['devices'] = '/dev/vdb'
+        self.inventory['/dev/vdb'] = _info(mounted=True)
         zap_disk.zap()
-        _zap_disk.assert_not_called()
+        self.wipe_block_device.assert_not_called()
         self.hookenv.action_fail.assert_called_with(
             "1 devices are mounted: /dev/vdb")
 
-    @mock.patch.object(zap_disk, 'zap_disk')
-    def test_wont_zap__mounted_bluestore_device(self,
-                                                _zap_disk):
-        """Will not zap a disk that is mounted"""
-        def side_effect(arg):
-            return {
-                'devices': '/dev/vdb',
-                'i-really-mean-it': True,
-            }.get(arg)
-        self.hookenv.action_get.side_effect = side_effect
-        self.is_active_bluestore_device.return_value = True
+    def test_wont_zap_in_use_device(self):
+        """Will not zap a disk backing an OSD or an open mapping"""
+        self.params['devices'] = '/dev/vdb /dev/vdc'
+        self.inventory['/dev/vdb'] = _info(in_use=True,
+                                           mappings=['crypt-vdb'])
         zap_disk.zap()
-        _zap_disk.assert_not_called()
+        self.wipe_block_device.assert_not_called()
         self.hookenv.action_fail.assert_called_with(
-            "1 devices are mounted: /dev/vdb")
+            "1 devices are in use by an OSD or an open device-mapper "
+            "mapping: /dev/vdb")
 
-    @mock.patch.object(zap_disk, 'zap_disk')
-    def test_wont_zap__mapped_luks_device(self, _zap_disk):
-        """Will not zap a disk that has a LUKS header"""
-        def side_effect(arg):
-            return {
-                'devices': '/dev/vdb',
-                'i-really-mean-it': True,
-            }.get(arg)
-        self.hookenv.action_get.side_effect = side_effect
-        self.is_active_bluestore_device.return_value = False
-        self.is_mapped_luks_device.return_value = True
+    def test_reports_devices_missing_from_inventory(self):
+        """Devices lsblk does not report fail without aborting the rest"""
+        self.params['devices'] = '/dev/vdb /dev/vdc'
+        self.block_device_inventory.side_effect = lambda devices: {
+            '/dev/vdc': _info()}
         zap_disk.zap()
-        _zap_disk.assert_not_called()
-        self.hookenv.action_fail.assert_called_with(
-            "1 devices are mounted: /dev/vdb")
+        self.wipe_block_device.assert_called_once_with(
+            '/dev/vdc', [], None, discard=False)
+        self.assertEqual(self.registry.state('/dev/vdb'),
+                         device_registry.ACTIVE)
+        self.assertEqual(self.registry.state('/dev/vdc'),
+                         device_registry.ZAPPED)
+        self.hookenv.action_fail.assert_called_once_with(
+            "Failed to zap 1 device(s): /dev/vdb: not found by lsblk")
 
-    @mock.patch.object(zap_disk, 'zap_disk')
-    def test_zap_luks_not_mapped(self, _zap_disk):
-        """Will zap disk with extra config set"""
-        def side_effect(arg):
-            return {
-                'devices': '/dev/vdb',
-                'i-really-mean-it': True,
-            }.get(arg)
+    def test_zap_tears_down_leftovers(self):
+        """Will remove stale mappings and discard when asked to"""
+        self.params.update({'devices': '/dev/vdb /dev/nvme0n1',
+                            'discard': True})
+        self.inventory['/dev/vdb'] = _info(
+            mappings=['ceph--block-osd', 'crypt-vdb'], fstype='crypto_LUKS')
+        self.inventory['/dev/nvme0n1'] = _info(fstype='LVM2_member',
+                                               discard=True)
+        zap_disk.zap()
+        self.wipe_block_device.assert_has_calls([
+            mock.call('/dev/vdb', ['ceph--block-osd', 'crypt-vdb'],
+                      'crypto_LUKS', discard=False),
+            mock.call('/dev/nvme0n1', [], 'LVM2_member', discard=True),
+        ], any_order=True)
 
-        self.is_active_bluestore_device.return_value = False
-        self.is_mapped_luks_device.return_value = False
+    def test_reports_failed_wipes(self):
+        """Devices which fail to wipe are reported and stay registered"""
+        self.params['devices'] = '/dev/vdb /dev/vdc'
 
-        self.hookenv.action_get.side_effect = side_effect
-        self.kv.get.return_value = ['/dev/vdb', '/dev/vdz']
+        def wipe(device, *args, **kwargs):
+            if device == '/dev/vdb':
+                raise OSError('device busy')
+        self.wipe_block_device.side_effect = wipe
         zap_disk.zap()
-        _zap_disk.assert_called_with('/dev/vdb')
-        self.kv.get.assert_called_with('osd-devices', [])
-        self.kv.set.assert_called_with('osd-devices', ['/dev/vdz'])
-        self.hookenv.action_set.assert_called_with({
-            'message': "1 disk(s) have been zapped, to use "
-                       "them as OSDs, run: \njuju "
-                       "run-action ceph-osd-test/0 add-disk "
-                       "osd-devices=\"/dev/vdb\""
-        })
+        self.assertEqual(self.registry.state('/dev/vdb'),
+                         device_registry.ACTIVE)
+        self.assertEqual(self.registry.state('/dev/vdc'),
+                         device_registry.ZAPPED)
+        self.hookenv.action_fail.assert_called_once_with(
+            "Failed to zap 1 device(s): /dev/vdb: device busy")
@@ -13,17 +13,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
 import copy
+import json
+import mock
 import unittest
 
 from mock import patch, MagicMock, call
 
 import charmhelpers.contrib.storage.linux.ceph as ceph
+from charmhelpers.core import unitdata
 
 with patch('charmhelpers.contrib.hardening.harden.harden') as mock_dec:
     mock_dec.side_effect = (lambda *dargs, **dkwargs: lambda f:
                             lambda *args, **kwargs: f(*args, **kwargs))
     import ceph_hooks
+import vault_approle
 
 CHARM_CONFIG = {'config-flags': '',
                 'loglevel': 1,
@@ -37,6 +42,7 @@ CHARM_CONFIG = {'config-flags': '',
                 'customize-failure-domain': False,
                 'bluestore': False,
                 'crush-initial-weight': '0',
+                'osd-weight-ramp-step': 0,
                 'bluestore': False,
                 'bluestore-block-wal-size': 0,
                 'bluestore-block-db-size': 0,
@@ -409,20 +415,22 @@ class CephHooksTestCase(unittest.TestCase):
         self.assertEqual(devices, ['/dev/vda', '/dev/vdb'])
 
     @patch.object(ceph_hooks, 'is_block_device')
-    @patch.object(ceph_hooks, 'get_blacklist')
+    @patch.object(ceph_hooks.device_registry, 'registry')
     @patch.object(ceph_hooks, 'storage_list')
     @patch.object(ceph_hooks, 'config')
     def test_get_devices_blacklist(self, mock_config, mock_storage_list,
-                                   mock_get_blacklist, mock_is_block_device):
+                                   mock_registry, mock_is_block_device):
         '''Devices returned as expected when blacklist in effect'''
         config = {'osd-devices': '/dev/vda /dev/vdb'}
         mock_config.side_effect = lambda key: config[key]
         mock_storage_list.return_value = []
-        mock_get_blacklist.return_value = ['/dev/vda']
+        mock_registry.return_value = ceph_hooks.device_registry.DeviceRegistry(
+            unitdata.Storage(':memory:'), by_id_dir='/nonexistent')
+        mock_registry.return_value.blacklist('/dev/vda')
         mock_is_block_device.return_value = True
         devices = ceph_hooks.get_devices()
         mock_storage_list.assert_called()
-        mock_get_blacklist.assert_called()
+        mock_registry.assert_called()
         self.assertEqual(devices, ['/dev/vdb'])
 
     @patch.object(ceph_hooks, 'log')
@@ -500,6 +508,96 @@ class CephHooksTestCase(unittest.TestCase):
         shutil.copy.assert_not_called()
         subprocess.check_call.assert_not_called()
 
+    @patch.object(ceph_hooks, 'update_metrics_state')
+    @patch.object(ceph_hooks, 'write_file')
+    @patch.object(ceph_hooks, 'render_template')
+    @patch.object(ceph_hooks, 'mkdir')
+    @patch.object(ceph_hooks, 'service_name')
+    @patch.object(ceph_hooks, 'config')
+    @patch.object(ceph_hooks, 'os')
+    @patch.object(ceph_hooks, 'ceph')
+    @patch.object(ceph_hooks, 'subprocess')
+    @patch.object(ceph_hooks, 'shutil')
+    def test_install_metrics_exporter(self, shutil, subprocess, ceph, os,
+                                      config, service_name, mkdir,
+                                      render_template, write_file,
+                                      update_metrics_state):
+        ceph.systemd.return_value = True
+        os.path.join.side_effect = lambda *args: '/'.join(args)
+        os.path.basename.side_effect = lambda p: p.split('/')[-1]
+        service_name.return_value = 'ceph-osd'
+        config.side_effect = lambda key: {
+            'metrics-textfile-dir': '/var/lib/prometheus/node-exporter',
+            'metrics-interval': 60}[key]
+        render_template.return_value = 'unit'
+        ceph_hooks.install_metrics_exporter()
+        shutil.copy.assert_called_once_with(
+            'files/metrics/charm_ceph_osd_metrics.py',
+            '/usr/local/bin/charm-ceph-osd-metrics')
+        render_template.assert_called_with(
+            'charm-ceph-osd-metrics.timer',
+            {'script': '/usr/local/bin/charm-ceph-osd-metrics',
+             'state_file': '/var/lib/charm/ceph-osd/metrics-state.json',
+             'textfile_dir': '/var/lib/prometheus/node-exporter',
+             'interval': 60})
+        write_file.assert_has_calls([
+            call('/etc/systemd/system/charm-ceph-osd-metrics.service',
+                 'unit', perms=0o644),
+            call('/etc/systemd/system/charm-ceph-osd-metrics.timer',
+                 'unit', perms=0o644),
+        ])
+        update_metrics_state.assert_called_once_with()
+        subprocess.check_call.assert_called_with(
+            ['systemctl', 'enable', '--now', 'charm-ceph-osd-metrics.timer'])
+
+    @patch.object(ceph_hooks, 'config')
+    @patch.object(ceph_hooks, 'os')
+    @patch.object(ceph_hooks, 'ceph')
+    @patch.object(ceph_hooks, 'subprocess')
+    def test_install_metrics_exporter_disabled(self, subprocess, ceph, os,
+                                               config):
+        ceph.systemd.return_value = True
+        os.path.join.side_effect = lambda *args: '/'.join(args)
+        os.path.exists.return_value = True
+        config.return_value = None
+        ceph_hooks.install_metrics_exporter()
+        subprocess.call.assert_called_once_with(
+            ['systemctl', 'disable', '--now', 'charm-ceph-osd-metrics.timer'])
+        os.unlink.assert_has_calls([
+            call('/etc/systemd/system/charm-ceph-osd-metrics.service'),
+            call('/etc/systemd/system/charm-ceph-osd-metrics.timer'),
+            call('/usr/local/bin/charm-ceph-osd-metrics'),
+        ])
+
+    @patch.object(ceph_hooks, 'time')
+    @patch.object(ceph_hooks, 'write_file')
+    @patch.object(ceph_hooks, 'mkdir')
+    @patch.object(ceph_hooks, 'get_journal_devices')
+    @patch.object(ceph_hooks, 'get_blacklist')
+    @patch.object(ceph_hooks.device_registry, 'registry')
+    @patch.object(ceph_hooks, 'service_name')
+    @patch.object(ceph_hooks, 'config')
+    def test_update_metrics_state(self, config, service_name, registry,
+                                  get_blacklist, get_journal_devices,
+                                  mkdir, write_file, _time):
+        config.return_value = '/var/lib/prometheus/node-exporter'
+        service_name.return_value = 'ceph-osd-missing'
+        registry.return_value.paths.return_value = set(['/dev/sdb'])
+        get_blacklist.return_value = ['/dev/sdc']
+        get_journal_devices.return_value = set(['/dev/sdd'])
+        _time.time.return_value = 1000
+        ceph_hooks.update_metrics_state('update-status', 1.23456)
+        write_file.assert_called_once_with(
+            '/var/lib/charm/ceph-osd-missing/metrics-state.json', mock.ANY,
+            perms=0o644)
+        self.assertEqual(json.loads(write_file.call_args[0][1]), {
+            'osd_devices': ['/dev/sdb'],
+            'blacklist': ['/dev/sdc'],
+            'journal_devices': ['/dev/sdd'],
+            'hooks': {'update-status': {'duration': 1.235,
+                                        'timestamp': 1000}},
+        })
+
     @patch.object(ceph_hooks, 'config')
     @patch.object(ceph_hooks, 'cmp_pkgrevno')
     def test_use_short_objects(self, mock_cmp_pkgrevno, mock_config):
@@ -523,6 +621,82 @@ class CephHooksTestCase(unittest.TestCase):
         self.assertTrue(ceph_hooks.use_short_objects())
 
 
+@patch.object(ceph_hooks, 'kv')
+@patch.object(ceph_hooks, 'shutil')
+@patch.object(ceph_hooks, 'mkdir')
+@patch.object(ceph_hooks, 'ceph')
+@patch.object(ceph_hooks, 'nrpe')
+class NRPETestCase(unittest.TestCase):
+
+    def test_update_nrpe_config(self, nrpe, ceph, mkdir, shutil, kv):
+        nrpe.get_nagios_unit_name.return_value = 'ceph-osd-0'
+        ceph.systemd.return_value = True
+        ceph.get_local_osd_ids.return_value = ['10', '2']
+        kv.return_value.get.return_value = ['2', '3']
+        ceph_hooks.update_nrpe_config()
+        nrpe_setup = nrpe.NRPE.return_value
+        nrpe_setup.remove_check.assert_has_calls([
+            call(shortname='ceph-osd'),
+            call(shortname='ceph-osd-3'),
+        ])
+        self.assertEqual(nrpe_setup.remove_check.call_count, 2)
+        shutil.copy.assert_called_once_with(
+            'files/nagios/check_ceph_osd_services.py',
+            '/usr/local/lib/nagios/plugins')
+        nrpe_setup.add_check.assert_has_calls([
+            call(shortname='ceph-osd-2',
+                 description='osd.2 process check {ceph-osd-0}',
+                 check_cmd='check_ceph_osd_services.py 2'),
+            call(shortname='ceph-osd-10',
+                 description='osd.10 process check {ceph-osd-0}',
+                 check_cmd='check_ceph_osd_services.py 10'),
+        ])
+        nrpe_setup.write.assert_called_once_with()
+        kv.return_value.set.assert_called_once_with('nrpe-osd-ids',
+                                                    ['2', '10'])
+
+    @patch.object(ceph_hooks, 'apt_install')
+    def test_update_nrpe_config_upstart(self, apt_install, nrpe, ceph,
+                                        mkdir, shutil, kv):
+        nrpe.get_nagios_unit_name.return_value = 'ceph-osd-0'
+        ceph.systemd.return_value = False
+        ceph.get_local_osd_ids.return_value = ['1']
+        kv.return_value.get.return_value = []
+        ceph_hooks.update_nrpe_config()
+        apt_install.assert_called_once_with('python3-dbus')
+        nrpe.NRPE.return_value.add_check.assert_called_once_with(
+            shortname='ceph-osd-1',
+            description='osd.1 process check {ceph-osd-0}',
+            check_cmd='check_upstart_job ceph-osd id=1')
+
+    @patch.object(ceph_hooks, 'update_nrpe_config')
+    def test_refresh_nrpe_checks(self, update_nrpe_config,
+                                 nrpe, ceph, mkdir, shutil, kv):
+        ceph.get_local_osd_ids.return_value = ['1', '0']
+        kv.return_value.get.return_value = ['0', '1']
+        ceph_hooks.refresh_nrpe_checks()
+        update_nrpe_config.assert_not_called()
+        ceph.get_local_osd_ids.return_value = ['1', '0', '2']
+        ceph_hooks.refresh_nrpe_checks()
+        update_nrpe_config.assert_called_once_with()
+
+    @patch.object(ceph_hooks, 'update_nrpe_config')
+    @patch.object(ceph_hooks, 'relation_ids')
+    def test_refresh_nrpe_checks_no_relation(self, relation_ids,
+                                             update_nrpe_config, nrpe, ceph,
+                                             mkdir, shutil, kv):
+        kv.return_value.get.return_value = None
+        ceph_hooks.refresh_nrpe_checks()
+        relation_ids.assert_not_called()
+        ceph.get_local_osd_ids.assert_not_called()
+        update_nrpe_config.assert_not_called()
+
+    def test_nrpe_relation_broken(self, nrpe, ceph, mkdir, shutil, kv):
+        ceph_hooks.nrpe_relation_broken()
+        kv.return_value.unset.assert_called_once_with('nrpe-osd-ids')
+        kv.return_value.flush.assert_called_once_with()
+
+
 @patch.object(ceph_hooks, 'relation_get')
 @patch.object(ceph_hooks, 'relation_set')
 @patch.object(ceph_hooks, 'prepare_disks_and_activate')
@@ -600,3 +774,85 @@ class VaultLockerTestCase(unittest.TestCase):
         _cmp_pkgrevno.return_value = -1
         self.assertRaises(ValueError,
                           ceph_hooks.use_vaultlocker)
+
+
+class VaultPreflightTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = unitdata.Storage(':memory:')
+        self.test_config = {
+            'osd-encrypt': True,
+            'osd-encrypt-keymanager': 'vault',
+        }
+        for name, value in (('config', None),
+                            ('cmp_pkgrevno', 1),
+                            ('kv', self.db),
+                            ('log', None),
+                            ('status_set', None),
+                            ('get_journal_devices', set()),
+                            ('get_devices', ['/dev/vdb']),
+                            ('is_device_mounted', False),
+                            ('emit_cephconf', None),
+                            ('tune_dm_crypt', None),
+                            ('is_unit_paused_set', False),
+                            ('charm_agent', None),
+                            ('device_registry', None),
+                            ('ceph', None),
+                            ('vaultlocker', None),
+                            ('vault_approle', None)):
+            _patch = patch.object(ceph_hooks, name, return_value=value)
+            setattr(self, name, _patch.start())
+            self.addCleanup(_patch.stop)
+        self.config.side_effect = self.test_config.get
+        _exists = patch.object(ceph_hooks.os.path, 'exists',
+                               return_value=True)
+        _exists.start()
+        self.addCleanup(_exists.stop)
+        self.device_registry.registry.return_value.state.return_value = None
+        self.ceph.get_devices.return_value = set()
+        self.ceph.is_active_bluestore_device.return_value = False
+        self.ceph.is_pristine_disk.return_value = True
+        self.ceph.is_bootstrapped.return_value = True
+        self.ceph.osdize_devs.return_value = {}
+        self.ceph.VAULT_KEY_MANAGER = 'vault'
+        vault_kv = self.vaultlocker.VaultKVContext.return_value
+        vault_kv.return_value = {
+            'vault_url': 'https://vault:8200', 'role_id': 'role',
+            'secret_id': 'secret',
+            'vault_ca': base64.b64encode(b'PEM').decode('UTF-8')}
+        vault_kv.complete = True
+        self.vault_approle.VaultError = vault_approle.VaultError
+        self.vault_approle.VaultRefused = vault_approle.VaultRefused
+
+    def test_checks_credentials_for_new_devices(self):
+        ceph_hooks.prepare_disks_and_activate()
+        self.vault_approle.check_credentials.assert_called_once_with(
+            'https://vault:8200', 'role', 'secret', ca='PEM')
+        self.ceph.osdize_devs.assert_called_once()
+
+    def test_no_vault_calls_without_new_devices(self):
+        self.ceph.is_active_bluestore_device.return_value = True
+        ceph_hooks.prepare_disks_and_activate()
+        self.vault_approle.check_credentials.assert_not_called()
+
+    def test_blocks_on_refused_credentials(self):
+        self.vault_approle.check_credentials.side_effect = (
+            vault_approle.VaultRefused('invalid role or secret ID'))
+        ceph_hooks.prepare_disks_and_activate()
+        self.status_set.assert_called_once_with(
+            'blocked', ceph_hooks.VAULT_REFUSED_MESSAGE)
+        self.assertTrue(self.db.get(ceph_hooks.VAULT_REFUSED_KEY))
+        self.ceph.osdize_devs.assert_not_called()
+
+        # accepted credentials clear the block
+        self.vault_approle.check_credentials.side_effect = None
+        ceph_hooks.prepare_disks_and_activate()
+        self.assertIsNone(self.db.get(ceph_hooks.VAULT_REFUSED_KEY))
+        self.ceph.osdize_devs.assert_called_once()
+
+    def test_defers_when_vault_unreachable(self):
+        self.vault_approle.check_credentials.side_effect = (
+            vault_approle.VaultError('connection refused'))
+        ceph_hooks.prepare_disks_and_activate()
+        self.status_set.assert_not_called()
+        self.ceph.osdize_devs.assert_not_called()
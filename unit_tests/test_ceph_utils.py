@@ -13,10 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
+import tempfile
 import unittest
 
 from mock import patch
 
+from charmhelpers.core import unitdata
+
 with patch('charmhelpers.contrib.hardening.harden.harden') as mock_dec:
     mock_dec.side_effect = (lambda *dargs, **dkwargs: lambda f:
                             lambda *args, **kwargs: f(*args, **kwargs))
@@ -43,21 +48,38 @@ class CephUtilsTestCase(unittest.TestCase):
         self.assertEqual(devices, set(['/dev/vda', '/dev/vdb']))
 
     @patch('os.path.exists')
-    @patch.object(utils, 'get_blacklist')
+    @patch.object(utils.device_registry, 'registry')
     @patch.object(utils, 'storage_list')
     @patch.object(utils, 'config')
     def test_get_journal_devices_blacklist(self, mock_config,
                                            mock_storage_list,
-                                           mock_get_blacklist,
+                                           mock_registry,
                                            mock_os_path_exists):
         '''Devices returned as expected when blacklist in effect'''
         config = {'osd-journal': '/dev/vda /dev/vdb'}
         mock_config.side_effect = lambda key: config[key]
         mock_storage_list.return_value = []
-        mock_get_blacklist.return_value = ['/dev/vda']
+        mock_registry.return_value = utils.device_registry.DeviceRegistry(
+            unitdata.Storage(':memory:'), by_id_dir='/nonexistent')
+        mock_registry.return_value.blacklist('/dev/vda')
         mock_os_path_exists.return_value = True
         devices = utils.get_journal_devices()
         mock_storage_list.assert_called()
         mock_os_path_exists.assert_called()
-        mock_get_blacklist.assert_called()
+        mock_registry.assert_called()
         self.assertEqual(devices, set(['/dev/vdb']))
+
+    def test_has_aes_instructions(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        cpuinfo = os.path.join(tmp, 'cpuinfo')
+        for content, expected in (
+                ('processor\t: 0\nflags\t\t: fpu sse2 aes avx\n', True),
+                ('processor\t: 0\nFeatures\t: fp asimd aes pmull\n', True),
+                ('processor\t: 0\nflags\t\t: fpu sse2 avx\n', False),
+                ('processor\t: 0\n', None)):
+            with open(cpuinfo, 'w') as f:
+                f.write(content)
+            self.assertEqual(utils.has_aes_instructions(cpuinfo), expected)
+        self.assertIsNone(
+            utils.has_aes_instructions(os.path.join(tmp, 'missing')))
@@ -0,0 +1,89 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mock import MagicMock, patch
+
+import charm_agent
+
+INVENTORY = {'disks': ['/dev/vdb', '/dev/vdc'], 'non-pristine': ['/dev/vdc'],
+             'timestamp': 1}
+
+
+class AgentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.socket = os.path.join(self.tmp, 'agent.sock')
+        _scan = patch.object(charm_agent, 'scan_inventory',
+                             return_value=INVENTORY)
+        self.scan_inventory = _scan.start()
+        self.addCleanup(_scan.stop)
+
+    def _start(self, monitor=None):
+        agent = charm_agent.Agent(self.socket, monitor)
+        thread = threading.Thread(target=agent.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(agent.stop)
+        deadline = time.time() + 5
+        while not os.path.exists(self.socket) and time.time() < deadline:
+            time.sleep(0.01)
+        return agent
+
+    def test_serves_cached_inventory(self):
+        self._start()
+        self.assertEqual(
+            charm_agent.call('ping', socket_path=self.socket)['pid'],
+            os.getpid())
+        for _ in range(2):
+            self.assertEqual(charm_agent.inventory(self.socket), INVENTORY)
+        self.assertEqual(self.scan_inventory.call_count, 1)
+
+        charm_agent.invalidate(self.socket)
+        charm_agent.inventory(self.socket)
+        self.assertEqual(self.scan_inventory.call_count, 2)
+
+    def test_udev_events_discard_inventory(self):
+        agent = charm_agent.Agent(self.socket, MagicMock())
+        agent.monitor.poll.side_effect = [MagicMock(), MagicMock(), None]
+        agent.inventory()
+        agent._udev_events()
+        agent.inventory()
+        self.assertEqual(self.scan_inventory.call_count, 2)
+        self.assertEqual(agent.monitor.poll.call_count, 3)
+
+    def test_errors(self):
+        self._start()
+        self.assertRaises(charm_agent.AgentUnavailable, charm_agent.call,
+                          'unknown', socket_path=self.socket)
+        self.scan_inventory.side_effect = OSError('udev unavailable')
+        with patch.object(charm_agent.logging, 'exception'):
+            self.assertRaises(charm_agent.AgentUnavailable,
+                              charm_agent.call, 'inventory',
+                              socket_path=self.socket)
+
+    def test_falls_back_without_agent(self):
+        self.assertRaises(charm_agent.AgentUnavailable, charm_agent.call,
+                          'ping', socket_path=self.socket)
+        self.assertEqual(charm_agent.inventory(self.socket), INVENTORY)
+        charm_agent.invalidate(self.socket)
@@ -0,0 +1,69 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from mock import patch
+
+sys.path.append('files/nagios')
+
+import check_ceph_osd_services as check
+
+SYSTEMCTL_SHOW = b"""Id=ceph-osd@0.service
+ActiveState=active
+SubState=running
+
+Id=ceph-osd@1.service
+ActiveState=failed
+SubState=failed
+"""
+
+
+class CheckCephOsdServicesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.osd_dir = os.path.join(self.tmp, 'osd')
+        for osd_id in ('0', '1'):
+            os.makedirs(os.path.join(self.osd_dir, 'ceph-{}'.format(osd_id)))
+        self.cache = os.path.join(self.tmp, 'cache.json')
+
+    @patch.object(check.subprocess, 'check_output')
+    def test_single_query_shared_by_checks(self, check_output):
+        check_output.return_value = SYSTEMCTL_SHOW
+        states = check.get_states(self.cache, 60, self.osd_dir)
+        check_output.assert_called_once_with(
+            ['systemctl', 'show', '--property=Id,ActiveState,SubState',
+             'ceph-osd@0.service', 'ceph-osd@1.service'])
+        self.assertEqual(check.check(['0'], states),
+                         (check.OK, 'OK: osd.0 running'))
+        self.assertEqual(check.check(['1'], states),
+                         (check.CRITICAL, 'CRITICAL: osd.1 failed/failed'))
+        # A second check within max-age reads the cached result
+        states = check.get_states(self.cache, 60, self.osd_dir)
+        self.assertEqual(check_output.call_count, 1)
+        self.assertEqual(check.check(['5'], states)[0], check.UNKNOWN)
+
+    @patch.object(check.subprocess, 'check_output')
+    def test_cache_invalidated_by_new_osd(self, check_output):
+        check_output.return_value = SYSTEMCTL_SHOW
+        check.get_states(self.cache, 60, self.osd_dir)
+        os.makedirs(os.path.join(self.osd_dir, 'ceph-2'))
+        check.get_states(self.cache, 60, self.osd_dir)
+        self.assertEqual(check_output.call_count, 2)
@@ -0,0 +1,134 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+import unittest
+
+# nagios_plugin is provided by the nrpe subordinate on deployed units, so
+# provide a minimal stand-in exposing the exceptions the check raises.
+nagios_plugin = types.ModuleType('nagios_plugin')
+for _name in ('CriticalError', 'WarnError', 'UnknownError'):
+    setattr(nagios_plugin, _name, type(_name, (Exception,), {}))
+sys.modules['nagios_plugin'] = nagios_plugin
+
+sys.path.append('files/nagios')
+
+import check_ceph_status
+
+STATUS = {
+    'health': {'status': 'HEALTH_OK', 'checks': {}},
+    'osdmap': {'osdmap': {'num_osds': 3, 'num_up_osds': 3,
+                          'num_in_osds': 3}},
+    'pgmap': {'pgs_by_state': [{'state_name': 'active+clean',
+                                'count': 64}]},
+}
+
+OSD_DF = {'nodes': [{'name': 'osd.0', 'utilization': 40.0},
+                    {'name': 'osd.1', 'utilization': 50.0}]}
+
+
+class CheckCephStatusTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.status_file = os.path.join(self.tmp, 'cat-ceph-status.json')
+        self.args = argparse.Namespace(
+            status_file=self.status_file, max_age=3600,
+            checks=list(check_ceph_status.CHECKS),
+            min_up_ratio=1.0, min_in_ratio=1.0,
+            full_warn=85.0, full_crit=95.0)
+
+    def _write(self, status=STATUS, osd_df=OSD_DF, age=0):
+        with open(self.status_file, 'w') as f:
+            json.dump({'timestamp': time.time() - age,
+                       'status': status, 'osd_df': osd_df}, f)
+
+    def test_all_ok(self):
+        self._write()
+        check_ceph_status.check_ceph_status(self.args)
+
+    def test_stale_file(self):
+        self._write(age=7200)
+        self.assertRaises(nagios_plugin.UnknownError,
+                          check_ceph_status.check_ceph_status, self.args)
+
+    def test_health_warn(self):
+        status = dict(STATUS, health={
+            'status': 'HEALTH_WARN',
+            'checks': {'OSDMAP_FLAGS': {'summary': {'message':
+                                                    'noout flag(s) set'}}}})
+        self._write(status=status)
+        with self.assertRaises(nagios_plugin.WarnError) as ctx:
+            check_ceph_status.check_ceph_status(self.args)
+        self.assertIn('noout flag(s) set', str(ctx.exception))
+
+    def test_health_err_pre_luminous(self):
+        status = dict(STATUS, health={
+            'overall_status': 'HEALTH_ERR',
+            'summary': [{'summary': '1 pgs inconsistent'}]})
+        self._write(status=status)
+        self.assertRaises(nagios_plugin.CriticalError,
+                          check_ceph_status.check_ceph_status, self.args)
+
+    def test_osds_down_compared_numerically(self):
+        # 10 > 9 but '10' < '9' as strings
+        status = dict(STATUS, osdmap={'num_osds': 10, 'num_up_osds': 9,
+                                      'num_in_osds': 10})
+        self._write(status=status)
+        with self.assertRaises(nagios_plugin.CriticalError) as ctx:
+            check_ceph_status.check_ceph_status(self.args)
+        self.assertIn('Total: 10, up: 9', str(ctx.exception))
+
+    def test_osds_up_ratio(self):
+        self.args.min_up_ratio = 0.8
+        status = dict(STATUS, osdmap={'num_osds': 10, 'num_up_osds': 9,
+                                      'num_in_osds': 10})
+        self._write(status=status)
+        check_ceph_status.check_ceph_status(self.args)
+
+    def test_pgs_inactive(self):
+        status = dict(STATUS, pgmap={'pgs_by_state': [
+            {'state_name': 'active+clean', 'count': 60},
+            {'state_name': 'peering', 'count': 4}]})
+        self._write(status=status)
+        self.assertRaises(nagios_plugin.CriticalError,
+                          check_ceph_status.check_pgs,
+                          check_ceph_status.load_status(self.args),
+                          self.args)
+
+    def test_pgs_degraded(self):
+        status = dict(STATUS, pgmap={'pgs_by_state': [
+            {'state_name': 'active+clean', 'count': 60},
+            {'state_name': 'active+undersized+degraded', 'count': 4}]})
+        self._write(status=status)
+        self.assertRaises(nagios_plugin.WarnError,
+                          check_ceph_status.check_pgs,
+                          check_ceph_status.load_status(self.args),
+                          self.args)
+
+    def test_nearfull(self):
+        self._write(osd_df={'nodes': [
+            {'name': 'osd.0', 'utilization': 90.0},
+            {'name': 'osd.1', 'utilization': 50.0}]})
+        with self.assertRaises(nagios_plugin.WarnError) as ctx:
+            check_ceph_status.check_ceph_status(self.args)
+        self.assertIn('osd.0', str(ctx.exception))
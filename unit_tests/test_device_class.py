@@ -0,0 +1,134 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import call, patch
+
+from ceph import broker
+from ceph import utils as ceph_utils
+
+
+class DeviceClassTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sys_block = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sys_block)
+
+    def _device(self, name, rotational, transport=None):
+        os.makedirs(os.path.join(self.sys_block, name, 'queue'))
+        os.makedirs(os.path.join(self.sys_block, name, 'device'))
+        with open(os.path.join(self.sys_block, name, 'queue',
+                               'rotational'), 'w') as f:
+            f.write('{}\n'.format(rotational))
+        if transport:
+            with open(os.path.join(self.sys_block, name, 'device',
+                                   'transport'), 'w') as f:
+                f.write('{}\n'.format(transport))
+
+    def test_device_class(self):
+        self._device('sdb', 1)
+        self._device('sdc', 0)
+        self._device('vdd', 0, transport='rdma')
+        self.assertEqual(ceph_utils.device_class('/dev/sdb', self.sys_block),
+                         'hdd')
+        self.assertEqual(ceph_utils.device_class('/dev/sdc', self.sys_block),
+                         'ssd')
+        self.assertEqual(ceph_utils.device_class('/dev/vdd', self.sys_block),
+                         'nvme')
+        self.assertEqual(
+            ceph_utils.device_class('/dev/nvme0n1', self.sys_block), 'nvme')
+        self.assertIsNone(
+            ceph_utils.device_class('/dev/sdz', self.sys_block))
+
+    @patch.object(ceph_utils, 'get_devices', lambda name: [])
+    def test_ceph_volume_crush_device_class(self):
+        cmd = ceph_utils._ceph_volume('/dev/nvme0n1', [], bluestore=True,
+                                      osd_fsid='a', data='ceph-a/osd-block-a',
+                                      crush_device_class='nvme')
+        self.assertEqual(cmd[cmd.index('--crush-device-class') + 1], 'nvme')
+        cmd = ceph_utils._ceph_volume('/dev/nvme0n1', [], bluestore=True,
+                                      osd_fsid='a', data='ceph-a/osd-block-a')
+        self.assertNotIn('--crush-device-class', cmd)
+
+
+@patch.object(broker, 'log')
+@patch.object(broker, 'cmp_pkgrevno', lambda *args: 1)
+@patch.object(broker, 'pool_set')
+@patch.object(broker, 'check_call')
+@patch.object(broker, 'check_output')
+class DeviceClassPoolTestCase(unittest.TestCase):
+
+    @patch.object(broker, 'ReplicatedPool')
+    @patch.object(broker, 'pool_exists', lambda **kwargs: True)
+    def test_replicated_pool_new_rule(self, _pool, _check_output,
+                                      _check_call, _pool_set, _log):
+        _check_output.return_value = json.dumps(
+            ['replicated_rule']).encode('UTF-8')
+        self.assertIsNone(broker.handle_replicated_pool(
+            {'name': 'fast', 'replicas': 3, 'device-class': 'nvme'},
+            'admin'))
+        _check_call.assert_called_once_with(
+            ['ceph', '--id', 'admin', 'osd', 'crush', 'rule',
+             'create-replicated', 'replicated_nvme', 'default', 'host',
+             'nvme'])
+        _pool_set.assert_called_once_with(
+            service='admin', pool_name='fast', key='crush_rule',
+            value='replicated_nvme')
+
+    @patch.object(broker, 'ReplicatedPool')
+    @patch.object(broker, 'pool_exists', lambda **kwargs: True)
+    def test_replicated_pool_reuses_rule(self, _pool, _check_output,
+                                         _check_call, _pool_set, _log):
+        _check_output.return_value = json.dumps(
+            ['replicated_rule', 'replicated_ssd']).encode('UTF-8')
+        broker.handle_replicated_pool(
+            {'name': 'fast', 'replicas': 3, 'device-class': 'ssd'}, 'admin')
+        _check_call.assert_not_called()
+        _pool_set.assert_called_once_with(
+            service='admin', pool_name='fast', key='crush_rule',
+            value='replicated_ssd')
+
+    def test_invalid_class(self, _check_output, _check_call, _pool_set,
+                           _log):
+        ret = broker.handle_replicated_pool(
+            {'name': 'fast', 'replicas': 3, 'device-class': 'ssd; rm'},
+            'admin')
+        self.assertEqual(ret['exit-code'], 1)
+        _check_call.assert_not_called()
+
+    @patch.object(broker, 'erasure_profile_exists', lambda **kwargs: True)
+    @patch.object(broker, 'pool_exists', lambda **kwargs: True)
+    @patch.object(broker, 'get_erasure_profile')
+    def test_erasure_pool(self, _get_erasure_profile, _check_output,
+                          _check_call, _pool_set, _log):
+        _check_output.return_value = b'[]'
+        _get_erasure_profile.return_value = {'k': '4', 'm': '2',
+                                             'plugin': 'jerasure'}
+        self.assertIsNone(broker.handle_erasure_pool(
+            {'name': 'cold', 'erasure-profile': 'ec42',
+             'device-class': 'hdd'}, 'admin'))
+        _check_call.assert_has_calls([
+            call(['ceph', '--id', 'admin', 'osd', 'erasure-code-profile',
+                  'set', 'ec42_hdd', 'crush-device-class=hdd', 'k=4', 'm=2',
+                  'plugin=jerasure', '--force']),
+            call(['ceph', '--id', 'admin', 'osd', 'crush', 'rule',
+                  'create-erasure', 'ec42_hdd', 'ec42_hdd'])])
+        _pool_set.assert_called_once_with(
+            service='admin', pool_name='cold', key='crush_rule',
+            value='ec42_hdd')
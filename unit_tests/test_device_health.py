@@ -0,0 +1,127 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+import device_health
+
+SMARTCTL_ATA = """\
+smartctl 6.6 2016-05-31 r4324 [x86_64-linux-4.15.0-29-generic] (local build)
+
+=== START OF READ SMART DATA SECTION ===
+SMART overall-health self-assessment test result: PASSED
+
+SMART Attributes Data Structure revision number: 16
+Vendor Specific SMART Attributes with Thresholds:
+ID# ATTRIBUTE_NAME          FLAG     VALUE WORST THRESH TYPE      UPDATED  WHEN_FAILED RAW_VALUE
+  1 Raw_Read_Error_Rate     0x000f   118   099   006    Pre-fail  Always       -       184467360
+  5 Reallocated_Sector_Ct   0x0033   100   100   010    Pre-fail  Always       -       {reallocated}
+  9 Power_On_Hours          0x0032   085   085   000    Old_age   Always       -       13574 (12 34 0)
+197 Current_Pending_Sector  0x0012   100   100   000    Old_age   Always       -       2
+"""  # noqa
+
+SMARTCTL_NVME = """\
+=== START OF SMART DATA SECTION ===
+SMART overall-health self-assessment test result: PASSED
+
+SMART/Health Information (NVMe Log 0x02, NSID 0xffffffff)
+Critical Warning:                   0x04
+Temperature:                        38 Celsius
+Percentage Used:                    3%
+Media and Data Integrity Errors:    1,024
+"""
+
+
+class DeviceHealthTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.sys_block = os.path.join(self.tmp, 'sys')
+        self.health_dir = os.path.join(self.tmp, 'health')
+
+    def _stat(self, name, reads, read_ticks, writes, write_ticks):
+        path = os.path.join(self.sys_block, name)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with open(os.path.join(path, 'stat'), 'w') as f:
+            f.write('{} 0 0 {} {} 0 0 {} 0 0 0\n'.format(
+                reads, read_ticks, writes, write_ticks))
+
+    def test_parse_smartctl_ata(self):
+        self.assertEqual(
+            device_health.parse_smartctl(
+                SMARTCTL_ATA.format(reallocated=8)),
+            {'smart_ok': 1, 'reallocated': 8, 'pending': 2,
+             'media_errors': -1})
+
+    def test_parse_smartctl_nvme(self):
+        self.assertEqual(
+            device_health.parse_smartctl(SMARTCTL_NVME),
+            {'smart_ok': 0, 'reallocated': -1, 'pending': -1,
+             'media_errors': 1024})
+
+    def test_parse_smartctl_unavailable(self):
+        self.assertEqual(
+            device_health.parse_smartctl(''),
+            {'smart_ok': -1, 'reallocated': -1, 'pending': -1,
+             'media_errors': -1})
+
+    def test_ring_buffer_wraps(self):
+        ring = device_health.RingBuffer(os.path.join(self.tmp, 'ring'),
+                                        capacity=3)
+        for i in range(5):
+            ring.append(device_health.Sample(i, 0, 0, 0, 0, 1, 0, 0, 0))
+        self.assertEqual([s.timestamp for s in ring.samples()], [2, 3, 4])
+        self.assertEqual(os.path.getsize(ring.path),
+                         ring.HEADER.size + 3 * ring.RECORD.size)
+
+    def test_ring_buffer_empty(self):
+        ring = device_health.RingBuffer(os.path.join(self.tmp, 'missing'))
+        self.assertEqual(ring.samples(), [])
+
+    @patch.object(device_health, 'device_name', lambda dev: dev[5:])
+    def test_record_and_assess(self):
+        smart = {'/dev/sdb': SMARTCTL_ATA.format(reallocated=0),
+                 '/dev/sdc': SMARTCTL_ATA.format(reallocated=0),
+                 '/dev/sdd': SMARTCTL_ATA.format(reallocated=0)}
+
+        def record():
+            device_health.record_samples(
+                ['/dev/sdb', '/dev/sdc', '/dev/sdd', '/dev/sdz'],
+                self.health_dir, self.sys_block, smart.get)
+
+        for name in ('sdb', 'sdc', 'sdd'):
+            self._stat(name, 100, 500, 100, 500)
+        record()
+        # sdb: 10ms await, sdc: 400ms await and reallocating sectors
+        self._stat('sdb', 200, 1500, 200, 1500)
+        self._stat('sdc', 200, 40500, 200, 40500)
+        self._stat('sdd', 200, 1500, 200, 1500)
+        smart['/dev/sdc'] = SMARTCTL_ATA.format(reallocated=16)
+        record()
+
+        history = device_health.get_history(
+            ['/dev/sdb', '/dev/sdc', '/dev/sdd', '/dev/sdz'],
+            self.health_dir)
+        self.assertEqual(len(history['/dev/sdb']), 2)
+        self.assertEqual(history['/dev/sdz'], [])
+        self.assertEqual(device_health.assess_devices(history),
+                         {'/dev/sdc': ['reallocated growing',
+                                       'await 400ms']})
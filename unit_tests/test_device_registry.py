@@ -0,0 +1,410 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
+
+from ceph import device_registry
+from ceph import utils as ceph_utils
+from ceph.device_registry import (
+    ACTIVE,
+    BLACKLISTED,
+    DISCOVERED,
+    FAILED,
+    PREPARING,
+    PRISTINE,
+    ZAPPED,
+    DeviceRegistry,
+    InvalidTransition,
+)
+
+
+class DeviceRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.by_id = os.path.join(self.tmp, 'by-id')
+        os.mkdir(self.by_id)
+        self.sdb = os.path.join(self.tmp, 'sdb')
+        open(self.sdb, 'w').close()
+        for name in ('ata-DISK_SERIAL1', 'wwn-0x5000c500a1b2c3d4'):
+            os.symlink(self.sdb, os.path.join(self.by_id, name))
+        self.db = unitdata.Storage(':memory:')
+
+    def _registry(self):
+        return DeviceRegistry(self.db, by_id_dir=self.by_id)
+
+    def test_identity_prefers_wwn(self):
+        registry = self._registry()
+        self.assertEqual(registry.identity(self.sdb),
+                         'wwn-0x5000c500a1b2c3d4')
+        self.assertEqual(registry.identity('/dev/unknown'), '/dev/unknown')
+
+    def test_lifecycle(self):
+        registry = self._registry()
+        self.assertIsNone(registry.state(self.sdb))
+        registry.transition(self.sdb, PRISTINE)
+        registry.transition(self.sdb, PREPARING)
+        record = registry.transition(self.sdb, ACTIVE, osd_id=3)
+        self.assertEqual(record['id'], 'wwn-0x5000c500a1b2c3d4')
+        self.assertEqual(record['osd_id'], 3)
+        self.assertEqual(sorted(record['timestamps']),
+                         [ACTIVE, PREPARING, PRISTINE])
+        self.assertRaises(InvalidTransition,
+                          registry.transition, self.sdb, PRISTINE)
+
+        registry.transition(self.sdb, ZAPPED)
+        self.assertIsNone(registry.lookup(self.sdb)['osd_id'])
+        self.assertEqual(device_registry.osd_ids(registry.lookup(self.sdb)),
+                         [])
+        registry.transition(self.sdb, PREPARING)
+        registry.transition(self.sdb, FAILED)
+        self.assertEqual(self._registry().state(self.sdb), FAILED)
+
+    def test_paths_of_one_device_share_a_record(self):
+        registry = self._registry()
+        registry.transition(self.sdb, ACTIVE)
+        alias = os.path.join(self.by_id, 'ata-DISK_SERIAL1')
+        self.assertEqual(registry.state(alias), ACTIVE)
+        self.assertEqual(registry.paths(ACTIVE), set([self.sdb, alias]))
+        self.assertEqual(len(registry.devices()), 1)
+
+        # the by-id links are only read once per hook
+        with patch.object(device_registry.os, 'listdir') as listdir:
+            self.assertEqual(self._registry().state(alias), ACTIVE)
+        listdir.assert_not_called()
+
+    def test_blacklist(self):
+        registry = self._registry()
+        registry.transition(self.sdb, ACTIVE)
+        registry.blacklist(self.sdb)
+        registry.blacklist('/dev/vdc')
+        self.assertEqual(registry.paths(BLACKLISTED),
+                         set([self.sdb, '/dev/vdc']))
+        self.assertRaises(InvalidTransition,
+                          registry.transition, self.sdb, PREPARING)
+
+        # zapping keeps the device blacklisted
+        registry.transition('/dev/vdc', ZAPPED)
+        registry.unblacklist(self.sdb)
+        registry.unblacklist('/dev/vdc')
+        self.assertEqual(registry.state(self.sdb), ACTIVE)
+        self.assertEqual(registry.state('/dev/vdc'), ZAPPED)
+        self.assertRaises(InvalidTransition,
+                          registry.unblacklist, self.sdb)
+
+    def test_blacklisted_follows_renames(self):
+        registry = self._registry()
+        registry.blacklist(self.sdb)
+        registry.blacklist('/dev/vdc')
+        # the disk comes back under another kernel name
+        sdc = os.path.join(self.tmp, 'sdc')
+        os.rename(self.sdb, sdc)
+        for name in os.listdir(self.by_id):
+            os.unlink(os.path.join(self.by_id, name))
+            os.symlink(sdc, os.path.join(self.by_id, name))
+        # by-id links are read once per hook
+        self.assertNotEqual(self._registry().identity(sdc),
+                            'wwn-0x5000c500a1b2c3d4')
+        hookenv.flush(self.by_id)
+        registry = self._registry()
+        self.assertEqual(
+            registry.blacklisted([sdc, self.sdb, '/dev/vdc', '/dev/vdd']),
+            set([sdc, '/dev/vdc']))
+
+    def test_lookup_follows_swapped_names(self):
+        sdc = os.path.join(self.tmp, 'sdc')
+        open(sdc, 'w').close()
+        os.symlink(sdc, os.path.join(self.by_id, 'wwn-0x5000c500ffffffff'))
+        registry = self._registry()
+        registry.blacklist(self.sdb)
+        registry.transition(sdc, ACTIVE, osd_id=4)
+        # after a reboot the two disks have swapped kernel names
+        for name in os.listdir(self.by_id):
+            target = os.readlink(os.path.join(self.by_id, name))
+            os.unlink(os.path.join(self.by_id, name))
+            os.symlink(sdc if target == self.sdb else self.sdb,
+                       os.path.join(self.by_id, name))
+        hookenv.flush(self.by_id)
+        registry = self._registry()
+        self.assertEqual(registry.state(self.sdb), ACTIVE)
+        self.assertEqual(registry.state(sdc), BLACKLISTED)
+        self.assertEqual(registry.lookup(self.sdb)['paths'], [self.sdb])
+        self.assertEqual(registry.blacklisted([self.sdb, sdc]), set([sdc]))
+
+    def test_migrates_legacy_lists(self):
+        self.db.set('osd-devices', [self.sdb, '/dev/vdc'])
+        self.db.set('osd-blacklist', ['/dev/vdd'])
+        registry = self._registry()
+        self.assertIsNone(self.db.get('osd-devices'))
+        self.assertIsNone(self.db.get('osd-blacklist'))
+        self.assertEqual(registry.paths(ACTIVE), set([self.sdb, '/dev/vdc']))
+        self.assertEqual(registry.paths(BLACKLISTED), set(['/dev/vdd']))
+        self.assertEqual(registry.state('/dev/vdd'), BLACKLISTED)
+        registry.unblacklist('/dev/vdd')
+        self.assertEqual(registry.state('/dev/vdd'), DISCOVERED)
+
+    def test_processed_states(self):
+        self.assertEqual(device_registry.processed_states(), (ACTIVE,))
+        self.assertEqual(device_registry.processed_states(True),
+                         (ACTIVE, FAILED))
+
+
+class OsdizeDevTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = DeviceRegistry(unitdata.Storage(':memory:'),
+                                       by_id_dir='/nonexistent')
+        _registry = patch.object(device_registry, 'registry',
+                                 return_value=self.registry)
+        _registry.start()
+        self.addCleanup(_registry.stop)
+        for name, value in (('log', None),
+                            ('config', None),
+                            ('status_set', None),
+                            ('is_block_device', True),
+                            ('is_osd_disk', False),
+                            ('is_device_mounted', False),
+                            ('is_active_bluestore_device', False),
+                            ('is_mapped_luks_device', False),
+                            ('cmp_pkgrevno', 1),
+                            ('device_class', 'ssd'),
+                            ('_osd_id_for_fsid', 7)):
+            _patch = patch.object(ceph_utils, name, return_value=value)
+            setattr(self, name, _patch.start())
+            self.addCleanup(_patch.stop)
+        _exists = patch.object(ceph_utils.os.path, 'exists',
+                               return_value=True)
+        _exists.start()
+        self.addCleanup(_exists.stop)
+
+    @patch.object(ceph_utils.subprocess, 'check_call')
+    @patch.object(ceph_utils, '_ceph_volume')
+    def test_records_lifecycle(self, _ceph_volume, _check_call):
+        _ceph_volume.return_value = ['ceph-volume', 'lvm', 'create',
+                                     '--osd-fsid', 'abc']
+        ceph_utils.osdize_dev('/dev/vdb', 'xfs', [])
+        record = self.registry.lookup('/dev/vdb')
+        self.assertEqual(record['state'], ACTIVE)
+        self.assertEqual(record['osd_id'], 7)
+        self.assertIn(PREPARING, record['timestamps'])
+        self._osd_id_for_fsid.assert_called_once_with('abc')
+        self.assertEqual(_ceph_volume.call_args[1]['crush_device_class'],
+                         'ssd')
+
+        # processed devices are not considered again
+        ceph_utils.osdize_dev('/dev/vdb', 'xfs', [])
+        _check_call.assert_called_once_with(_ceph_volume.return_value)
+
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    @patch.object(ceph_utils.subprocess, 'check_call')
+    @patch.object(ceph_utils, '_ceph_volume')
+    def test_records_failure(self, _ceph_volume, _check_call, _check_output):
+        _check_call.side_effect = ceph_utils.subprocess.CalledProcessError(
+            1, 'ceph-volume')
+        _check_output.return_value = b''
+        ceph_utils.osdize_dev('/dev/vdb', 'xfs', [], ignore_errors=True)
+        self.assertEqual(self.registry.state('/dev/vdb'), FAILED)
+        self.assertRaises(ceph_utils.subprocess.CalledProcessError,
+                          ceph_utils.osdize_dev, '/dev/vdc', 'xfs', [])
+        self.assertEqual(self.registry.state('/dev/vdc'), FAILED)
+
+    @patch.object(ceph_utils, '_pv_logical_volumes',
+                  lambda dev: (None, set()))
+    @patch.object(ceph_utils.subprocess, 'check_call')
+    def test_resumes_interrupted_prepare(self, _check_call):
+        self.registry.transition('/dev/vdb', PREPARING)
+        self.is_active_bluestore_device.return_value = True
+        ceph_utils.osdize_dev('/dev/vdb', 'xfs', [])
+        self.assertEqual(self.registry.state('/dev/vdb'), ACTIVE)
+        _check_call.assert_not_called()
+
+    @patch.object(ceph_utils, '_ceph_volume')
+    @patch.object(ceph_utils, '_pv_logical_volumes')
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    @patch.object(ceph_utils.subprocess, 'check_call')
+    def test_resume_completes_split_device(self, _check_call, _check_output,
+                                           _pv_logical_volumes,
+                                           _ceph_volume):
+        self.registry.transition('/dev/nvme0n1', PREPARING)
+        self.is_active_bluestore_device.return_value = True
+        _pv_logical_volumes.return_value = (
+            'ceph-a', set(['osd-block-a', 'osd-block-b']))
+        _check_output.return_value = (
+            b'  osd-block-a ceph.osd_fsid=a,ceph.osd_id=7\n'
+            b'  osd-block-b\n')
+        _ceph_volume.return_value = ['ceph-volume', 'lvm', 'create']
+        osd_ids = {'a': 7, 'b': 8}
+        self._osd_id_for_fsid.side_effect = osd_ids.get
+        ceph_utils.osdize_dev('/dev/nvme0n1', 'xfs', [])
+        _ceph_volume.assert_called_once_with(
+            '/dev/nvme0n1', [], None, True, ceph_utils.CEPH_KEY_MANAGER,
+            'b', data='ceph-a/osd-block-b', crush_device_class='ssd')
+        _check_call.assert_called_once_with(_ceph_volume.return_value)
+        record = self.registry.lookup('/dev/nvme0n1')
+        self.assertEqual(record['state'], ACTIVE)
+        self.assertEqual(record['osd_ids'], [7, 8])
+
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    @patch.object(ceph_utils.subprocess, 'check_call')
+    @patch.object(ceph_utils, '_plan_osdize_dev')
+    def test_split_failure_keeps_created_osds(self, _plan_osdize_dev,
+                                              _check_call, _check_output):
+        _plan_osdize_dev.return_value = [
+            ['ceph-volume', 'lvm', 'create', '--osd-fsid', 'a'],
+            ['ceph-volume', 'lvm', 'create', '--osd-fsid', 'b']]
+        _check_output.return_value = b''
+        _check_call.side_effect = [
+            None, ceph_utils.subprocess.CalledProcessError(1, 'ceph-volume')]
+        self._osd_id_for_fsid.side_effect = {'a': 7}.get
+        ceph_utils.osdize_dev('/dev/nvme0n1', 'xfs', [], ignore_errors=True)
+        record = self.registry.lookup('/dev/nvme0n1')
+        self.assertEqual(record['state'], FAILED)
+        self.assertEqual(record['osd_ids'], [7])
+
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    @patch.object(ceph_utils.subprocess, 'check_call')
+    @patch.object(ceph_utils, '_ceph_volume')
+    def test_osdize_devs(self, _ceph_volume, _check_call, _check_output):
+        _ceph_volume.side_effect = lambda dev, *args, **kwargs: [
+            'ceph-volume', 'lvm', 'create', '--data', dev]
+        _check_output.return_value = b''
+
+        def check_call(cmd):
+            if cmd[-1] == '/dev/vdc':
+                raise ceph_utils.subprocess.CalledProcessError(1, cmd)
+        _check_call.side_effect = check_call
+        self.registry.transition('/dev/vde', ACTIVE)
+        devices = ['/dev/vdb', '/dev/vdc', '/dev/vdd', '/dev/vde']
+        timings = ceph_utils.osdize_devs(devices, 'xfs', [],
+                                         ignore_errors=True, parallel=2)
+        self.assertEqual(sorted(timings), ['/dev/vdb', '/dev/vdd'])
+        self.assertEqual(_check_call.call_count, 3)
+        self.assertEqual(self.registry.state('/dev/vdc'), FAILED)
+        self.assertEqual(self.registry.state('/dev/vdd'), ACTIVE)
+
+        # without ignore-device-errors the failure is raised once every
+        # device has been attempted
+        self.assertRaises(ceph_utils.subprocess.CalledProcessError,
+                          ceph_utils.osdize_devs, ['/dev/vdc', '/dev/vdf'],
+                          'xfs', [])
+        self.assertEqual(self.registry.state('/dev/vdf'), ACTIVE)
+
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    @patch.object(ceph_utils.subprocess, 'check_call')
+    @patch.object(ceph_utils, '_ceph_volume')
+    def test_osdize_devs_planning_failure(self, _ceph_volume, _check_call,
+                                          _check_output):
+        def ceph_volume(dev, *args, **kwargs):
+            if dev == '/dev/vdc':
+                raise ceph_utils.subprocess.CalledProcessError(5, 'lvcreate')
+            return ['ceph-volume', 'lvm', 'create', '--data', dev]
+        _ceph_volume.side_effect = ceph_volume
+        _check_output.return_value = b''
+        self.registry.transition('/dev/vdc', PRISTINE)
+        self.assertRaises(ceph_utils.subprocess.CalledProcessError,
+                          ceph_utils.osdize_devs,
+                          ['/dev/vdb', '/dev/vdc', '/dev/vdd'], 'xfs', [])
+        # the devices planned before and after the failure still get OSDs
+        self.assertEqual(self.registry.state('/dev/vdb'), ACTIVE)
+        self.assertEqual(self.registry.state('/dev/vdc'), FAILED)
+        self.assertEqual(self.registry.state('/dev/vdd'), ACTIVE)
+        self.assertEqual(_check_call.call_count, 2)
+
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    @patch.object(ceph_utils.subprocess, 'check_call')
+    @patch.object(ceph_utils, '_luks_uuid')
+    @patch.object(ceph_utils, '_ceph_volume')
+    def test_osdize_devs_encrypts_first(self, _ceph_volume, _luks_uuid,
+                                        _check_call, _check_output):
+        _ceph_volume.side_effect = lambda dev, *args, **kwargs: [
+            'ceph-volume', 'lvm', 'create', '--osd-fsid', args[-1]]
+        _luks_uuid.return_value = None
+        _check_output.return_value = b''
+        ceph_utils.os.path.exists.side_effect = (
+            lambda path: not path.startswith('/dev/mapper/'))
+        encrypted = {}
+
+        def check_call(cmd):
+            if cmd[0] == 'vaultlocker':
+                if cmd[-1] == '/dev/vdc':
+                    raise ceph_utils.subprocess.CalledProcessError(1, cmd)
+                encrypted[cmd[-1]] = cmd[3]
+        _check_call.side_effect = check_call
+        timings = ceph_utils.osdize_devs(
+            ['/dev/vdb', '/dev/vdc', '/dev/vdd'], 'xfs', [],
+            ignore_errors=True, encrypt=True,
+            key_manager=ceph_utils.VAULT_KEY_MANAGER)
+        self.assertEqual(sorted(timings), ['/dev/vdb', '/dev/vdd'])
+        self.assertEqual(self.registry.state('/dev/vdc'), FAILED)
+        # the OSDs are created with the fsid their devices were encrypted
+        # with, and not at all where encryption failed
+        for dev in ('/dev/vdb', '/dev/vdd'):
+            _check_call.assert_any_call(
+                ['ceph-volume', 'lvm', 'create', '--osd-fsid',
+                 encrypted[dev]])
+        self.assertEqual(_ceph_volume.call_count, 2)
+
+    @patch.object(ceph_utils, 'get_devices')
+    @patch.object(ceph_utils, 'is_rotational')
+    @patch.object(ceph_utils, 'lvm')
+    @patch.object(ceph_utils.subprocess, 'check_call')
+    def test_osds_per_device(self, _check_call, _lvm, _is_rotational,
+                             _get_devices):
+        self.config.side_effect = {'osds-per-device': 2}.get
+        _is_rotational.return_value = False
+        _get_devices.return_value = set()
+        _lvm.is_lvm_physical_volume.return_value = False
+        osd_ids = iter([7, 8])
+        self._osd_id_for_fsid.side_effect = lambda fsid: next(osd_ids)
+        self.assertTrue(ceph_utils.osdize_dev('/dev/nvme0n1', 'xfs', [],
+                                              bluestore=True))
+        vg_name = _lvm.create_lvm_volume_group.call_args[0][0]
+        lvcreates = [c[0][0] for c in _check_call.call_args_list
+                     if c[0][0][0] == 'lvcreate']
+        creates = [c[0][0] for c in _check_call.call_args_list
+                   if c[0][0][0] == 'ceph-volume']
+        self.assertEqual(len(lvcreates), 2)
+        self.assertEqual(lvcreates[0][:4],
+                         ['lvcreate', '--yes', '-l', '50%VG'])
+        self.assertEqual(
+            [cmd[cmd.index('--data') + 1] for cmd in creates],
+            ['{}/{}'.format(vg_name, cmd[5]) for cmd in lvcreates])
+        record = self.registry.lookup('/dev/nvme0n1')
+        self.assertEqual(record['osd_ids'], [7, 8])
+        self.assertEqual(device_registry.osd_ids(record), [7, 8])
+
+        # rotational devices are not split
+        _is_rotational.return_value = True
+        self.assertEqual(ceph_utils.osds_per_device('/dev/sdb'), 1)
+
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    def test_get_ceph_volume_osds(self, _check_output):
+        _check_output.return_value = json.dumps({
+            '0': [{'type': 'block', 'devices': ['/dev/vdb']},
+                  {'type': 'db', 'devices': ['/dev/nvme0n1']}],
+            '1': [{'type': 'block', 'devices': ['/dev/vdc']}],
+            '2': [{'type': 'block', 'devices': ['/dev/vdc']}],
+        }).encode('UTF-8')
+        self.assertEqual(ceph_utils.get_ceph_volume_osds(),
+                         {'/dev/vdb': [0], '/dev/vdc': [1, 2]})
@@ -0,0 +1,124 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+# installs a fake python-apt module used by the hardening apt audits
+import test_utils  # noqa
+
+from charmhelpers.core import unitdata
+from charmhelpers.contrib.hardening import audits
+from charmhelpers.contrib.hardening.audits import file as file_audits
+from charmhelpers.contrib.hardening.host.checks import suid_sgid
+
+
+class RunAuditsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'file')
+        with open(self.path, 'w') as f:
+            f.write('data')
+        os.chmod(self.path, 0o644)
+        self.kv = unitdata.Storage(':memory:')
+        _kv = patch.object(audits.unitdata, 'kv', return_value=self.kv)
+        _kv.start()
+        self.addCleanup(_kv.stop)
+
+    def _audit(self, cls, *args, **kwargs):
+        # Subclass rather than mock ensure_compliance on the instance, as
+        # instance attributes are part of an audit's fingerprint.
+        calls = []
+        counting = type(cls.__name__, (cls,), {
+            'ensure_compliance': lambda audit: calls.append(audit)})
+        return counting(*args, **kwargs), calls
+
+    def test_skips_unchanged_file_audit(self):
+        audit, calls = self._audit(file_audits.NoSUIDSGIDAudit, [self.path])
+        audits.run_audits([audit], {'setting': 1})
+        audits.run_audits([audit], {'setting': 1})
+        self.assertEqual(len(calls), 1)
+
+        # permission change
+        os.chmod(self.path, 0o600)
+        audits.run_audits([audit], {'setting': 1})
+        self.assertEqual(len(calls), 2)
+
+        # settings change
+        audits.run_audits([audit], {'setting': 2})
+        self.assertEqual(len(calls), 3)
+
+    def test_always_runs_unfingerprinted_audits(self):
+        recursive, recursive_calls = self._audit(file_audits.ReadOnly,
+                                                 [self.tmp])
+        unless, unless_calls = self._audit(file_audits.NoSUIDSGIDAudit,
+                                           [self.path], unless=lambda: False)
+        base, base_calls = self._audit(audits.BaseAudit)
+        for _ in range(2):
+            audits.run_audits([recursive, unless, base])
+        self.assertEqual(len(recursive_calls), 2)
+        self.assertEqual(len(unless_calls), 2)
+        self.assertEqual(len(base_calls), 2)
+
+
+class SUIDSGIDScanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.kv = unitdata.Storage(':memory:')
+        _kv = patch.object(suid_sgid.unitdata, 'kv', return_value=self.kv)
+        _kv.start()
+        self.addCleanup(_kv.stop)
+        # hookenv.log would otherwise go through the patched Popen
+        _log = patch.object(suid_sgid, 'log')
+        _log.start()
+        self.addCleanup(_log.stop)
+
+    @patch.object(suid_sgid.subprocess, 'Popen')
+    def test_find_paths_with_suid_sgid(self, _popen):
+        _popen.return_value.communicate.return_value = (
+            b'/bin/su\n/usr/bin/sudo\n', b'')
+        paths = suid_sgid.find_paths_with_suid_sgid(
+            '/', skip_paths=['/var/lib/ceph/osd', '/proc'], interval=3600)
+        self.assertEqual(paths, set(['/bin/su', '/usr/bin/sudo']))
+        _popen.assert_called_once_with(
+            ['find', '/',
+             '-path', '/proc', '-prune', '-o',
+             '-path', '/var/lib/ceph/osd', '-prune', '-o',
+             '-type', 'f', '(', '-perm', '-4000', '-o', '-perm', '-2000',
+             ')', '-print'],
+            stdout=suid_sgid.subprocess.PIPE,
+            stderr=suid_sgid.subprocess.PIPE)
+
+        # reused within the interval
+        self.assertEqual(
+            suid_sgid.find_paths_with_suid_sgid(
+                '/', skip_paths=['/proc', '/var/lib/ceph/osd'],
+                interval=3600),
+            paths)
+        self.assertEqual(_popen.call_count, 1)
+
+        # but not once it has elapsed or the parameters changed
+        suid_sgid.find_paths_with_suid_sgid('/', interval=3600)
+        self.assertEqual(_popen.call_count, 2)
+        with patch.object(suid_sgid.time, 'time') as _time:
+            _time.return_value = self.kv.get(
+                suid_sgid.SCAN_KEY)['timestamp'] + 3601
+            suid_sgid.find_paths_with_suid_sgid('/', interval=3600)
+        self.assertEqual(_popen.call_count, 3)
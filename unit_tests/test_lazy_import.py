@@ -0,0 +1,105 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from mock import patch
+
+import lazy_import
+
+CHARM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules which importing the hook entry point must not pull in; see
+# "Hook start-up cost" in README.md.
+DEFERRED_MODULES = [
+    'ceph.primary_affinity',
+    'ceph.utils',
+    'ceph.weight_ramp',
+    'charmhelpers.contrib.charmsupport.nrpe',
+    'charmhelpers.contrib.hardening.host.checks',
+    'charmhelpers.contrib.network.ip',
+    'charmhelpers.contrib.openstack.context',
+    'charmhelpers.contrib.openstack.vaultlocker',
+    'charmhelpers.contrib.storage.linux.ceph',
+    'dns.resolver',
+    'jinja2',
+    'netifaces',
+    'pyudev',
+    'vault_approle',
+]
+
+# Modules which the update-status path, including assess_status(), must
+# not pull in.
+UPDATE_STATUS_DEFERRED_MODULES = [
+    'charmhelpers.contrib.hardening.host.checks',
+    'charmhelpers.contrib.openstack.context',
+    'charmhelpers.contrib.openstack.utils',
+    'charmhelpers.contrib.storage.linux.ceph',
+    'dns.resolver',
+    'jinja2',
+    'pyudev',
+]
+
+PROBE = """
+import json, sys
+sys.path.insert(0, 'hooks')
+sys.path.insert(0, 'lib')
+import ceph_hooks
+{extra}
+print(json.dumps(sorted(sys.modules)))
+"""
+
+
+def _loaded_modules(extra=''):
+    output = subprocess.check_output(
+        [sys.executable, '-c', PROBE.format(extra=extra)], cwd=CHARM_DIR)
+    return set(json.loads(output.decode('UTF-8').splitlines()[-1]))
+
+
+class LazyImportTestCase(unittest.TestCase):
+
+    def test_lazy_module(self):
+        module = lazy_import.LazyModule('json')
+        self.assertEqual(module.loads('[1]'), [1])
+        self.assertIs(module.dumps, json.dumps)
+
+    def test_lazy_module_patch(self):
+        module = lazy_import.LazyModule('json')
+        with patch.object(module, 'loads') as _loads:
+            self.assertIs(json.loads, _loads)
+            self.assertIs(module.loads, _loads)
+        self.assertIsNot(json.loads, _loads)
+
+    def test_lazy_callable(self):
+        dumps = lazy_import.lazy_callable('json', 'dumps')
+        self.assertEqual(dumps.__name__, 'dumps')
+        self.assertEqual(dumps([1]), '[1]')
+
+
+class ImportBudgetTestCase(unittest.TestCase):
+
+    def test_hook_import_defers_modules(self):
+        loaded = _loaded_modules()
+        self.assertEqual(
+            sorted(loaded.intersection(DEFERRED_MODULES)), [])
+
+    def test_update_status_defers_modules(self):
+        loaded = _loaded_modules('ceph_hooks.ceph.get_running_osds')
+        self.assertIn('ceph.utils', loaded)
+        self.assertEqual(
+            sorted(loaded.intersection(UPDATE_STATUS_DEFERRED_MODULES)), [])
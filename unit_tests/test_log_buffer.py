@@ -0,0 +1,94 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import unittest
+
+from mock import call, patch
+
+from charmhelpers.core import hookenv
+
+import log_buffer
+
+
+@patch.object(log_buffer.subprocess, 'call')
+class BufferedJujuLogTestCase(unittest.TestCase):
+
+    def test_batches_until_flush(self, _call):
+        handler = log_buffer.BufferedJujuLog()
+        handler.log('one', hookenv.DEBUG)
+        handler.log('two', hookenv.DEBUG)
+        handler.log('three')
+        handler.log('four', hookenv.DEBUG)
+        _call.assert_not_called()
+        handler.flush()
+        _call.assert_has_calls([
+            call(['juju-log', '-l', 'DEBUG', 'one\ntwo']),
+            call(['juju-log', '-l', 'INFO', 'three']),
+            call(['juju-log', '-l', 'DEBUG', 'four']),
+        ])
+        self.assertEqual(_call.call_count, 3)
+        handler.flush()
+        self.assertEqual(_call.call_count, 3)
+
+    def test_error_flushes_immediately(self, _call):
+        handler = log_buffer.BufferedJujuLog()
+        handler.log('context', hookenv.INFO)
+        handler.log('failed', hookenv.ERROR)
+        _call.assert_has_calls([
+            call(['juju-log', '-l', 'INFO', 'context']),
+            call(['juju-log', '-l', 'ERROR', 'failed']),
+        ])
+
+    def test_size_threshold(self, _call):
+        handler = log_buffer.BufferedJujuLog(max_bytes=10)
+        handler.log('12345', hookenv.INFO)
+        _call.assert_not_called()
+        handler.log('67890', hookenv.INFO)
+        _call.assert_called_once_with(
+            ['juju-log', '-l', 'INFO', '12345\n67890'])
+
+    def test_level_filter(self, _call):
+        handler = log_buffer.BufferedJujuLog(hookenv.WARNING)
+        handler.log('noise', hookenv.DEBUG)
+        handler.log('chatter')
+        self.assertEqual(handler.buffer, [])
+        handler.log('careful', hookenv.WARNING)
+        handler.flush()
+        _call.assert_called_once_with(
+            ['juju-log', '-l', 'WARNING', 'careful'])
+
+    def test_logging_handler(self, _call):
+        handler = log_buffer.BufferedJujuLog(hookenv.INFO)
+        logger = logging.getLogger('test_log_buffer')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        logger.setLevel(logging.DEBUG)
+        logger.debug('dropped')
+        logger.warning('kept %s', 1)
+        handler.close()
+        _call.assert_called_once_with(
+            ['juju-log', '-l', 'WARNING', 'kept 1'])
+
+    @patch.object(log_buffer.atexit, 'register')
+    def test_install(self, _register, _call):
+        self.addCleanup(hookenv.set_log_handler, None)
+        handler = log_buffer.install(hookenv.INFO)
+        _register.assert_called_once_with(handler.flush)
+        hookenv.log('routed', hookenv.INFO)
+        hookenv.log(['not', 'a', 'string'], hookenv.INFO)
+        _call.assert_not_called()
+        handler.flush()
+        _call.assert_called_once_with(
+            ['juju-log', '-l', 'INFO', "routed\n['not', 'a', 'string']"])
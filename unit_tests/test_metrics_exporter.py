@@ -0,0 +1,97 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append('files/metrics')
+
+import charm_ceph_osd_metrics as exporter
+
+DISKSTATS = """\
+   8       0 sda 100 0 2000 50 200 0 4000 150 1 300 200 0 0 0 0
+   8      16 sdb 10 0 200 5 20 0 400 15 0 30 20 0 0 0 0
+"""
+
+
+class MetricsExporterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def _write(self, path, content, mode='w'):
+        path = os.path.join(self.tmp, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, mode) as f:
+            f.write(content)
+        return path
+
+    def test_collect_osds(self):
+        osd_dir = os.path.join(self.tmp, 'osd')
+        for osd_id in ('0', '1', '12'):
+            os.makedirs(os.path.join(osd_dir, 'ceph-{}'.format(osd_id)))
+        self._write('proc/123/cmdline',
+                    b'/usr/bin/ceph-osd\0-f\0--id\0' b'12\0', 'wb')
+        self._write('proc/124/cmdline', b'/bin/bash\0--id\0' b'1\0', 'wb')
+        metrics = exporter.Metrics()
+        exporter.collect_osds(metrics, osd_dir, os.path.join(self.tmp,
+                                                             'proc'))
+        output = metrics.render()
+        self.assertIn('ceph_osd_charm_osd_up{osd="0"} 0', output)
+        self.assertIn('ceph_osd_charm_osd_up{osd="1"} 0', output)
+        self.assertIn('ceph_osd_charm_osd_up{osd="12"} 1', output)
+
+    def test_collect_devices(self):
+        diskstats = self._write('diskstats', DISKSTATS)
+        self._write('block/sda/queue/max_sectors_kb', '1024\n')
+        self._write('block/sda/queue/read_ahead_kb', '128\n')
+        metrics = exporter.Metrics()
+        exporter.collect_devices(metrics, ['/dev/sda', '/dev/sdz'],
+                                 diskstats, os.path.join(self.tmp, 'block'))
+        output = metrics.render()
+        self.assertIn('# TYPE ceph_osd_charm_device_io_time_seconds_total '
+                      'counter', output)
+        self.assertIn('ceph_osd_charm_device_io_time_seconds_total'
+                      '{device="/dev/sda"} 0.3', output)
+        self.assertIn('ceph_osd_charm_device_io_in_progress'
+                      '{device="/dev/sda"} 1', output)
+        self.assertIn('ceph_osd_charm_device_queue_max_sectors_kb'
+                      '{device="/dev/sda"} 1024', output)
+        self.assertNotIn('sdz', output)
+
+    def test_main(self):
+        state = self._write('state.json', json.dumps({
+            'osd_devices': ['/dev/sdb'],
+            'blacklist': ['/dev/sdc'],
+            'hooks': {'update-status': {'duration': 1.5,
+                                        'timestamp': 1000}},
+        }))
+        exporter.main(['--state-file', state, '--textfile-dir', self.tmp])
+        self.assertEqual(
+            [f for f in os.listdir(self.tmp) if f.endswith('.prom')],
+            ['ceph_osd_charm.prom'])
+        with open(os.path.join(self.tmp, 'ceph_osd_charm.prom')) as f:
+            output = f.read()
+        self.assertIn('ceph_osd_charm_device_processed{device="/dev/sdb"} 1',
+                      output)
+        self.assertIn('ceph_osd_charm_device_blacklisted{device="/dev/sdc"} '
+                      '1', output)
+        self.assertIn('ceph_osd_charm_hook_duration_seconds'
+                      '{hook="update-status"} 1.5', output)
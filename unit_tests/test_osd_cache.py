@@ -0,0 +1,180 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import call, patch
+
+from ceph import utils as ceph_utils
+
+GiB = 1024 ** 3
+
+SIZES = {'/dev/sdb': 4000 * GiB, '/dev/sdc': 8000 * GiB,
+         '/dev/sdd': 4000 * GiB, '/dev/nvme0n1': 800 * GiB}
+
+
+class SysfsTestCase(unittest.TestCase):
+
+    def test_is_rotational_and_size(self):
+        sys_block = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sys_block)
+        os.makedirs(os.path.join(sys_block, 'sdb', 'queue'))
+        with open(os.path.join(sys_block, 'sdb', 'queue', 'rotational'),
+                  'w') as f:
+            f.write('1\n')
+        with open(os.path.join(sys_block, 'sdb', 'size'), 'w') as f:
+            f.write('7814037168\n')
+        self.assertTrue(ceph_utils.is_rotational('/dev/sdb', sys_block))
+        self.assertEqual(ceph_utils.block_device_size('/dev/sdb', sys_block),
+                         7814037168 * 512)
+        self.assertIsNone(ceph_utils.is_rotational('/dev/sdz', sys_block))
+        self.assertEqual(ceph_utils.block_device_size('/dev/sdz', sys_block),
+                         0)
+
+
+class CachedVolumeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.charm_config = {'osd-cache-mode': 'writeback',
+                             'osd-cache-policy': 'smq'}
+        for name, kwargs in (
+                ('config', {'side_effect': self.charm_config.get}),
+                ('log', {}),
+                ('lvm', {}),
+                ('get_devices', {'return_value': set(SIZES) -
+                                 set(['/dev/nvme0n1'])}),
+                ('is_rotational', {'return_value': True}),
+                ('block_device_size', {'side_effect': SIZES.get}),
+                ('_pv_free', {'return_value': 800 * GiB}),
+                ('_remove_missing_pvs', {}),
+                ('find_least_used_utility_device',
+                 {'return_value': '/dev/nvme0n1'})):
+            _patch = patch.object(ceph_utils, name, **kwargs)
+            setattr(self, name, _patch.start())
+            self.addCleanup(_patch.stop)
+        self.lvm.list_logical_volumes.return_value = []
+
+    def test_cache_shared_in_proportion(self):
+        devices = set(['/dev/nvme0n1'])
+        self.assertEqual(
+            ceph_utils._cache_size('/dev/sdc', '/dev/nvme0n1', devices),
+            int(400 * GiB * 0.98))
+        # never more than is left on the cache device
+        self._pv_free.return_value = 100 * GiB
+        self.assertEqual(
+            ceph_utils._cache_size('/dev/sdc', '/dev/nvme0n1', devices),
+            int(100 * GiB * 0.98))
+
+    @patch.object(ceph_utils.subprocess, 'check_call')
+    def test_allocate_writeback(self, _check_call):
+        self.lvm.is_lvm_physical_volume.side_effect = [True, False]
+        self.lvm.list_lvm_volume_group.side_effect = ['ceph-hybrid-1', None]
+        self.assertEqual(
+            ceph_utils._allocate_cached_volume(
+                '/dev/sdb', 'block', 'abc', set(['/dev/nvme0n1'])),
+            'ceph-hybrid-1/osd-block-abc')
+        self.lvm.create_lvm_physical_volume.assert_called_once_with(
+            '/dev/sdb')
+        self._remove_missing_pvs.assert_called_once_with('ceph-hybrid-1')
+        _check_call.assert_has_calls([
+            call(['vgextend', 'ceph-hybrid-1', '/dev/sdb']),
+            call(['lvcreate', '--yes', '-l', '100%PVS', '-n',
+                  'osd-block-abc', 'ceph-hybrid-1', '/dev/sdb']),
+            call(['lvcreate', '--yes', '--type', 'cache-pool', '-L',
+                  '200704m', '-n', 'osd-cache-abc', 'ceph-hybrid-1',
+                  '/dev/nvme0n1']),
+            call(['lvconvert', '--yes', '--type', 'cache', '--cachepool',
+                  'ceph-hybrid-1/osd-cache-abc', '--cachemode', 'writeback',
+                  '--cachepolicy', 'smq', 'ceph-hybrid-1/osd-block-abc'])])
+
+    @patch.object(ceph_utils.subprocess, 'check_call')
+    def test_allocate_writecache_new_group(self, _check_call):
+        self.charm_config['osd-cache-mode'] = 'writecache'
+        self.lvm.is_lvm_physical_volume.return_value = False
+        self.lvm.list_lvm_volume_group.return_value = None
+        volume = ceph_utils._allocate_cached_volume(
+            '/dev/sdb', 'block', 'abc', set(['/dev/nvme0n1']))
+        vg_name = volume.split('/')[0]
+        self.assertTrue(vg_name.startswith(ceph_utils.HYBRID_VG_PREFIX))
+        self.lvm.create_lvm_volume_group.assert_called_once_with(
+            vg_name, '/dev/nvme0n1')
+        _check_call.assert_called_with([
+            'lvconvert', '--yes', '--type', 'writecache', '--cachevol',
+            'osd-cache-abc', volume])
+
+    def test_invalid_mode(self):
+        self.charm_config['osd-cache-mode'] = 'writearound'
+        self.assertRaises(ValueError, ceph_utils._allocate_cached_volume,
+                          '/dev/sdb', 'block', 'abc', set(['/dev/nvme0n1']))
+
+
+class ReleaseHybridVolumesTestCase(unittest.TestCase):
+
+    @patch.object(ceph_utils, '_hybrid_volume_groups', lambda: [])
+    @patch.object(ceph_utils, 'log')
+    @patch.object(ceph_utils.subprocess, 'call')
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    def test_release(self, _check_output, _call, _log):
+        _check_output.return_value = (
+            b'  ceph-hybrid-1 [osd-block-abc_corig]\n')
+        ceph_utils._release_hybrid_volumes('/dev/sdb')
+        _call.assert_has_calls([
+            call(['lvremove', '--yes', 'ceph-hybrid-1/osd-block-abc']),
+            call(['vgreduce', 'ceph-hybrid-1', '/dev/sdb'])])
+
+        # volume groups of uncached OSDs are left alone
+        _call.reset_mock()
+        _check_output.return_value = b'  ceph-abc osd-block-abc\n'
+        ceph_utils._release_hybrid_volumes('/dev/sdb')
+        _call.assert_not_called()
+
+    @patch.object(ceph_utils, 'log')
+    @patch.object(ceph_utils.subprocess, 'call')
+    @patch.object(ceph_utils.subprocess, 'check_call')
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    def test_release_removes_missing(self, _check_output, _check_call,
+                                     _call, _log):
+        outputs = {'vg_name': b'  ceph-abc\n  ceph-hybrid-1\n',
+                   'vg_missing_pv_count': b'  1\n',
+                   'vg_name,lv_name': b''}
+        _check_output.side_effect = lambda cmd: outputs[cmd[3]]
+        # the replacement of a failed device is not in any volume group
+        ceph_utils._release_hybrid_volumes('/dev/sdb')
+        _check_call.assert_called_once_with(
+            ['vgreduce', '--removemissing', '--force', 'ceph-hybrid-1'])
+        _call.assert_not_called()
+
+
+class ActiveBluestoreTestCase(unittest.TestCase):
+
+    @patch.object(ceph_utils.os.path, 'islink', lambda path: True)
+    @patch.object(ceph_utils.os, 'readlink')
+    @patch.object(ceph_utils.glob, 'glob')
+    @patch.object(ceph_utils, 'lvm')
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    def test_shared_volume_group(self, _check_output, _lvm, _glob,
+                                 _readlink):
+        _lvm.is_lvm_physical_volume.return_value = True
+        _glob.return_value = ['/var/lib/ceph/osd/ceph-3/block']
+        _readlink.return_value = '/dev/ceph-hybrid-1/osd-block-def'
+        # the group also holds the OSD of another device, listed first
+        _check_output.return_value = (
+            b'  ceph-hybrid-1 [osd-block-abc_corig]\n')
+        self.assertFalse(ceph_utils.is_active_bluestore_device('/dev/sdb'))
+        _check_output.return_value = (
+            b'  ceph-hybrid-1 [osd-block-def_corig]\n')
+        self.assertTrue(ceph_utils.is_active_bluestore_device('/dev/sdc'))
@@ -0,0 +1,212 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock, call, patch
+
+from ceph import utils as ceph_utils
+
+
+_block_sysnames = ceph_utils._block_sysnames
+
+
+def _udev_device(sys_name):
+    device = MagicMock()
+    device.sys_name = sys_name
+    return device
+
+
+class RescanOsdDevicesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sys_block = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sys_block)
+        for path in ('sdb/sdb1', 'sdb/holders', 'sdb/sdb1/holders/dm-0',
+                     'dm-0/holders', 'sdb1/holders/dm-0', 'sdc'):
+            os.makedirs(os.path.join(self.sys_block, path))
+        open(os.path.join(self.sys_block, 'sdb', 'sdb1', 'partition'),
+             'w').close()
+        _call = patch.object(ceph_utils.subprocess, 'call')
+        self.call = _call.start()
+        self.addCleanup(_call.stop)
+        _log = patch.object(ceph_utils, 'log')
+        self.log = _log.start()
+        self.addCleanup(_log.stop)
+        _sysnames = patch.object(ceph_utils, '_block_sysnames',
+                                 side_effect=self._sysnames)
+        _sysnames.start()
+        self.addCleanup(_sysnames.stop)
+
+    def _sysnames(self, dev):
+        return _block_sysnames(dev, self.sys_block)
+
+    def test_block_sysnames(self):
+        self.assertEqual(_block_sysnames('/dev/sdb', self.sys_block),
+                         set(['sdb', 'sdb1', 'dm-0']))
+        self.assertEqual(_block_sysnames('/dev/sdc', self.sys_block),
+                         set(['sdc']))
+
+    @patch.object(ceph_utils, '_block_monitor')
+    def test_rescan_targets_devices(self, _block_monitor):
+        _block_monitor.return_value.poll.side_effect = [
+            _udev_device('sdb1'), _udev_device('sdz'),
+            _udev_device('dm-0'), _udev_device('sdb')]
+        ceph_utils.rescan_osd_devices(['/dev/sdb'])
+        self.call.assert_called_once_with([
+            'udevadm', 'trigger', '--subsystem-match=block', '--action=add',
+            '--sysname-match=dm-0', '--sysname-match=sdb',
+            '--sysname-match=sdb1'])
+        self.assertEqual(_block_monitor.return_value.poll.call_count, 4)
+        self.log.assert_not_called()
+
+    @patch.object(ceph_utils, '_block_monitor')
+    def test_rescan_bounded_wait(self, _block_monitor):
+        _block_monitor.return_value.poll.side_effect = [
+            _udev_device('sdb'), None]
+        ceph_utils.rescan_osd_devices(['/dev/sdb'], timeout=5)
+        timeout = _block_monitor.return_value.poll.call_args[1]['timeout']
+        self.assertTrue(0 < timeout <= 5)
+        self.log.assert_called_once_with(
+            'Timed out waiting for udev to process dm-0, sdb1',
+            level=ceph_utils.WARNING)
+
+    @patch.object(ceph_utils, '_block_monitor')
+    def test_rescan_without_pyudev(self, _block_monitor):
+        _block_monitor.return_value = None
+        ceph_utils.rescan_osd_devices(['/dev/sdc'])
+        self.call.assert_has_calls([
+            call(['udevadm', 'trigger', '--subsystem-match=block',
+                  '--action=add', '--sysname-match=sdc']),
+            call(['udevadm', 'settle', '--timeout=30'])])
+
+    def test_rescan_all(self):
+        ceph_utils.rescan_osd_devices()
+        self.call.assert_has_calls([
+            call(['udevadm', 'trigger', '--subsystem-match=block',
+                  '--action=add']),
+            call(['udevadm', 'settle', '--timeout=30'])])
+
+    @patch.object(ceph_utils, 'systemd')
+    @patch.object(ceph_utils, 'cmp_pkgrevno')
+    @patch.object(ceph_utils, 'rescan_osd_devices')
+    def test_start_osds(self, _rescan, _cmp_pkgrevno, _systemd):
+        _cmp_pkgrevno.return_value = -1
+        _systemd.return_value = False
+        ceph_utils.start_osds(['/dev/sdb'], new_devices=[])
+        _rescan.assert_not_called()
+        ceph_utils.start_osds(['/dev/sdb'], new_devices=['/dev/sdb'])
+        _rescan.assert_called_once_with(['/dev/sdb'])
+        ceph_utils.start_osds(['/dev/sdb'])
+        _rescan.assert_called_with(None)
+
+    @patch.object(ceph_utils, 'start_osds_staggered')
+    @patch.object(ceph_utils, 'service_running')
+    @patch.object(ceph_utils.device_registry, 'registry')
+    @patch.object(ceph_utils, 'systemd')
+    @patch.object(ceph_utils, 'cmp_pkgrevno')
+    @patch.object(ceph_utils, 'rescan_osd_devices')
+    def test_start_osds_starts_new_stopped(self, _rescan, _cmp_pkgrevno,
+                                           _systemd, _registry,
+                                           _service_running, _staggered):
+        _cmp_pkgrevno.return_value = -1
+        _systemd.return_value = True
+        records = {'/dev/sdb': {'osd_id': None, 'osd_ids': [1, 2]},
+                   '/dev/sdc': {'osd_id': 3, 'osd_ids': None}}
+        _registry.return_value.lookup.side_effect = records.get
+        _service_running.side_effect = lambda unit: unit == 'ceph-osd@2'
+        ceph_utils.start_osds(['/dev/sdb', '/dev/sdc'],
+                              new_devices=['/dev/sdb'])
+        _staggered.assert_called_once_with([1])
+
+        # OSDs stopped on existing devices are left alone
+        _staggered.reset_mock()
+        ceph_utils.start_osds(['/dev/sdb', '/dev/sdc'], new_devices=[])
+        ceph_utils.start_osds(['/dev/sdb', '/dev/sdc'])
+        _staggered.assert_not_called()
+
+        # as are new OSDs while the unit is paused
+        ceph_utils.start_osds(['/dev/sdb'], new_devices=['/dev/sdb'],
+                              start_stopped=False)
+        _staggered.assert_not_called()
+
+
+LSBLK = {'blockdevices': [
+    {'name': 'vdb', 'kname': 'vdb', 'type': 'disk', 'fstype': 'crypto_LUKS',
+     'mountpoint': None, 'disc-max': '0', 'children': [
+         {'name': 'crypt-vdb', 'kname': 'dm-0', 'type': 'crypt',
+          'fstype': 'LVM2_member', 'mountpoint': None, 'disc-max': '0',
+          'children': [
+              {'name': 'ceph--vg-osd--block', 'kname': 'dm-1',
+               'type': 'lvm', 'fstype': None, 'mountpoint': None,
+               'disc-max': '0'}]}]},
+    {'name': 'nvme0n1', 'kname': 'nvme0n1', 'type': 'disk', 'fstype': None,
+     'mountpoint': None, 'disc-max': 2199023255040},
+    {'name': 'vdc', 'kname': 'vdc', 'type': 'disk', 'fstype': None,
+     'mountpoint': None, 'disc-max': '0', 'children': [
+         {'name': 'vdc1', 'kname': 'vdc1', 'type': 'part', 'fstype': 'xfs',
+          'mountpoint': '/srv', 'disc-max': '0'}]},
+]}
+
+
+class BlockDeviceInventoryTestCase(unittest.TestCase):
+
+    @patch.object(ceph_utils.glob, 'glob')
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    def test_inventory(self, _check_output, _glob):
+        _glob.return_value = []
+        _check_output.side_effect = [
+            json.dumps(LSBLK).encode('UTF-8'),
+            b'  crypt-vdb:1\n  ceph--vg-osd--block:1\n']
+        devices = ['/dev/vdb', '/dev/nvme0n1', '/dev/vdc']
+        inventory = ceph_utils.block_device_inventory(devices)
+        self.assertEqual(inventory['/dev/vdb'], {
+            'mounted': False, 'in-use': True,
+            'mappings': ['ceph--vg-osd--block', 'crypt-vdb'],
+            'fstype': 'crypto_LUKS', 'discard': False})
+        self.assertEqual(inventory['/dev/nvme0n1']['discard'], True)
+        self.assertEqual(inventory['/dev/vdc']['mounted'], True)
+        self.assertEqual(_check_output.call_count, 2)
+
+        # stale mappings nobody holds open are not in use
+        _check_output.side_effect = [
+            json.dumps(LSBLK).encode('UTF-8'),
+            b'  crypt-vdb:1\n  ceph--vg-osd--block:0\n']
+        self.assertFalse(
+            ceph_utils.block_device_inventory(devices)['/dev/vdb']['in-use'])
+
+    @patch.object(ceph_utils.os.path, 'exists')
+    @patch.object(ceph_utils, '_release_hybrid_volumes')
+    @patch.object(ceph_utils, 'zap_disk')
+    @patch.object(ceph_utils, 'log')
+    @patch.object(ceph_utils.subprocess, 'call')
+    @patch.object(ceph_utils.subprocess, 'check_call')
+    def test_wipe_block_device(self, _check_call, _call, _log, _zap_disk,
+                               _release_hybrid_volumes, _exists):
+        _exists.return_value = True
+        ceph_utils.wipe_block_device(
+            '/dev/vdb', ['ceph--vg-osd--block', 'crypt-vdb'],
+            'LVM2_member', discard=True)
+        _release_hybrid_volumes.assert_has_calls([
+            call('/dev/vdb'), call('/dev/mapper/crypt-vdb')])
+        _check_call.assert_has_calls([
+            call(['dmsetup', 'remove', '--retry', 'ceph--vg-osd--block']),
+            call(['dmsetup', 'remove', '--retry', 'crypt-vdb']),
+            call(['blkdiscard', '/dev/vdb'])])
+        _call.assert_called_once_with(['pvremove', '-ff', '-y', '/dev/vdb'])
+        _zap_disk.assert_called_once_with('/dev/vdb')
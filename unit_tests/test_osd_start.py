@@ -0,0 +1,153 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import subprocess
+import unittest
+
+from mock import call, patch
+
+from ceph import utils as ceph_utils
+
+
+def _osd_dump(up):
+    return json.dumps({'osds': [{'osd': osd_id, 'up': int(osd_id in up)}
+                                for osd_id in range(6)]}).encode('UTF-8')
+
+
+class StaggeredStartTestCase(unittest.TestCase):
+
+    def setUp(self):
+        for name in ('log', 'start_osd', 'config'):
+            _patch = patch.object(ceph_utils, name)
+            setattr(self, name, _patch.start())
+            self.addCleanup(_patch.stop)
+        self.config.return_value = None
+        self.now = [0]
+        _time = patch.object(ceph_utils.time, 'time',
+                             side_effect=lambda: self.now[0])
+        _time.start()
+        self.addCleanup(_time.stop)
+        _sleep = patch.object(ceph_utils.time, 'sleep',
+                              side_effect=self._sleep)
+        self.sleep = _sleep.start()
+        self.addCleanup(_sleep.stop)
+
+    def _sleep(self, seconds):
+        self.now[0] += seconds
+
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    def test_starts_in_waves(self, _check_output):
+        started = []
+        self.start_osd.side_effect = started.append
+        # each wave is up on the second look at the OSD map
+        _check_output.side_effect = [
+            _osd_dump(set()), _osd_dump({0, 1}),
+            _osd_dump({0, 1}), _osd_dump({0, 1, 2, 3}),
+            _osd_dump({0, 1, 2, 3, 4})]
+        down = ceph_utils.start_osds_staggered([4, '3', 2, 1, 0],
+                                               wave_size=2)
+        self.assertEqual(down, set())
+        self.assertEqual(started, ['0', '1', '2', '3', '4'])
+        self.assertEqual(self.sleep.call_count, 2)
+        _check_output.assert_called_with(
+            ['ceph', '--id', 'osd-upgrade', 'osd', 'dump', '--format=json'])
+
+    @patch.object(ceph_utils, 'get_osds_up')
+    def test_wave_timeout(self, _get_osds_up):
+        _get_osds_up.return_value = set()
+        self.config.side_effect = {'osd-start-wave-size': 1,
+                                   'osd-start-wave-timeout': 30}.get
+        down = ceph_utils.start_osds_staggered(['0', '1'])
+        self.assertEqual(down, set(['0', '1']))
+        self.assertEqual(self.now[0], 60)
+        self.start_osd.assert_has_calls([call('0'), call('1')])
+
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    def test_osds_up_from_admin_socket(self, _check_output):
+        def check_output(cmd, **kwargs):
+            if cmd[1] == '--id':
+                raise subprocess.CalledProcessError(1, cmd)
+            if cmd[2] == 'osd.1':
+                raise subprocess.CalledProcessError(22, cmd)
+            state = 'active' if cmd[2] == 'osd.0' else 'booting'
+            return json.dumps({'state': state}).encode('UTF-8')
+        _check_output.side_effect = check_output
+        self.assertEqual(ceph_utils.get_osds_up([0, 1, 2]), set(['0']))
+
+
+class MaintenanceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        _check_call = patch.object(ceph_utils.subprocess, 'check_call')
+        self.check_call = _check_call.start()
+        self.addCleanup(_check_call.stop)
+        _log = patch.object(ceph_utils, 'log')
+        _log.start()
+        self.addCleanup(_log.stop)
+
+    def test_mark_osds(self):
+        ceph_utils.mark_osds([1, '2'], 'out')
+        self.check_call.assert_called_once_with(
+            ['ceph', '--id', 'osd-upgrade', 'osd', 'out', '1', '2'])
+        ceph_utils.mark_osds([], 'in')
+        self.assertEqual(self.check_call.call_count, 1)
+
+    @patch.object(ceph_utils.socket, 'gethostname')
+    @patch.object(ceph_utils, 'cmp_pkgrevno')
+    def test_maintenance_flags_on_host(self, _cmp_pkgrevno, _gethostname):
+        _cmp_pkgrevno.return_value = 1
+        _gethostname.return_value = 'host1'
+        flags = ceph_utils.set_maintenance_flags()
+        self.assertEqual(flags, {'host': 'host1', 'group': ['noout'],
+                                 'cluster': []})
+        _cmp_pkgrevno.assert_called_once_with('ceph', '13.0.0')
+        ceph_utils.set_maintenance_flags(unset=True, flags=flags)
+        self.check_call.assert_has_calls([
+            call(['ceph', '--id', 'osd-upgrade', 'osd', 'set-group',
+                  'noout', 'host1']),
+            call(['ceph', '--id', 'osd-upgrade', 'osd', 'unset-group',
+                  'noout', 'host1'])])
+        self.assertEqual(self.check_call.call_count, 2)
+
+    @patch.object(ceph_utils, 'cmp_pkgrevno')
+    def test_maintenance_flags_cluster_wide(self, _cmp_pkgrevno):
+        _cmp_pkgrevno.return_value = -1
+        self.assertEqual(ceph_utils.set_maintenance_flags(),
+                         {'host': None, 'group': [],
+                          'cluster': ['noout', 'norebalance']})
+        self.check_call.assert_has_calls([
+            call(['ceph', '--id', 'osd-upgrade', 'osd', 'set', 'noout']),
+            call(['ceph', '--id', 'osd-upgrade', 'osd', 'set',
+                  'norebalance'])])
+
+        # flags recorded by earlier releases of the charm
+        self.check_call.reset_mock()
+        ceph_utils.set_maintenance_flags(unset=True, flags={'host': None})
+        self.check_call.assert_has_calls([
+            call(['ceph', '--id', 'osd-upgrade', 'osd', 'unset', 'noout']),
+            call(['ceph', '--id', 'osd-upgrade', 'osd', 'unset',
+                  'norebalance'])])
+
+    @patch.object(ceph_utils, 'stop_osd')
+    def test_stop_osds_parallel(self, _stop_osd):
+        def stop_osd(osd_id):
+            if osd_id == '2':
+                raise subprocess.CalledProcessError(1, 'systemctl')
+        _stop_osd.side_effect = stop_osd
+        timings = ceph_utils.stop_osds_parallel([0, 1], parallel=2)
+        self.assertEqual(sorted(timings), ['0', '1'])
+        self.assertRaises(subprocess.CalledProcessError,
+                          ceph_utils.stop_osds_parallel, [0, 1, 2, 3])
+        self.assertEqual(_stop_osd.call_count, 6)
@@ -0,0 +1,140 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+
+from mock import patch, call
+
+from ceph import pg_utils
+
+OSD_POOL_LS = [
+    {'pool_name': 'rbd', 'size': 3, 'crush_rule': 0,
+     'pg_num': 64, 'pg_placement_num': 64},
+    {'pool_name': 'images', 'size': 3, 'crush_rule': 0,
+     'pg_num': 8, 'pg_placement_num': 8},
+    {'pool_name': 'fast', 'size': 2, 'crush_rule': 1,
+     'pg_num': 8, 'pg_placement_num': 8},
+]
+
+DF = {'pools': [
+    {'name': 'rbd', 'stats': {'bytes_used': 300}},
+    {'name': 'images', 'stats': {'bytes_used': 100}},
+    {'name': 'fast', 'stats': {'bytes_used': 0}},
+]}
+
+RULES = [
+    {'rule_id': 0, 'steps': [{'op': 'take', 'item': -1},
+                             {'op': 'chooseleaf_firstn'}]},
+    {'rule_id': 1, 'steps': [{'op': 'take', 'item': -10}]},
+]
+
+TREE = {'nodes': [
+    {'id': -1, 'type': 'root', 'children': [-2, -3]},
+    {'id': -2, 'type': 'host', 'children': [0, 1, 2]},
+    {'id': -3, 'type': 'host', 'children': [3, 4, 5]},
+    {'id': -10, 'type': 'root', 'children': [-11]},
+    {'id': -11, 'type': 'host', 'children': [6, 7]},
+] + [{'id': i, 'type': 'osd'} for i in range(8)]}
+
+
+def fake_ceph(cmd):
+    outputs = {
+        ('osd', 'pool', 'ls', 'detail'): OSD_POOL_LS,
+        ('df',): DF,
+        ('osd', 'crush', 'rule', 'dump'): RULES,
+        ('osd', 'tree'): TREE,
+    }
+    return json.dumps(outputs[tuple(cmd[3:-1])]).encode('UTF-8')
+
+
+class PGUtilsTestCase(unittest.TestCase):
+
+    @patch.object(pg_utils, 'check_output')
+    def test_get_cluster_pg_state(self, check_output):
+        check_output.side_effect = fake_ceph
+        pools = {p.name: p for p in pg_utils.get_cluster_pg_state('admin')}
+        self.assertEqual(check_output.call_count, 4)
+        self.assertEqual(pools['rbd'].osd_count, 6)
+        self.assertEqual(pools['rbd'].bytes_used, 300)
+        self.assertEqual(pools['fast'].osd_count, 2)
+        self.assertEqual(pools['fast'].root, -10)
+
+    @patch.object(pg_utils, 'check_output')
+    def test_plan_pgs(self, check_output):
+        check_output.side_effect = fake_ceph
+        plans = pg_utils.plan_pgs(pg_utils.get_cluster_pg_state('admin'))
+        targets = {p.name: p.target_pg_num for p in plans}
+        # 600 PG budget: rbd 75% / 3 replicas, images 25% / 3 replicas
+        self.assertEqual(targets['rbd'], 128)
+        self.assertEqual(targets['images'], 64)
+        # 200 PG budget on the second root for a single pool of size 2
+        self.assertEqual(targets['fast'], 128)
+
+    def test_plan_pgs_never_shrinks(self):
+        pool = pg_utils.PoolPlan('big', 3, -1, 3, 0, 512, 512, None)
+        plan = pg_utils.plan_pgs([pool])[0]
+        self.assertEqual(plan.target_pg_num, 512)
+
+    def test_plan_pgs_caps_per_osd(self):
+        pools = [pg_utils.PoolPlan('a', 3, -1, 4, 0, 128, 128, None),
+                 pg_utils.PoolPlan('b', 3, -1, 4, 0, 8, 8, None)]
+        plans = pg_utils.plan_pgs(pools, target_pgs_per_osd=400,
+                                  max_pgs_per_osd=200)
+        targets = {p.name: p.target_pg_num for p in plans}
+        self.assertEqual(targets, {'a': 128, 'b': 128})
+
+    def test_nearest_power_of_two(self):
+        self.assertEqual(pg_utils.nearest_power_of_two(0), 2)
+        self.assertEqual(pg_utils.nearest_power_of_two(70), 64)
+        self.assertEqual(pg_utils.nearest_power_of_two(90), 128)
+
+    @patch.object(pg_utils, '_wait_for_pgs')
+    @patch.object(pg_utils, 'check_call')
+    def test_apply_pg_plan_steps(self, check_call, wait_for_pgs):
+        wait_for_pgs.return_value = True
+        plan = pg_utils.PoolPlan('rbd', 3, -1, 6, 0, 64, 64, 160)
+        self.assertEqual(pg_utils.apply_pg_plan('admin', [plan], step=64),
+                         {'rbd': 160})
+        base = ['ceph', '--id', 'admin', 'osd', 'pool', 'set', 'rbd']
+        check_call.assert_has_calls([
+            call(base + ['pg_num', '128']),
+            call(base + ['pgp_num', '128']),
+            call(base + ['pg_num', '160']),
+            call(base + ['pgp_num', '160']),
+        ])
+
+    @patch.object(pg_utils, '_wait_for_pgs')
+    @patch.object(pg_utils, 'check_call')
+    def test_apply_pg_plan_timeout(self, check_call, wait_for_pgs):
+        wait_for_pgs.return_value = False
+        plan = pg_utils.PoolPlan('rbd', 3, -1, 6, 0, 64, 64, 128)
+        self.assertRaises(RuntimeError, pg_utils.apply_pg_plan,
+                          'admin', [plan])
+
+    @patch.object(pg_utils, 'check_output')
+    def test_pgs_active_clean(self, check_output):
+        check_output.side_effect = [
+            json.dumps({'num_pg_by_state': [
+                {'name': 'active+clean', 'num': 60},
+                {'name': 'active+undersized+degraded', 'num': 4}],
+                'num_pgs': 64}).encode('UTF-8'),
+            json.dumps({'pg_summary': {'num_pg_by_state': [
+                {'name': 'active+clean', 'num': 64}],
+                'num_pgs': 64}}).encode('UTF-8'),
+        ]
+        self.assertFalse(pg_utils.pgs_active_clean('osd-upgrade'))
+        self.assertTrue(pg_utils.pgs_active_clean('osd-upgrade'))
+        check_output.assert_called_with(
+            ['ceph', '--id', 'osd-upgrade', 'pg', 'stat', '--format=json'])
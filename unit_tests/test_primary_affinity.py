@@ -0,0 +1,149 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from ceph import primary_affinity
+from ceph import utils as ceph_utils
+
+OSD_PERF = {'osdstats': {'osd_perf_infos': [
+    {'id': 0, 'perf_stats': {'commit_latency_ms': 0,
+                             'apply_latency_ms': 1}},
+    {'id': 1, 'perf_stats': {'commit_latency_ms': 8,
+                             'apply_latency_ms': 10}},
+    {'id': 2, 'perf_stats': {'commit_latency_ms': 2,
+                             'apply_latency_ms': 2}},
+]}}
+
+OSD_DUMP = {'osds': [
+    {'osd': 0, 'primary_affinity': 1.0},
+    {'osd': 1, 'primary_affinity': 1.0},
+    {'osd': 2, 'primary_affinity': 0.45},
+]}
+
+
+def _diskstats(sdb, nvme):
+    line = ' 8 16 {} {} 0 0 {} {} 0 0 {} 0 0 0\n'
+    return (line.format('sdb', sdb[0], sdb[1], sdb[2], sdb[3]) +
+            line.format('nvme0n1', nvme[0], nvme[1], nvme[2], nvme[3]))
+
+
+class PlanTestCase(unittest.TestCase):
+
+    def test_bounded_steps(self):
+        plans = primary_affinity.plan_primary_affinity(
+            {0: 1.0, 1: 10.0, 2: 2.0},
+            {0: 1.0, 1: 1.0, 2: 0.45},
+            [1, 2, 0])
+        self.assertEqual([p.osd_id for p in plans], [0, 1, 2])
+        by_id = dict((p.osd_id, p) for p in plans)
+        # fastest OSD keeps full affinity
+        self.assertEqual(by_id[0].new_affinity, 1.0)
+        # 10x slower, floored at the minimum, one step at a time
+        self.assertEqual(by_id[1].target, 0.1)
+        self.assertEqual(by_id[1].new_affinity, 0.75)
+        # within the hysteresis of its target of 0.5
+        self.assertEqual(by_id[2].target, 0.5)
+        self.assertEqual(by_id[2].new_affinity, 0.45)
+
+    def test_latency_floor(self):
+        plans = primary_affinity.plan_primary_affinity(
+            {0: 0.0, 1: 1.0}, {0: 0.5, 1: 0.5}, [0, 1], step=1.0)
+        self.assertEqual([p.new_affinity for p in plans], [1.0, 1.0])
+
+    def test_unmeasured_osds_skipped(self):
+        self.assertEqual(
+            primary_affinity.plan_primary_affinity({0: 1.0}, {}, [5]), [])
+        self.assertEqual(
+            primary_affinity.plan_primary_affinity({}, {}, [0]), [])
+
+
+@patch.object(primary_affinity, 'log')
+@patch.object(primary_affinity, 'get_local_osd_ids',
+              lambda: ['1', '2'])
+class LocalPlanTestCase(unittest.TestCase):
+
+    def _ceph(self, cmd):
+        if 'perf' in cmd:
+            if self.perf is None:
+                raise primary_affinity.CalledProcessError(13, 'ceph')
+            return json.dumps(self.perf).encode('UTF-8')
+        return json.dumps(OSD_DUMP).encode('UTF-8')
+
+    @patch.object(primary_affinity, 'check_output')
+    def test_from_osd_perf(self, _check_output, _log):
+        self.perf = OSD_PERF
+        _check_output.side_effect = self._ceph
+        plans = primary_affinity.plan_local_primary_affinity('osd-upgrade')
+        self.assertEqual([(p.osd_id, p.latency_ms) for p in plans],
+                         [(1, 10.0), (2, 2.0)])
+
+    @patch.object(primary_affinity.time, 'sleep')
+    @patch.object(primary_affinity, 'get_ceph_volume_osds')
+    def test_from_diskstats(self, _get_ceph_volume_osds, _sleep, _log):
+        _get_ceph_volume_osds.return_value = {'/dev/sdb': [1],
+                                              '/dev/nvme0n1': [2]}
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'diskstats')
+        samples = [_diskstats((100, 100, 100, 100), (100, 10, 100, 10)),
+                   _diskstats((150, 500, 150, 500), (600, 60, 600, 60))]
+
+        def _sleep_and_sample(interval):
+            with open(path, 'w') as f:
+                f.write(samples.pop(0))
+
+        _sleep.side_effect = _sleep_and_sample
+        _sleep_and_sample(0)
+        self.assertEqual(primary_affinity.get_local_await(5, path),
+                         {1: 8.0, 2: 0.1})
+
+    @patch.object(primary_affinity, 'get_local_await')
+    @patch.object(primary_affinity, 'check_output')
+    def test_falls_back_to_diskstats(self, _check_output, _get_local_await,
+                                     _log):
+        self.perf = None
+        _check_output.side_effect = self._ceph
+        _get_local_await.return_value = {1: 4.0, 2: 1.0}
+        plans = primary_affinity.plan_local_primary_affinity('osd-upgrade')
+        self.assertEqual([p.target for p in plans], [0.25, 1.0])
+
+
+class ApplyTestCase(unittest.TestCase):
+
+    @patch.object(ceph_utils, 'log')
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    def test_set_primary_affinity(self, _check_output, _log):
+        _check_output.return_value = (
+            b'set osd.3 primary-affinity to 1 (8327682)')
+        self.assertTrue(ceph_utils.set_primary_affinity(3, 1.0))
+        _check_output.assert_called_once_with(
+            ['ceph', '--id', 'osd-upgrade', 'osd', 'primary-affinity',
+             'osd.3', '1'], stderr=ceph_utils.subprocess.STDOUT)
+        self.assertFalse(ceph_utils.set_primary_affinity(3, 0.75))
+
+    @patch.object(primary_affinity, 'log')
+    @patch.object(primary_affinity, 'set_primary_affinity')
+    def test_apply_changes_only(self, _set_primary_affinity, _log):
+        _set_primary_affinity.return_value = True
+        plans = [primary_affinity.AffinityPlan(1, 10.0, 1.0, 0.1, 0.75),
+                 primary_affinity.AffinityPlan(2, 2.0, 0.45, 0.5, 0.45)]
+        self.assertEqual(primary_affinity.apply_primary_affinity(plans), [1])
+        _set_primary_affinity.assert_called_once_with(1, 0.75)
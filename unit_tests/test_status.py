@@ -17,6 +17,8 @@ import test_utils
 
 from mock import patch
 
+from charmhelpers.core import unitdata
+
 with patch('charmhelpers.contrib.hardening.harden.harden') as mock_dec:
     mock_dec.side_effect = (lambda *dargs, **dkwargs: lambda f:
                             lambda *args, **kwargs: f(*args, **kwargs))
@@ -34,6 +36,9 @@ TO_PATCH = [
     'get_upstream_version',
     'vaultlocker',
     'use_vaultlocker',
+    'get_device_health_problems',
+    'kv',
+    'is_unit_paused_set',
 ]
 
 CEPH_MONS = [
@@ -50,6 +55,10 @@ class ServiceStatusTestCase(test_utils.CharmTestCase):
         self.config.side_effect = self.test_config.get
         self.get_upstream_version.return_value = '10.2.2'
         self.use_vaultlocker.return_value = False
+        self.get_device_health_problems.return_value = {}
+        self.is_unit_paused_set.return_value = False
+        self.db = unitdata.Storage(':memory:')
+        self.kv.return_value = self.db
 
     def test_assess_status_no_monitor_relation(self):
         self.relation_ids.return_value = []
@@ -85,6 +94,56 @@ class ServiceStatusTestCase(test_utils.CharmTestCase):
         self.status_set.assert_called_with('active', mock.ANY)
         self.application_version_set.assert_called_with('12.2.4')
 
+    def test_assess_status_unhealthy_devices(self):
+        self.relation_ids.return_value = ['mon:1']
+        self.related_units.return_value = CEPH_MONS
+        self.get_conf.return_value = 'monitor-bootstrap-key'
+        self.ceph.get_running_osds.return_value = ['12345']
+        self.get_device_health_problems.return_value = {
+            '/dev/sdc': ['await 400ms']}
+        hooks.assess_status()
+        self.status_set.assert_called_with(
+            'active', 'Unit is ready (1 OSD), unhealthy devices: /dev/sdc')
+
+    def test_assess_status_weight_ramp(self):
+        self.relation_ids.return_value = ['mon:1']
+        self.related_units.return_value = CEPH_MONS
+        self.get_conf.return_value = 'monitor-bootstrap-key'
+        self.ceph.get_running_osds.return_value = ['1', '2']
+        self.db.set('osd-weight-ramp', {'1': {'weight': 1.0, 'target': 4.0},
+                                        '2': {'weight': 1.0, 'target': 4.0}})
+        hooks.assess_status()
+        self.status_set.assert_called_with(
+            'active', 'Unit is ready (2 OSD), ramping in 2 OSD (25%)')
+
+    @patch.object(hooks, 'weight_ramp')
+    def test_assess_status_no_weight_ramp(self, _weight_ramp):
+        self.relation_ids.return_value = ['mon:1']
+        self.related_units.return_value = CEPH_MONS
+        self.get_conf.return_value = 'monitor-bootstrap-key'
+        self.ceph.get_running_osds.return_value = ['1']
+        hooks.assess_status()
+        self.status_set.assert_called_with('active', 'Unit is ready (1 OSD)')
+        _weight_ramp.progress.assert_not_called()
+
+    @patch.object(hooks, 'weight_ramp')
+    @patch.object(hooks, 'primary_affinity')
+    def test_update_status_features_disabled(self, _primary_affinity,
+                                             _weight_ramp):
+        hooks.tune_dm_crypt()
+        hooks.optimize_primary_affinity()
+        hooks.advance_weight_ramp()
+        self.ceph.tune_dm_crypt_devices.assert_not_called()
+        _primary_affinity.plan_local_primary_affinity.assert_not_called()
+        _weight_ramp.advance.assert_not_called()
+
+        self.db.set(hooks.WEIGHT_RAMP_KEY, {'1': {'weight': 1.0,
+                                                  'target': 4.0}})
+        hooks.advance_weight_ramp()
+        _weight_ramp.advance.assert_called_once_with(
+            'osd-upgrade', step=1.0, max_misplaced=mock.ANY,
+            enroll_new=False)
+
     def test_assess_status_monitor_vault_missing(self):
         _test_relations = {
             'mon': ['mon:1'],
@@ -117,3 +176,87 @@ class ServiceStatusTestCase(test_utils.CharmTestCase):
         hooks.assess_status()
         self.status_set.assert_called_with('waiting', mock.ANY)
         self.application_version_set.assert_called_with('12.2.4')
+
+    def test_assess_status_paused(self):
+        self.is_unit_paused_set.return_value = True
+        hooks.assess_status()
+        self.status_set.assert_called_with('maintenance', mock.ANY)
+
+    def test_assess_status_non_pristine(self):
+        self.relation_ids.return_value = ['mon:1']
+        self.related_units.return_value = CEPH_MONS
+        self.get_conf.return_value = 'monitor-bootstrap-key'
+        self.db.set(hooks.NON_PRISTINE_KEY, True)
+        hooks.assess_status()
+        self.status_set.assert_called_with('blocked',
+                                           hooks.NON_PRISTINE_MESSAGE)
+        self.ceph.get_running_osds.assert_not_called()
+
+    def test_assess_status_vault_refused(self):
+        self.relation_ids.return_value = ['mon:1']
+        self.related_units.return_value = CEPH_MONS
+        self.get_conf.return_value = 'monitor-bootstrap-key'
+        self.db.set(hooks.VAULT_REFUSED_KEY, True)
+        hooks.assess_status()
+        self.status_set.assert_called_with('blocked',
+                                           hooks.VAULT_REFUSED_MESSAGE)
+        self.ceph.get_running_osds.assert_not_called()
+
+    @patch.object(hooks, '_dpkg_status_mtime')
+    @patch.object(hooks.hookenv, 'hook_name')
+    def test_assess_status_update_status_unchanged(self, hook_name,
+                                                   _dpkg_status_mtime):
+        _dpkg_status_mtime.return_value = 1000.0
+        self.relation_ids.return_value = ['mon:1']
+        self.related_units.return_value = CEPH_MONS
+        self.get_conf.return_value = 'monitor-bootstrap-key'
+        self.ceph.get_running_osds.return_value = ['12345']
+        hook_name.return_value = 'config-changed'
+        hooks.assess_status()
+        self.status_set.assert_called_once_with('active',
+                                                'Unit is ready (1 OSD)')
+        self.application_version_set.assert_called_once_with('10.2.2')
+
+        # update-status reuses the relation facts and version, and does
+        # not publish an unchanged status
+        self.relation_ids.reset_mock()
+        self.get_upstream_version.reset_mock()
+        self.status_set.reset_mock()
+        self.application_version_set.reset_mock()
+        hook_name.return_value = 'update-status'
+        hooks.assess_status()
+        self.relation_ids.assert_not_called()
+        self.get_upstream_version.assert_not_called()
+        self.status_set.assert_not_called()
+        self.application_version_set.assert_not_called()
+
+        # but does publish changes
+        self.ceph.get_running_osds.return_value = ['12345', '67890']
+        _dpkg_status_mtime.return_value = 2000.0
+        self.get_upstream_version.return_value = '12.2.4'
+        hooks.assess_status()
+        self.status_set.assert_called_once_with('active',
+                                                'Unit is ready (2 OSD)')
+        self.application_version_set.assert_called_once_with('12.2.4')
+
+    @patch.object(hooks, '_dpkg_status_mtime')
+    @patch.object(hooks.hookenv, 'hook_name')
+    def test_assess_status_after_forgotten_status(self, hook_name,
+                                                  _dpkg_status_mtime):
+        _dpkg_status_mtime.return_value = 1000.0
+        self.relation_ids.return_value = ['mon:1']
+        self.related_units.return_value = CEPH_MONS
+        self.get_conf.return_value = 'monitor-bootstrap-key'
+        self.ceph.get_running_osds.return_value = ['12345']
+        hook_name.return_value = 'update-status'
+        hooks.assess_status()
+
+        # an action set 'maintenance' itself and stopped before
+        # assess_status(), so update-status publishes the status again
+        hooks.forget_published_status()
+        self.status_set.reset_mock()
+        self.application_version_set.reset_mock()
+        hooks.assess_status()
+        self.status_set.assert_called_once_with('active',
+                                                'Unit is ready (1 OSD)')
+        self.application_version_set.assert_called_once_with('10.2.2')
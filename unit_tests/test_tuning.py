@@ -2,6 +2,7 @@ __author__ = 'Chris Holcombe <chris.holcombe@canonical.com>'
 from mock import patch, call
 import test_utils
 import ceph.utils as ceph
+from charmhelpers.core import hookenv
 
 TO_PATCH = [
     'hookenv',
@@ -124,3 +125,83 @@ class PerformanceTestCase(test_utils.CharmTestCase):
         check_output.assert_called_with(
             ['hdparm', '-a256', '/dev/sda']
         )
+
+    @patch.object(ceph.subprocess, 'check_output')
+    def test_dm_target_version(self, check_output):
+        check_output.return_value = (b'crypt            v1.23.0\n'
+                                     b'striped          v1.6.0\n')
+        hookenv.flush('dm_target_version')
+        self.assertEqual(ceph.dm_target_version('crypt'), (1, 23, 0))
+        hookenv.flush('dm_target_version')
+        self.assertIsNone(ceph.dm_target_version('integrity'))
+
+    @patch.object(ceph.subprocess, 'check_call')
+    @patch.object(ceph.subprocess, 'Popen')
+    @patch.object(ceph.subprocess, 'check_output')
+    @patch.object(ceph, 'dm_target_version')
+    def test_tune_dm_crypt_devices(self, dm_target_version, check_output,
+                                   popen, check_call):
+        dm_target_version.return_value = (1, 22, 0)
+        check_output.return_value = (
+            b'crypt-1234: 0 209715200 crypt aes-xts-plain64 abcd 0 '
+            b'252:16 4096\n'
+            b'crypt-5678: 0 209715200 crypt aes-xts-plain64 ef01 0 '
+            b'252:32 4096 3 allow_discards no_read_workqueue '
+            b'no_write_workqueue\n'
+            b'luks-home: 0 2048 crypt aes-xts-plain64 2345 0 8:3 4096\n')
+        popen.return_value.returncode = 0
+        self.assertEqual(ceph.tune_dm_crypt_devices(), ['crypt-1234'])
+        popen.assert_called_once_with(['dmsetup', 'reload', 'crypt-1234'],
+                                      stdin=ceph.subprocess.PIPE)
+        popen.return_value.communicate.assert_called_once_with(
+            b'0 209715200 crypt aes-xts-plain64 abcd 0 252:16 4096 '
+            b'2 no_read_workqueue no_write_workqueue')
+        check_call.assert_called_once_with(
+            ['dmsetup', 'resume', 'crypt-1234'])
+
+        # kernels before 5.9 do not support the options
+        dm_target_version.return_value = (1, 19, 0)
+        self.assertEqual(ceph.tune_dm_crypt_devices(), [])
+        self.assertEqual(check_output.call_count, 1)
+
+    @patch.object(ceph.subprocess, 'check_call')
+    @patch.object(ceph.subprocess, 'Popen')
+    @patch.object(ceph.subprocess, 'check_output')
+    @patch.object(ceph, 'cryptsetup_version')
+    @patch.object(ceph, 'dm_target_version')
+    def test_tune_dm_crypt_devices_keyring(self, dm_target_version,
+                                           cryptsetup_version, check_output,
+                                           popen, check_call):
+        dm_target_version.return_value = (1, 22, 0)
+        cryptsetup_version.return_value = (2, 3, 4)
+        check_output.return_value = (
+            b'crypt-1234: 0 209715200 crypt aes-xts-plain64 '
+            b':64:logon:cryptsetup:2b1c4e2a-0a5e-4cc3-bc0e-0d4d2c2f5c8a-d0 '
+            b'0 252:16 32768 1 allow_discards\n')
+        self.assertEqual(ceph.tune_dm_crypt_devices(), ['crypt-1234'])
+        popen.assert_not_called()
+        check_call.assert_called_once_with(
+            ['cryptsetup', 'refresh', '--perf-no_read_workqueue',
+             '--perf-no_write_workqueue', '--persistent', 'crypt-1234'],
+            stdin=ceph.subprocess.DEVNULL)
+
+        # a failed refresh is logged and the device skipped
+        check_call.side_effect = ceph.subprocess.CalledProcessError(
+            1, 'cryptsetup')
+        self.assertEqual(ceph.tune_dm_crypt_devices(), [])
+
+        # cryptsetup before 2.3.4 cannot refresh the options
+        check_call.reset_mock()
+        cryptsetup_version.return_value = (2, 2, 2)
+        self.assertEqual(ceph.tune_dm_crypt_devices(), [])
+        check_call.assert_not_called()
+        popen.assert_not_called()
+
+    @patch.object(ceph.subprocess, 'check_output')
+    def test_cryptsetup_version(self, check_output):
+        check_output.return_value = b'cryptsetup 2.3.4\n'
+        hookenv.flush('cryptsetup_version')
+        self.assertEqual(ceph.cryptsetup_version(), (2, 3, 4))
+        check_output.side_effect = OSError('No such file or directory')
+        hookenv.flush('cryptsetup_version')
+        self.assertIsNone(ceph.cryptsetup_version())
@@ -0,0 +1,98 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from charmhelpers.core import unitdata
+
+
+class StorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.db = unitdata.Storage(os.path.join(self.tmp, 'state.db'))
+        self.addCleanup(self.db.close)
+
+    def _revisions(self):
+        self.db.cursor.execute(
+            'select key, revision, data from kv_revisions order by key')
+        return self.db.cursor.fetchall()
+
+    def test_uses_write_ahead_log(self):
+        self.db.cursor.execute('pragma journal_mode')
+        self.assertEqual(self.db.cursor.fetchone()[0], 'wal')
+        self.db.cursor.execute('pragma synchronous')
+        # NORMAL
+        self.assertEqual(self.db.cursor.fetchone()[0], 1)
+
+    def _test_set(self):
+        with self.db.hook_scope('config-changed') as revision:
+            self.db.set('a', 1)
+            self.db.set('a', 2)
+            self.db.set('b', [1])
+            self.db.set('b', [1])
+        self.assertEqual(self.db.get('a'), 2)
+        self.assertEqual(self.db.get('b'), [1])
+        self.assertEqual(self._revisions(),
+                         [('a', revision, '2'), ('b', revision, '[1]')])
+
+        with self.db.hook_scope('update-status'):
+            self.db.set('a', 2)
+        # unchanged values add no revisions
+        self.assertEqual(len(self._revisions()), 2)
+
+    def test_set(self):
+        self._test_set()
+
+    def test_set_without_upsert(self):
+        with patch.object(unitdata, '_HAVE_UPSERT', False):
+            self._test_set()
+
+    def test_update(self):
+        self.db.set('x.a', 1)
+        with patch.object(unitdata, '_MAX_VARIABLES', 2):
+            with self.db.hook_scope('config-changed') as revision:
+                self.db.update({'a': 1, 'b': 2, 'c': {'d': 3}}, prefix='x.')
+        self.assertEqual(self.db.getrange('x.', strip=True),
+                         {'a': 1, 'b': 2, 'c': {'d': 3}})
+        self.assertEqual(self._revisions(),
+                         [('x.b', revision, '2'),
+                          ('x.c', revision, '{"d": 3}')])
+
+    def test_compact(self):
+        revisions = []
+        for i in range(5):
+            with self.db.hook_scope('update-status') as revision:
+                self.db.set('counter', i)
+                revisions.append(revision)
+        self.assertEqual(self.db.compact(retention=2), 3)
+        self.db.flush()
+        self.assertEqual([r[0] for r in self.db.gethistory('counter')],
+                         revisions[-2:])
+        self.assertEqual(self.db.get('counter'), 4)
+
+    @patch.object(unitdata, 'COMPACT_INTERVAL', 3)
+    @patch.object(unitdata, 'REVISION_RETENTION', 1)
+    def test_hook_scope_compacts(self):
+        for i in range(3):
+            with self.db.hook_scope('update-status'):
+                self.db.set('counter', i)
+        # the third hook compacted everything before itself
+        self.assertEqual(len(self._revisions()), 1)
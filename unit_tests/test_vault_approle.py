@@ -0,0 +1,111 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from mock import patch
+
+from charmhelpers.core import unitdata
+
+import vault_approle
+from fake_vault import FakeVault
+
+
+class CheckCredentialsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.vault = FakeVault(ttl=60).start()
+        self.addCleanup(self.vault.stop)
+        self.vault.add_approle('role', 'secret')
+        self.db = unitdata.Storage(':memory:')
+
+    def _check(self, now, secret_id='secret'):
+        vault_approle.check_credentials(self.vault.url, 'role', secret_id,
+                                        db=self.db, now=now)
+
+    def test_check_trusted_for_interval(self):
+        self._check(1000)
+        # later hooks do not contact vault, however short the token lease
+        self._check(1000 + 60)
+        self._check(1000 + vault_approle.CHECK_INTERVAL - 1)
+        self.assertEqual(self.vault.requests, ['/v1/auth/approle/login'])
+
+        self._check(1000 + vault_approle.CHECK_INTERVAL)
+        self.assertEqual(len(self.vault.requests), 2)
+
+    def test_long_lease(self):
+        self.vault.ttl = 3 * vault_approle.CHECK_INTERVAL
+        self._check(1000)
+        self._check(1000 + 2 * vault_approle.CHECK_INTERVAL)
+        self.assertEqual(len(self.vault.requests), 1)
+
+    def test_new_credentials(self):
+        self._check(1000)
+        self.vault.add_approle('role', 'reissued')
+        self._check(1000, 'reissued')
+        self.assertEqual(len(self.vault.requests), 2)
+
+    def test_refused_credentials(self):
+        self.assertRaises(vault_approle.VaultRefused, self._check, 1000,
+                          'revoked')
+        self.assertRaises(vault_approle.VaultRefused, self._check, 1000, None)
+        self.assertIsNone(self.db.get(vault_approle.CHECK_KEY))
+
+    def test_unreachable(self):
+        self.vault.stop()
+        with patch.object(vault_approle, 'REQUEST_TIMEOUT', 1):
+            with self.assertRaises(vault_approle.VaultError) as cm:
+                self._check(1000)
+        self.assertNotIsInstance(cm.exception, vault_approle.VaultRefused)
+
+
+@unittest.skipUnless(shutil.which('openssl'), 'openssl is not installed')
+class CheckCredentialsTLSTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        key = os.path.join(tmp, 'key.pem')
+        cert = os.path.join(tmp, 'cert.pem')
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+             '-keyout', key, '-out', cert, '-days', '1',
+             '-subj', '/CN=127.0.0.1',
+             '-addext', 'subjectAltName=IP:127.0.0.1'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(cert) as f:
+            self.ca = f.read()
+        certfile = os.path.join(tmp, 'server.pem')
+        with open(certfile, 'w') as f:
+            f.write(self.ca)
+            with open(key) as k:
+                f.write(k.read())
+        self.vault = FakeVault(certfile=certfile).start()
+        self.addCleanup(self.vault.stop)
+        self.vault.add_approle('role', 'secret')
+        self.db = unitdata.Storage(':memory:')
+
+    def test_verified_with_vault_ca(self):
+        vault_approle.check_credentials(self.vault.url, 'role', 'secret',
+                                        ca=self.ca, db=self.db, now=1000)
+        self.assertEqual(self.vault.requests, ['/v1/auth/approle/login'])
+
+    def test_unknown_ca(self):
+        self.assertRaises(vault_approle.VaultError,
+                          vault_approle.check_credentials, self.vault.url,
+                          'role', 'secret', db=self.db, now=1000)
@@ -0,0 +1,173 @@
+# Copyright 2018 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import call, patch
+
+from charmhelpers.core import unitdata
+
+from ceph import utils as ceph_utils
+from ceph import weight_ramp
+
+TiB = 1024 ** 4
+
+
+class TargetWeightTestCase(unittest.TestCase):
+
+    @patch.object(weight_ramp.subprocess, 'check_output')
+    def test_bluestore(self, _check_output):
+        osd_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, osd_path)
+        os.makedirs(os.path.join(osd_path, 'ceph-3'))
+        os.symlink('/dev/null', os.path.join(osd_path, 'ceph-3', 'block'))
+        _check_output.return_value = str(4 * TiB).encode('UTF-8')
+        self.assertEqual(weight_ramp.osd_target_weight(3, osd_path), 4.0)
+        _check_output.assert_called_once_with(
+            ['blockdev', '--getsize64', '/dev/null'])
+
+    @patch.object(weight_ramp.subprocess, 'check_output')
+    def test_misplaced_ratio(self, _check_output):
+        _check_output.return_value = json.dumps(
+            {'pg_summary': {'misplaced_ratio': 0.25}}).encode('UTF-8')
+        self.assertEqual(weight_ramp.misplaced_ratio('osd-upgrade'), 0.25)
+        # luminous omits the counters when nothing is misplaced
+        _check_output.return_value = b'{"num_pgs": 64}'
+        self.assertEqual(weight_ramp.misplaced_ratio('osd-upgrade'), 0.0)
+
+
+@patch.object(weight_ramp, 'log')
+@patch.object(weight_ramp, 'get_local_osd_ids', lambda: ['3', '4'])
+@patch.object(weight_ramp, 'osd_target_weight', lambda osd_id: 2.0)
+@patch.object(weight_ramp, 'reweight_osd')
+@patch.object(weight_ramp, 'misplaced_ratio')
+class RampTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = unitdata.Storage(':memory:')
+        patcher = patch.object(weight_ramp, 'get_crush_weights')
+        self.get_crush_weights = patcher.start()
+        self.get_crush_weights.return_value = {}
+        self.addCleanup(patcher.stop)
+
+    def test_ramp(self, _misplaced_ratio, _reweight_osd, _log):
+        _misplaced_ratio.return_value = 0.0
+        weight_ramp.enroll([3, 4], self.db)
+        self.assertEqual(weight_ramp.progress(self.db), (2, 0))
+
+        weight_ramp.advance('osd-upgrade', 0.4, db=self.db)
+        _reweight_osd.assert_has_calls([
+            call('3', '0.8', 'osd-upgrade'),
+            call('4', '0.8', 'osd-upgrade')])
+        self.assertEqual(weight_ramp.progress(self.db), (2, 40))
+
+        # held while the last step is still moving data
+        _reweight_osd.reset_mock()
+        _misplaced_ratio.return_value = 0.05
+        weight_ramp.advance('osd-upgrade', 0.4, db=self.db)
+        _reweight_osd.assert_not_called()
+
+        _misplaced_ratio.return_value = 0.005
+        weight_ramp.advance('osd-upgrade', 0.4, db=self.db)
+        self.assertEqual(weight_ramp.progress(self.db), (2, 80))
+        self.assertEqual(weight_ramp.advance('osd-upgrade', 0.4,
+                                             db=self.db), {})
+        _reweight_osd.assert_called_with('4', '2', 'osd-upgrade')
+        self.assertIsNone(weight_ramp.progress(self.db))
+
+    def test_enroll_once(self, _misplaced_ratio, _reweight_osd, _log):
+        weight_ramp.enroll([3], self.db)
+        self.db.set('osd-weight-ramp', {'3': {'weight': 1.0,
+                                              'target': 2.0}})
+        weight_ramp.enroll([3], self.db)
+        self.assertEqual(weight_ramp.progress(self.db), (1, 50))
+
+    def test_gone_osds_dropped(self, _misplaced_ratio, _reweight_osd, _log):
+        _misplaced_ratio.return_value = 0.0
+        weight_ramp.enroll([5], self.db)
+        self.assertEqual(weight_ramp.advance('osd-upgrade', db=self.db), {})
+        _reweight_osd.assert_not_called()
+
+    def test_discovers_zero_weight_osds(self, _misplaced_ratio,
+                                        _reweight_osd, _log):
+        _misplaced_ratio.return_value = 0.0
+        # osd.4 is not in the CRUSH map yet
+        self.get_crush_weights.return_value = {3: 0.0, 7: 0.0}
+        weight_ramp.advance('osd-upgrade', 0.5, db=self.db)
+        _reweight_osd.assert_called_once_with('3', '1', 'osd-upgrade')
+        self.assertEqual(weight_ramp.progress(self.db), (1, 50))
+
+        _reweight_osd.reset_mock()
+        self.get_crush_weights.return_value = {3: 1.0, 4: 0.0}
+        weight_ramp.advance('osd-upgrade', 0.5, db=self.db)
+        _reweight_osd.assert_has_calls([
+            call('3', '2', 'osd-upgrade'),
+            call('4', '1', 'osd-upgrade')])
+
+        # weighted to 0 by hand once ramped in, osd.3 is left there
+        _reweight_osd.reset_mock()
+        self.get_crush_weights.return_value = {3: 0.0, 4: 1.0}
+        weight_ramp.advance('osd-upgrade', 0.5, db=self.db)
+        _reweight_osd.assert_called_once_with('4', '2', 'osd-upgrade')
+        self.assertIsNone(weight_ramp.progress(self.db))
+
+    def test_discovery_retries_failed_enroll(self, _misplaced_ratio,
+                                             _reweight_osd, _log):
+        _misplaced_ratio.return_value = 0.0
+        self.get_crush_weights.return_value = {3: 0.0, 4: 2.0}
+        with patch.object(weight_ramp, 'osd_target_weight',
+                          side_effect=OSError('no such directory')):
+            self.assertEqual(weight_ramp.discover('osd-upgrade', self.db),
+                             {})
+        self.assertEqual(self.db.get(weight_ramp.SEEN_KEY), [4])
+        self.assertEqual(sorted(weight_ramp.discover('osd-upgrade',
+                                                     self.db)), ['3'])
+
+    def test_disabled_ramp_enrolls_nothing(self, _misplaced_ratio,
+                                           _reweight_osd, _log):
+        self.assertEqual(weight_ramp.advance(
+            'osd-upgrade', 1.0, db=self.db, enroll_new=False), {})
+        self.get_crush_weights.assert_not_called()
+
+
+class CrushWeightsTestCase(unittest.TestCase):
+
+    @patch.object(weight_ramp.subprocess, 'check_output')
+    def test_get_crush_weights(self, _check_output):
+        _check_output.return_value = json.dumps({
+            'nodes': [{'id': -1, 'type': 'root', 'name': 'default'},
+                      {'id': 3, 'type': 'osd', 'crush_weight': 0}],
+            'stray': [{'id': 4, 'type': 'osd', 'crush_weight': 1.5}],
+        }).encode('UTF-8')
+        self.assertEqual(weight_ramp.get_crush_weights('osd-upgrade'),
+                         {3: 0.0, 4: 1.5})
+        _check_output.assert_called_once_with(
+            ['ceph', '--id', 'osd-upgrade', 'osd', 'tree', '--format=json'])
+
+
+class ReweightTestCase(unittest.TestCase):
+
+    @patch.object(ceph_utils, 'log')
+    @patch.object(ceph_utils.subprocess, 'check_output')
+    def test_reweight_osd_as_service(self, _check_output, _log):
+        _check_output.return_value = (
+            b"reweighted item id 3 name 'osd.3' to 0.8 in crush map")
+        self.assertTrue(ceph_utils.reweight_osd(3, '0.8', 'osd-upgrade'))
+        _check_output.assert_called_once_with(
+            ['ceph', '--id', 'osd-upgrade', 'osd', 'crush', 'reweight',
+             'osd.3', '0.8'], stderr=ceph_utils.subprocess.STDOUT)